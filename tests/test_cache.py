@@ -0,0 +1,85 @@
+import json
+from unittest import TestCase
+
+from tilekiln.cache import CacheCollector, TileCache
+from tilekiln.tile import Tile
+
+
+class TestCache(TestCase):
+    def test_get_put(self):
+        cache = TileCache(100, 60)
+        self.assertIsNone(cache.get("foo", Tile(1, 0, 0)))
+        cache.put("foo", Tile(1, 0, 0), b'abc', b'hash')
+        cache.put("foo", Tile(1, 0, 1), b'')
+        self.assertEqual(cache.get("foo", Tile(1, 0, 0)), (b'abc', b'hash'))
+        self.assertEqual(cache.get("foo", Tile(1, 0, 1)), (b'', None))
+        self.assertIsNone(cache.get("bar", Tile(1, 0, 0)))
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        self.assertEqual(cache.size, 3)
+
+    def test_size(self):
+        cache = TileCache(10, 60)
+        cache.put("foo", Tile(1, 0, 0), b'1234')
+        cache.put("foo", Tile(1, 0, 1), b'1234')
+        # Using a tile makes it the most recently used
+        cache.get("foo", Tile(1, 0, 0))
+        cache.put("foo", Tile(1, 1, 0), b'1234')
+        self.assertEqual(cache.get("foo", Tile(1, 0, 0)), (b'1234', None))
+        self.assertIsNone(cache.get("foo", Tile(1, 0, 1)))
+        self.assertEqual(cache.get("foo", Tile(1, 1, 0)), (b'1234', None))
+        self.assertEqual(cache.size, 8)
+
+        # Replacing a tile replaces its size, and tiles bigger than the cache aren't cached
+        cache.put("foo", Tile(1, 0, 0), b'12')
+        cache.put("foo", Tile(1, 1, 1), b'12345678901')
+        self.assertEqual(cache.size, 6)
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl(self):
+        cache = TileCache(100, 60, {2: 0, 3: -1})
+        cache.put("foo", Tile(1, 0, 0), b'abc')
+        cache.put("foo", Tile(2, 0, 0), b'abc')
+        cache.put("foo", Tile(3, 0, 0), b'abc')
+        self.assertEqual(cache.get("foo", Tile(1, 0, 0)), (b'abc', None))
+        self.assertIsNone(cache.get("foo", Tile(2, 0, 0)))
+        self.assertIsNone(cache.get("foo", Tile(3, 0, 0)))
+
+    def test_invalidate(self):
+        cache = TileCache(100, 60)
+        for tile in [Tile(1, 0, 0), Tile(1, 0, 1), Tile(2, 0, 0)]:
+            cache.put("foo", tile, b'abc')
+            cache.put("bar", tile, b'abc')
+
+        cache.handle_notification(json.dumps({"id": "foo", "zoom": 1, "x": 0, "y": 0}))
+        self.assertIsNone(cache.get("foo", Tile(1, 0, 0)))
+        self.assertEqual(cache.get("foo", Tile(1, 0, 1)), (b'abc', None))
+
+        cache.handle_notification(json.dumps({"id": "foo", "zoom": 1}))
+        self.assertIsNone(cache.get("foo", Tile(1, 0, 1)))
+        self.assertEqual(cache.get("foo", Tile(2, 0, 0)), (b'abc', None))
+
+        cache.handle_notification(json.dumps({"id": "foo"}))
+        self.assertIsNone(cache.get("foo", Tile(2, 0, 0)))
+        self.assertEqual(len(cache), 3)
+
+    def test_generation(self):
+        cache = TileCache(100, 60)
+        generation = cache.generation
+        cache.invalidate("foo", 1, 0, 0)
+        cache.put("foo", Tile(1, 0, 0), b'abc', generation=generation)
+        self.assertIsNone(cache.get("foo", Tile(1, 0, 0)))
+        cache.put("foo", Tile(1, 0, 0), b'abc', generation=cache.generation)
+        self.assertEqual(cache.get("foo", Tile(1, 0, 0)), (b'abc', None))
+
+    def test_collector(self):
+        cache = TileCache(100, 60)
+        cache.put("foo", Tile(1, 0, 0), b'abc')
+        cache.get("foo", Tile(1, 0, 0))
+        cache.get("foo", Tile(1, 0, 1))
+        metrics = {sample.name: sample.value
+                   for metric in CacheCollector(cache).collect() for sample in metric.samples}
+        self.assertEqual(metrics["tilekiln_cache_hits_total"], 1)
+        self.assertEqual(metrics["tilekiln_cache_misses_total"], 1)
+        self.assertEqual(metrics["tilekiln_cache_bytes"], 3)
+        self.assertEqual(metrics["tilekiln_cache_max_bytes"], 100)
+        self.assertEqual(metrics["tilekiln_cache_entries"], 1)
@@ -4,7 +4,7 @@ from unittest import TestCase
 from fs.memoryfs import MemoryFS
 
 from tilekiln.config import Config, LayerConfig
-from tilekiln.tile import Tile
+from tilekiln.tile import Metatile, Tile
 
 
 class TestConfig(TestCase):
@@ -136,6 +136,52 @@ class TestConfig(TestCase):
     ]
 }''')
 
+    def test_layer_queries(self):
+        with MemoryFS() as fs:
+            fs.writetext("one.sql.jinja2", "one")
+            fs.writetext("two.sql.jinja2", "two")
+            c_str = ('''{"metadata": {"id":"id"},'''
+                     '''"vector_layers": {'''
+                     '''"b":{"sql": [{"minzoom":0, "maxzoom":4, "file": "two.sql.jinja2"}]},'''
+                     '''"a":{"sql": [{"minzoom":2, "maxzoom":4, "file": "one.sql.jinja2"}]}}}''')
+            c = Config(c_str, fs)
+
+            # Queries are in the same order as the layers
+            self.assertEqual([q.split("\n")[2] for q in c.layer_queries(Tile(3, 0, 0))],
+                             ["two", "one"])
+            self.assertEqual([q.split("\n")[2] for q in c.layer_queries(Tile(1, 0, 0))],
+                             ["two"])
+            self.assertEqual(c.layer_ids(3), ["b", "a"])
+            self.assertEqual(c.layer_ids(1), ["b"])
+            self.assertEqual(c.layer_ids(5), [])
+
+    def test_coordinate_logic_queries(self):
+        with MemoryFS() as fs:
+            fs.writetext("one.sql.jinja2", "one {{ x }}")
+            fs.writetext("logic.sql.jinja2", "{% if x > 0 %}logic{% endif %}")
+            c_str = ('''{"metadata": {"id":"id"},'''
+                     '''"vector_layers": {'''
+                     '''"a":{"sql": [{"minzoom":0, "maxzoom":4, "file": "one.sql.jinja2"}]},'''
+                     '''"b":{"sql": [{"minzoom":0, "maxzoom":4, "file": "logic.sql.jinja2"}]}}}''')
+            c = Config(c_str, fs)
+
+            # Layers using x or y in logic can't be prepared or rendered for metatiles
+            self.assertIsNotNone(c.prepared_layer_queries(2)[0])
+            self.assertIsNone(c.prepared_layer_queries(2)[1])
+            self.assertIsNone(c.prepared_metatile_layer_queries(2)[1])
+            self.assertIsNone(c.metatile_layer_queries(Metatile(2, 0, 0, 2))[1])
+            self.assertIn("logic", c.layer_queries(Tile(2, 1, 0))[1])
+
+    def test_cache_control(self):
+        with MemoryFS() as fs:
+            c = Config('''{"metadata": {"id":"foo"}}''', fs)
+            self.assertEqual(c.cache_control, {})
+            c = Config('''{"metadata": {"id":"foo", "cache_control": "max-age=60"}}''', fs)
+            self.assertEqual(c.cache_control, {0: "max-age=60"})
+            c = Config('''{"metadata": {"id":"foo", "cache_control": '''
+                       '''{"0": "max-age=3600", "10": "max-age=60"}}}''', fs)
+            self.assertEqual(c.cache_control, {0: "max-age=3600", 10: "max-age=60"})
+
 
 class TestLayerConfig(TestCase):
     def test_render(self):
@@ -2,8 +2,8 @@ from unittest import TestCase
 
 from fs.memoryfs import MemoryFS
 
-from tilekiln.definition import Definition
-from tilekiln.tile import Tile
+from tilekiln.definition import Definition, j2Environment, substitutable
+from tilekiln.tile import Metatile, Tile
 
 
 class TestDefinition(TestCase):
@@ -70,3 +70,97 @@ FROM mvtgeom;'''
 SELECT ST_AsMVT(mvtgeom.*, 'units', 1024, 'way', NULL)
 FROM mvtgeom;'''
             self.assertEqual(d.render_sql(Tile(2, 0, 1)), expected)
+
+    def test_render_metatile(self):
+        with MemoryFS() as fs:
+            fs.writetext("two.sql.jinja2", "SELECT {{zoom}}/{{x}}/{{y}}\n{{bbox}}\n" +
+                                           "{{unbuffered_bbox}}")
+            d = Definition("two", {"minzoom": 1, "maxzoom": 3, "extent": 1024, "buffer": 256,
+                                   "file": "two.sql.jinja2"}, fs)
+            expected = '''WITH metatile AS
+(
+SELECT x, y FROM generate_series(0, 3) AS x
+CROSS JOIN generate_series(4, 7) AS y
+)
+SELECT metatile.x, metatile.y, ST_AsMVT(mvtgeom.*, 'two', 1024, 'way', NULL)
+FROM metatile CROSS JOIN LATERAL
+(
+SELECT 3/metatile.x/metatile.y
+ST_TileEnvelope(3, metatile.x, metatile.y, margin=>0.25)
+ST_TileEnvelope(3, metatile.x, metatile.y, margin=>0)
+) AS mvtgeom
+GROUP BY metatile.x, metatile.y;'''
+            self.assertEqual(d.render_metatile_sql(Metatile(3, 0, 4, 4)), expected)
+
+    def test_render_prepared(self):
+        with MemoryFS() as fs:
+            fs.writetext("two.sql.jinja2", "SELECT {{zoom}}/{{x}}/{{y}}\n{{bbox}}")
+            d = Definition("two", {"minzoom": 1, "maxzoom": 3, "extent": 1024, "buffer": 256,
+                                   "file": "two.sql.jinja2"}, fs)
+            expected = '''WITH mvtgeom AS
+(
+SELECT 2/$1/$2
+ST_TileEnvelope(2, $1, $2, margin=>0.25)
+)
+SELECT ST_AsMVT(mvtgeom.*, 'two', 1024, 'way', NULL)
+FROM mvtgeom;'''
+            self.assertEqual(d.render_prepared_sql(2), expected)
+
+            expected = '''WITH metatile AS
+(
+SELECT x, y FROM generate_series($1, $2) AS x
+CROSS JOIN generate_series($3, $4) AS y
+)
+SELECT metatile.x, metatile.y, ST_AsMVT(mvtgeom.*, 'two', 1024, 'way', NULL)
+FROM metatile CROSS JOIN LATERAL
+(
+SELECT 2/metatile.x/metatile.y
+ST_TileEnvelope(2, metatile.x, metatile.y, margin=>0.25)
+) AS mvtgeom
+GROUP BY metatile.x, metatile.y;'''
+            self.assertEqual(d.render_prepared_metatile_sql(2), expected)
+
+    def test_render_cached(self):
+        with MemoryFS() as fs:
+            # Tile variables are substituted into the SQL rendered for the zoom
+            fs.writetext("sub.sql.jinja2", "{{zoom}} {{x}} {{y}} {{x}}")
+            d = Definition("sub", {"minzoom": 1, "maxzoom": 3, "file": "sub.sql.jinja2"}, fs)
+            self.assertEqual(d.render_sql(Tile(2, 0, 1)).split("\n")[2], "2 0 1 0")
+            self.assertEqual(d.render_sql(Tile(2, 3, 2)).split("\n")[2], "2 3 2 3")
+            self.assertEqual(d.render_sql(Tile(3, 7, 5)).split("\n")[2], "3 7 5 7")
+
+            # Tile variables used in Jinja logic are rendered for each tile
+            fs.writetext("logic.sql.jinja2", "{% if x > 1 %}east{% else %}west{% endif %} " +
+                                             "{{ y + 1 }}")
+            d = Definition("logic", {"minzoom": 1, "maxzoom": 3, "file": "logic.sql.jinja2"}, fs)
+            self.assertEqual(d.render_sql(Tile(2, 0, 1)).split("\n")[2], "west 2")
+            self.assertEqual(d.render_sql(Tile(2, 3, 2)).split("\n")[2], "east 3")
+
+    def test_substitutable(self):
+        self.assertTrue(substitutable(j2Environment.parse("")))
+        self.assertTrue(substitutable(j2Environment.parse("{{x}} {{ y }} {{bbox}}")))
+        self.assertTrue(substitutable(j2Environment.parse("{% if zoom > 2 %}{{x}}{% endif %}")))
+        self.assertFalse(substitutable(j2Environment.parse("{{x + 1}}")))
+        self.assertFalse(substitutable(j2Environment.parse("{{bbox|upper}}")))
+        self.assertFalse(substitutable(j2Environment.parse("{% if y %}{% endif %}")))
+        self.assertFalse(substitutable(j2Environment.parse("{% set x = 1 %}{{x}}")))
+
+    def test_coordinate_logic(self):
+        with MemoryFS() as fs:
+            fs.writetext("logic.sql.jinja2",
+                         "SELECT {% if x > 3 %}{{ x + y }}{% else %}{{ bbox }}{% endif %}")
+            d = Definition("logic", {"minzoom": 1, "maxzoom": 3, "file": "logic.sql.jinja2"}, fs)
+            self.assertFalse(d.sql_coordinates)
+            self.assertEqual(d.render_sql(Tile(3, 4, 1)).split("\n")[2], "SELECT 5")
+            # x and y can't be SQL expressions when they are used in logic
+            with self.assertRaisesRegex(ValueError, "logic"):
+                d.render_prepared_sql(3)
+            with self.assertRaisesRegex(ValueError, "logic"):
+                d.render_metatile_sql(Metatile(3, 0, 0, 2))
+            with self.assertRaisesRegex(ValueError, "logic"):
+                d.render_prepared_metatile_sql(3)
+
+            # Logic on other variables is fine
+            fs.writetext("zoom.sql.jinja2", "SELECT {% if zoom > 2 %}{{ x }}{% endif %}")
+            d = Definition("zoom", {"minzoom": 1, "maxzoom": 3, "file": "zoom.sql.jinja2"}, fs)
+            self.assertTrue(d.sql_coordinates)
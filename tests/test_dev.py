@@ -0,0 +1,21 @@
+from unittest import TestCase
+
+from tilekiln.dev import profile_headers
+from tilekiln.kiln import LayerProfile
+
+
+class TestDev(TestCase):
+    def test_profile_headers(self):
+        headers = profile_headers([LayerProfile("water", 0.0123, 100),
+                                   LayerProfile("admin lines", 0.002, 0),
+                                   LayerProfile("a,b=c\r\n", 0.001, 5)], 0.015)
+        self.assertEqual(headers["Server-Timing"],
+                         'water;dur=12.3;desc="100 bytes", '
+                         'admin_lines;dur=2.0;desc="0 bytes", '
+                         'a_b_c__;dur=1.0;desc="5 bytes", '
+                         'render;dur=15.0')
+        self.assertEqual(headers["X-Tilekiln-Layers"], "water=100, admin_lines=0, a_b_c__=5")
+
+        headers = profile_headers([], 0.001)
+        self.assertEqual(headers["Server-Timing"], "render;dur=1.0")
+        self.assertEqual(headers["X-Tilekiln-Layers"], "")
@@ -0,0 +1,53 @@
+from unittest import TestCase
+
+from tilekiln.expire import ExpiredTiles, pack, read_expire_list, unpack
+from tilekiln.tile import Tile
+
+
+def tiles(expired):
+    return [(t.zoom, t.x, t.y) for t in expired]
+
+
+class TestExpire(TestCase):
+    def test_pack(self):
+        self.assertEqual(unpack(3, pack(3, 5, 2)), (5, 2))
+        self.assertEqual(unpack(0, pack(0, 0, 0)), (0, 0))
+        self.assertNotEqual(pack(3, 5, 2), pack(3, 2, 5))
+
+    def test_read_expire_list(self):
+        self.assertEqual(tiles(read_expire_list(["3/2/1\n", "\n", "4/5/6"])),
+                         [(3, 2, 1), (4, 5, 6)])
+
+    def test_empty(self):
+        expired = ExpiredTiles(0, 3)
+        self.assertEqual(list(expired.zooms()), [])
+        self.assertEqual(tiles(expired), [])
+
+    def test_parents(self):
+        expired = ExpiredTiles(0, 2)
+        expired.update([Tile(2, 3, 3), Tile(2, 2, 2), Tile(2, 0, 1)])
+        self.assertEqual(tiles(expired), [(0, 0, 0),
+                                          (1, 0, 0), (1, 1, 1),
+                                          (2, 0, 1), (2, 2, 2), (2, 3, 3)])
+
+    def test_children(self):
+        expired = ExpiredTiles(1, 2)
+        expired.add(Tile(1, 1, 0))
+        self.assertEqual(tiles(expired), [(1, 1, 0),
+                                          (2, 2, 0), (2, 2, 1), (2, 3, 0), (2, 3, 1)])
+
+    def test_zoom_range(self):
+        # Tiles above the max zoom expire their parent, and zooms below the min zoom
+        # are skipped
+        expired = ExpiredTiles(1, 2)
+        expired.add(Tile(4, 15, 0))
+        self.assertEqual(tiles(expired), [(1, 1, 0), (2, 3, 0)])
+
+    def test_deduplicate(self):
+        expired = ExpiredTiles(0, 2)
+        expired.update([Tile(1, 0, 0), Tile(2, 1, 1), Tile(2, 1, 1), Tile(2, 2, 2),
+                        Tile(1, 0, 0)])
+        self.assertEqual(tiles(expired), [(0, 0, 0),
+                                          (1, 0, 0), (1, 1, 1),
+                                          (2, 2, 2), (2, 0, 0), (2, 0, 1), (2, 1, 0),
+                                          (2, 1, 1)])
@@ -0,0 +1,112 @@
+import threading
+import time
+from unittest import TestCase
+
+from tilekiln.kiln import Kiln, KilnPool, KilnPoolFull
+from tilekiln.tile import Metatile, Tile
+
+
+class FakeKiln:
+    def __init__(self):
+        # Held to stop renders from finishing
+        self.lock = threading.Lock()
+
+    def render(self, tile):
+        with self.lock:
+            return f"{tile.zoom}/{tile.x}/{tile.y}".encode()
+
+
+class TestKilnPool(TestCase):
+    def test_render(self):
+        kilns = KilnPool([FakeKiln(), FakeKiln()])  # type: ignore[list-item]
+        self.assertEqual(kilns.render(Tile(1, 0, 1)), b'1/0/1')
+        self.assertEqual((kilns.in_use, kilns.waiting), (0, 0))
+
+    def test_full(self):
+        kiln = FakeKiln()
+        kilns = KilnPool([kiln], 1)  # type: ignore[list-item]
+        results = []
+        with kilns.kiln() as taken:
+            self.assertIs(taken, kiln)
+            waiter = threading.Thread(target=lambda: results.append(kilns.render(Tile(1, 0, 0))))
+            waiter.start()
+            while kilns.waiting == 0:
+                time.sleep(0.001)
+            self.assertEqual((kilns.in_use, kilns.waiting), (1, 1))
+            # One render is running and one is waiting, so another is turned away
+            with self.assertRaises(KilnPoolFull):
+                kilns.render(Tile(1, 1, 0))
+            self.assertEqual(kilns.rejected, 1)
+        waiter.join()
+        self.assertEqual(results, [b'1/0/0'])
+        self.assertEqual((kilns.in_use, kilns.waiting), (0, 0))
+
+    def test_no_waiting(self):
+        kilns = KilnPool([FakeKiln()], 0)  # type: ignore[list-item]
+        with kilns.kiln():
+            with self.assertRaises(KilnPoolFull):
+                kilns.render(Tile(1, 0, 0))
+        self.assertEqual(kilns.render(Tile(1, 0, 0)), b'1/0/0')
+
+
+class FakeCursor:
+    def __init__(self):
+        self.sql = ""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, binary=False):
+        self.sql = sql
+
+    def fetchall(self):
+        if self.sql.startswith("EXECUTE"):
+            return [(b'prepared',)]
+        if self.sql == "metatile":
+            return [(0, 0, b'metatile'), (1, 1, b'metatile')]
+        return [(f"[{self.sql}]".encode(),)]
+
+
+class FakeConnection:
+    def execute(self, sql):
+        pass
+
+    def cursor(self):
+        return FakeCursor()
+
+
+class FakeConfig:
+    '''A config where layer b uses x or y in logic, so it can't be prepared or rendered
+       for metatiles'''
+    id = "fake"
+
+    def layer_ids(self, zoom):
+        return ["a", "b"]
+
+    def layer_queries(self, tile):
+        return [f"a {tile.x}/{tile.y}", f"b {tile.x}/{tile.y}"]
+
+    def prepared_layer_queries(self, zoom):
+        return ["prepared", None]
+
+    def metatile_layer_queries(self, metatile):
+        return ["metatile", None]
+
+    def prepared_metatile_layer_queries(self, zoom):
+        return ["prepared metatile", None]
+
+
+class TestKiln(TestCase):
+    def test_unprepared_layers(self):
+        kiln = Kiln(FakeConfig(), FakeConnection(), prepared=True)  # type: ignore[arg-type]
+        self.assertEqual(kiln.render(Tile(1, 1, 0)), b'prepared[b 1/0]')
+
+    def test_per_tile_layers(self):
+        kiln = Kiln(FakeConfig(), FakeConnection())  # type: ignore[arg-type]
+        tiles = {(tile.x, tile.y): data
+                 for tile, data in kiln.render_metatile(Metatile(1, 0, 0, 2))}
+        self.assertEqual(tiles, {(0, 0): b'metatile[b 0/0]', (0, 1): b'[b 0/1]',
+                                 (1, 0): b'[b 1/0]', (1, 1): b'metatile[b 1/1]'})
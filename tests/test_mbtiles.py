@@ -0,0 +1,64 @@
+import gzip
+import json
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+from tilekiln.mbtiles import export_mbtiles, mbtiles_metadata
+from tilekiln.tile import Tile
+
+
+class FakeTileset:
+    minzoom = 0
+    maxzoom = 2
+    tilejson = json.dumps({"name": "Test", "bounds": [-180, -85, 180, 85],
+                           "center": [0, 0, 1], "attribution": "OSM",
+                           "vector_layers": [{"id": "water", "fields": {}}]})
+
+
+class FakeStorage:
+    def __init__(self):
+        self.exported = None
+
+    def get_tileset(self, id):
+        return FakeTileset()
+
+    def export_tiles(self, id, zooms):
+        self.exported = list(zooms)
+        yield Tile(1, 0, 0), gzip.compress(b'1/0/0')
+        yield Tile(1, 1, 0), b''
+        yield Tile(2, 3, 1), gzip.compress(b'2/3/1')
+
+
+class TestMBTiles(TestCase):
+    def test_metadata(self):
+        metadata = mbtiles_metadata(FakeTileset.tilejson, 1, 2)
+        self.assertEqual(metadata["name"], "Test")
+        self.assertEqual(metadata["format"], "pbf")
+        self.assertEqual((metadata["minzoom"], metadata["maxzoom"]), ("1", "2"))
+        self.assertEqual(metadata["bounds"], "-180,-85,180,85")
+        self.assertEqual(metadata["center"], "0,0,1")
+        self.assertEqual(metadata["attribution"], "OSM")
+        self.assertNotIn("description", metadata)
+        self.assertEqual(json.loads(metadata["json"]),
+                         {"vector_layers": [{"id": "water", "fields": {}}]})
+
+    def test_export(self):
+        storage = FakeStorage()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "test.mbtiles")
+            self.assertEqual(export_mbtiles(storage, "foo", path, [2, 1, 5]), 2)
+            self.assertEqual(storage.exported, [1, 2])
+            db = sqlite3.connect(path)
+            # Rows count from the south, and empty tiles are left out
+            self.assertEqual(db.execute('''SELECT zoom_level, tile_column, tile_row, tile_data
+                                           FROM tiles ORDER BY zoom_level''').fetchall(),
+                             [(1, 0, 1, gzip.compress(b'1/0/0')),
+                              (2, 3, 2, gzip.compress(b'2/3/1'))])
+            self.assertEqual(dict(db.execute('''SELECT name, value FROM metadata''')
+                                  )["minzoom"], "1")
+            db.close()
+
+            with self.assertRaises(FileExistsError):
+                export_mbtiles(storage, "foo", path)
@@ -0,0 +1,87 @@
+import multiprocessing
+import queue
+import time
+from unittest import TestCase, mock
+
+import click
+from click.testing import CliRunner
+
+from tilekiln.expire import ExpiredTiles
+from tilekiln.scripts import (_join_checked, _render_worker, cli, unique_expired_metatiles,
+                              unique_metatiles)
+from tilekiln.tile import Tile
+
+
+def fail():
+    raise RuntimeError("render failed")
+
+
+def hang():
+    time.sleep(60)
+
+
+class TestGenerate(TestCase):
+    def test_render_worker_failure(self):
+        tile_queue: queue.Queue = queue.Queue()
+        tile_queue.put(Tile(1, 0, 0))
+        result_queue: queue.Queue = queue.Queue()
+        with mock.patch("tilekiln.load_config"), \
+                mock.patch("psycopg.connect", side_effect=RuntimeError("connect failed")):
+            with self.assertRaises(RuntimeError):
+                _render_worker("config.yaml", {}, {}, False, tile_queue, result_queue)
+        # The writer is still told the worker is done
+        self.assertIsNone(result_queue.get_nowait())
+
+    def test_join_checked(self):
+        processes = [multiprocessing.Process(target=target, daemon=True)
+                     for target in (hang, fail)]
+        for process in processes:
+            process.start()
+        start = time.monotonic()
+        # A failed process fails the join without waiting for the others
+        with self.assertRaises(click.ClickException):
+            _join_checked(processes)
+        self.assertLess(time.monotonic() - start, 30)
+        processes[0].terminate()
+
+    def test_unique_metatiles(self):
+        tiles = [Tile(3, 0, 1), Tile(2, 1, 1), Tile(3, 1, 0), Tile(3, 2, 0), Tile(2, 0, 0)]
+        self.assertEqual([(m.zoom, m.x, m.y, m.size) for m in unique_metatiles(tiles, 2)],
+                         [(3, 0, 0, 2), (2, 0, 0, 2), (3, 2, 0, 2)])
+
+        expired = ExpiredTiles(1, 2)
+        expired.add(Tile(2, 3, 3))
+        self.assertEqual([(m.zoom, m.x, m.y, m.size)
+                          for m in unique_expired_metatiles(expired, 2)],
+                         [(1, 0, 0, 2), (2, 2, 2, 2)])
+
+
+class TestStorage(TestCase):
+    def test_delete_bbox(self):
+        bbox = ["-10", "40", "5", "55.5"]
+        with mock.patch("psycopg_pool.NullConnectionPool"), \
+                mock.patch("tilekiln.scripts.Storage") as storage:
+            storage.return_value.delete_bbox.return_value = 7
+            result = CliRunner().invoke(cli, ["storage", "delete", "--id", "foo",
+                                              "--bbox", *bbox])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Deleted 7 tiles", result.output)
+            storage.return_value.delete_bbox.assert_called_once_with(
+                "foo", None, (-10.0, 40.0, 5.0, 55.5))
+
+            result = CliRunner().invoke(cli, ["storage", "delete", "--id", "foo",
+                                              "-z", "3", "-z", "5", "--bbox", *bbox])
+            self.assertEqual(result.exit_code, 0, result.output)
+            storage.return_value.delete_bbox.assert_called_with(
+                "foo", (3, 5), (-10.0, 40.0, 5.0, 55.5))
+            storage.return_value.truncate_tables.assert_not_called()
+
+    def test_export_missing_tileset(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem(), mock.patch("psycopg_pool.NullConnectionPool"), \
+                mock.patch("tilekiln.scripts.Storage") as storage:
+            storage.return_value.get_tileset.side_effect = KeyError("foo")
+            result = runner.invoke(cli, ["storage", "export", "--id", "foo", "foo.mbtiles"])
+            self.assertEqual(result.exit_code, 1)
+            self.assertIsInstance(result.exception, SystemExit)
+            self.assertIn("Failed to retrieve tileset for id foo", result.output)
@@ -0,0 +1,121 @@
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+from unittest import TestCase, mock
+
+import tilekiln.server
+
+from tilekiln.server import accepts_gzip, etag, etag_matches, pack_tiles, tile_response
+from tilekiln.storage import compress_tile
+
+
+class FakeKiln:
+    def render_metatile(self, metatile):
+        return [(tile, f"{tile.zoom}/{tile.x}/{tile.y}".encode()) for tile in metatile.tiles()]
+
+
+class FakeKilnPool:
+    @contextmanager
+    def kiln(self):
+        yield FakeKiln()
+
+
+class FakeTileset:
+    '''A tileset with nothing stored, which renders metatiles once release is set'''
+    def __init__(self):
+        self.release = threading.Event()
+        self.renders = 0
+
+    def get_cache_control(self, zoom):
+        return None
+
+    def get_stored_tile(self, tile):
+        return None
+
+    def get_or_render_metatile(self, tile, metatile, render, save=None, pending=None):
+        self.renders += 1
+        self.release.wait()
+        return {(t.x, t.y): (data, hashlib.sha256(data).digest()) for t, data in render()}
+
+
+class TestServer(TestCase):
+    def test_accepts_gzip(self):
+        self.assertFalse(accepts_gzip(None))
+        self.assertFalse(accepts_gzip(""))
+        self.assertFalse(accepts_gzip("identity"))
+        self.assertTrue(accepts_gzip("gzip"))
+        self.assertTrue(accepts_gzip("gzip, deflate, br"))
+        self.assertTrue(accepts_gzip("deflate, GZIP;q=0.5"))
+        self.assertTrue(accepts_gzip("*"))
+        self.assertFalse(accepts_gzip("gzip;q=0"))
+        self.assertFalse(accepts_gzip("gzip;q=0, *"))
+        self.assertTrue(accepts_gzip("*;q=0, gzip"))
+
+    def test_etag(self):
+        self.assertEqual(etag(b'\x01\xab', False), '"01ab"')
+        self.assertEqual(etag(b'\x01\xab', True), '"01ab-gzip"')
+
+    def test_etag_matches(self):
+        self.assertFalse(etag_matches(None, b'\x01'))
+        self.assertFalse(etag_matches('"01"', None))
+        self.assertTrue(etag_matches('"01"', b'\x01'))
+        self.assertTrue(etag_matches('"01-gzip"', b'\x01'))
+        self.assertTrue(etag_matches('W/"01"', b'\x01'))
+        self.assertTrue(etag_matches('"02", "01"', b'\x01'))
+        self.assertTrue(etag_matches('*', b'\x01'))
+        self.assertFalse(etag_matches('"02"', b'\x01'))
+
+    def test_pack_tiles(self):
+        self.assertEqual(pack_tiles([]), b'')
+        self.assertEqual(pack_tiles([b'abc', None, b'']),
+                         b'\x00\x00\x00\x03abc' b'\xff\xff\xff\xff' b'\x00\x00\x00\x00')
+
+    def test_tile_response(self):
+        tile = b'tile data'
+        hash = hashlib.sha256(tile).digest()
+        for accept_encoding in (None, "gzip"):
+            # Stored tiles are compressed, and rendered ones are not
+            stored = tile_response(compress_tile(tile), True, accept_encoding, hash)
+            rendered = tile_response(tile, False, accept_encoding, hash)
+            self.assertEqual(stored.body, rendered.body)
+            self.assertEqual(stored.headers, rendered.headers)
+        self.assertEqual(rendered.body, compress_tile(tile))
+        self.assertEqual(rendered.headers["Content-Encoding"], "gzip")
+        self.assertEqual(rendered.headers["ETag"], etag(hash, True))
+        self.assertEqual(tile_response(tile, False, None, hash).headers["ETag"], etag(hash, False))
+
+    def test_empty_tile_response(self):
+        # Empty tiles have no content, and are never gzipped
+        hash = hashlib.sha256(b'').digest()
+        for accept_encoding in (None, "gzip"):
+            for compressed in (False, True):
+                response = tile_response(b'', compressed, accept_encoding, hash)
+                self.assertEqual(response.status_code, 204)
+                self.assertEqual(response.body, b'')
+                self.assertNotIn("Content-Encoding", response.headers)
+                self.assertEqual(response.headers["ETag"], etag(hash, False))
+
+    def test_live_render_metatile_once(self):
+        tileset = FakeTileset()
+        responses = {}
+
+        def request(x, y):
+            responses[(x, y)] = tilekiln.server.live_serve_tile("foo", 2, x, y, None, None)
+
+        with mock.patch.dict(tilekiln.server.tilesets, {"foo": tileset}), \
+                mock.patch.dict(os.environ, {tilekiln.server.TILEKILN_METATILE_SIZE: "2"}), \
+                mock.patch.object(tilekiln.server, "kilns", FakeKilnPool(), create=True):
+            # Tiles of the same metatile share a render
+            requests = [threading.Thread(target=request, args=(x, y))
+                        for x, y in ((0, 0), (1, 1), (0, 1))]
+            for thread in requests:
+                thread.start()
+            time.sleep(0.1)
+            tileset.release.set()
+            for thread in requests:
+                thread.join()
+        self.assertEqual(tileset.renders, 1)
+        self.assertEqual({tile: response.body for tile, response in responses.items()},
+                         {(0, 0): b'2/0/0', (1, 1): b'2/1/1', (0, 1): b'2/0/1'})
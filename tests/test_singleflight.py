@@ -0,0 +1,50 @@
+import threading
+from unittest import TestCase
+
+from tilekiln.singleflight import SingleFlight
+
+
+class TestSingleFlight(TestCase):
+    def test_do(self):
+        flight: SingleFlight[int] = SingleFlight()
+        self.assertEqual(flight.do("a", lambda: 1), 1)
+        # Calls after one is done run again
+        self.assertEqual(flight.do("a", lambda: 2), 2)
+
+    def test_concurrent(self):
+        flight: SingleFlight[int] = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 5
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do("a", slow)))
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=lambda: results.append(flight.do("a", slow)))
+                     for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        # A different key doesn't wait
+        self.assertEqual(flight.do("b", lambda: 6), 6)
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join()
+        self.assertEqual(results, [5, 5, 5, 5])
+        self.assertEqual(len(calls), 1)
+
+    def test_error(self):
+        flight: SingleFlight[int] = SingleFlight()
+
+        def fail():
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            flight.do("a", fail)
+        self.assertEqual(flight.do("a", lambda: 1), 1)
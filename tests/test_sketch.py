@@ -0,0 +1,48 @@
+from unittest import TestCase
+
+from tilekiln.sketch import SIZE_ACCURACY, SizeSketch, bucket_size, size_bucket
+
+
+class TestSketch(TestCase):
+    def test_size_bucket(self):
+        self.assertEqual(size_bucket(0), 0)
+        self.assertEqual(size_bucket(1), 1)
+        for size in [2, 10, 1000, 123456, 10000000]:
+            self.assertGreaterEqual(size_bucket(size), size_bucket(size - 1))
+            self.assertAlmostEqual(bucket_size(size_bucket(size)) / size, 1,
+                                   delta=SIZE_ACCURACY)
+        self.assertEqual(bucket_size(0), 0)
+
+    def test_quantiles(self):
+        self.assertEqual(SizeSketch().quantiles([0, 0.5, 1]), [0, 0, 0])
+        sketch = SizeSketch([(0, 2), (size_bucket(100), 0), (size_bucket(1000), 7)])
+        sketch.add(5000)
+        self.assertEqual(sketch.count, 10)
+        quantiles = sketch.quantiles([0, 0.2, 0.5, 0.9, 1])
+        self.assertEqual(quantiles[:2], [0, 0])
+        for quantile, size in zip(quantiles[2:], [1000, 1000, 5000]):
+            self.assertAlmostEqual(quantile / size, 1, delta=SIZE_ACCURACY)
+
+    def test_accuracy(self):
+        sketch = SizeSketch()
+        sizes = [size * 37 for size in range(1, 1001)]
+        for size in sizes:
+            sketch.add(size)
+        for quantile in [0.5, 0.9, 0.99, 0.999]:
+            exact = sizes[round(quantile * (len(sizes) - 1))]
+            self.assertAlmostEqual(sketch.quantile(quantile) / exact, 1, delta=SIZE_ACCURACY)
+
+    def test_merge(self):
+        a = SizeSketch()
+        b = SizeSketch()
+        for size in range(100, 200):
+            a.add(size)
+            b.add(size * 10)
+        a.merge(b)
+        a.add(150, -1)
+        self.assertEqual(a.count, 199)
+        self.assertAlmostEqual(a.quantile(1) / 1990, 1, delta=SIZE_ACCURACY)
+        # Removing every tile from a bucket removes the bucket
+        a.add(7)
+        a.add(7, -1)
+        self.assertNotIn(size_bucket(7), dict(a.buckets()))
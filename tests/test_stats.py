@@ -0,0 +1,38 @@
+from unittest import TestCase
+
+from tilekiln.metric import RenderStat
+from tilekiln.stats import RENDER_TIME_BUCKETS, RenderStats
+
+
+class TestRenderStats(TestCase):
+    def test_record(self):
+        stats = RenderStats()
+        stats.record("foo", 1, 1, 0.02, [("water", 0.015), ("roads", 0.005)])
+        stats.record("foo", 1, 4, 100, [("water", 100)])
+        stats.record("foo", 2, 1, 0.001)
+
+        by_key = {(s.id, s.zoom, s.layer): s for s in stats.take()}
+        self.assertEqual(set(by_key), {("foo", 1, ""), ("foo", 1, "water"), ("foo", 1, "roads"),
+                                       ("foo", 2, "")})
+        tile = by_key[("foo", 1, "")]
+        self.assertEqual(tile.num_rendered, 5)
+        self.assertAlmostEqual(tile.time_rendered, 100.02)
+        self.assertEqual(len(tile.buckets), len(RENDER_TIME_BUCKETS) + 1)
+        self.assertEqual(tile.buckets[RENDER_TIME_BUCKETS.index(0.025)], 1)
+        self.assertEqual(tile.buckets[-1], 1)
+        # Times equal to a bucket bound are counted in that bucket
+        self.assertEqual(by_key[("foo", 1, "roads")].buckets[0], 1)
+
+        self.assertEqual(stats.take(), [])
+
+    def test_merge(self):
+        stats = RenderStats()
+        stats.record("foo", 1, 1, 0.001)
+        buckets = [0] * (len(RENDER_TIME_BUCKETS) + 1)
+        buckets[0] = 3
+        stats.merge([RenderStat(id="foo", zoom=1, layer="", num_rendered=3,
+                                time_rendered=0.003, buckets=buckets)])
+        [stat] = stats.take()
+        self.assertEqual(stat.num_rendered, 4)
+        self.assertEqual(stat.buckets[0], 4)
+        self.assertAlmostEqual(stat.time_rendered, 0.004)
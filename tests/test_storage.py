@@ -1,5 +1,308 @@
-from unittest import TestCase
+import asyncio
+import hashlib
+import json
+from contextlib import asynccontextmanager, contextmanager
+from unittest import TestCase, mock
+
+from tilekiln.storage import (SAVE_BATCH_SIZE, AsyncStorage, Storage, compress_tile,
+                              coordinates_by_zoom, decompress_tile)
+from tilekiln.tile import Metatile, Tile
+
+
+class FakeCopy:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def set_types(self, types):
+        pass
+
+    def write_row(self, row):
+        self.rows.append(row)
+
+
+class FakeCursor:
+    '''A cursor for a deduplicated tileset, which records the statements run on it
+
+    The tileset foo has zooms 0 to 2. Blobs are missing the first time they are locked,
+    as if deleted by another transaction, and the tiles written or deleted replace a tile
+    with the blob b'old'. The rows of each copy and the commits are recorded on the pool.
+    '''
+    def __init__(self, pool):
+        self.pool = pool
+        self.result = []
+        self.rowcount = 0
+        self.locked = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        sql = " ".join(sql.split())
+        self.pool.statements.append(sql)
+        self.pool.params.append(params)
+        self.result = []
+        if sql.startswith("SELECT id, minzoom"):
+            self.result = [{"id": "foo", "minzoom": 0, "maxzoom": 2, "tilejson": {},
+                            "cache_control": {}, "deduplicate": True}]
+        elif sql.startswith("SELECT deduplicate"):
+            self.result = [(True,)]
+        elif sql.endswith("FOR KEY SHARE"):
+            self.result = [(hash,) for hash in params[0]] if self.locked else []
+            self.locked = True
+        elif sql.startswith(("SELECT hash FROM", "SELECT DISTINCT t.hash")) \
+                or sql.endswith(("RETURNING t.hash", "RETURNING hash")):
+            self.result = [(b'old',)]
+        self.rowcount = len(self.result)
+
+    @contextmanager
+    def copy(self, sql):
+        self.pool.statements.append(" ".join(sql.split()))
+        self.pool.params.append(None)
+        self.pool.copies.append([])
+        yield FakeCopy(self.pool.copies[-1])
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def cursor(self, **kwargs):
+        return FakeCursor(self.pool)
+
+    def commit(self):
+        self.pool.commits += 1
+
+
+class FakePool:
+    def __init__(self):
+        self.statements = []
+        self.params = []
+        self.copies = []
+        self.commits = 0
+
+    @contextmanager
+    def connection(self):
+        yield FakeConnection(self)
+
+
+class FakeAsyncCursor:
+    '''An async cursor with stored tiles, which records the statements run on it
+
+    The tileset foo is deduplicated and the tileset bar is not. Only the tile 1/0/0
+    is stored.
+    '''
+    def __init__(self, pool):
+        self.pool = pool
+        self.result = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def execute(self, sql, params=None, binary=False):
+        sql = " ".join(sql.split())
+        self.pool.statements.append(sql)
+        self.result = None
+        if sql.startswith("SELECT deduplicate"):
+            self.result = {"foo": (True,), "bar": (False,)}.get(params[0])
+        elif tuple(params) == (1, 0, 0):
+            self.result = (compress_tile(b'tile'), b'hash') if sql.startswith("SELECT tile") \
+                else (b'hash',)
+
+    async def fetchone(self):
+        return self.result
+
+
+class FakeAsyncConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def cursor(self):
+        return FakeAsyncCursor(self.pool)
+
+
+class FakeAsyncPool:
+    def __init__(self):
+        self.statements = []
+
+    @asynccontextmanager
+    async def connection(self):
+        yield FakeAsyncConnection(self)
+
+
+def blob_steps(statements):
+    '''The statements which write, lock or delete tiles and blobs, in order'''
+    steps = []
+    for sql in statements:
+        if sql.startswith('INSERT INTO "tilekiln"."foo_blobs"'):
+            steps.append("insert blob")
+        elif sql.endswith("FOR KEY SHARE"):
+            steps.append("share blob")
+        elif sql.startswith('INSERT INTO "tilekiln"."foo'):
+            steps.append("write tile")
+        elif sql.startswith('DELETE FROM "tilekiln"."foo_z'):
+            steps.append("delete tile")
+        elif sql.endswith("FOR UPDATE"):
+            steps.append("lock blob")
+        elif sql.startswith('DELETE FROM "tilekiln"."foo_blobs"'):
+            steps.append("delete blob")
+    return steps
 
 
 class TestStorage(TestCase):
     maxDiff = None
+
+    def test_coordinates_by_zoom(self):
+        self.assertEqual(coordinates_by_zoom([]), {})
+        self.assertEqual(coordinates_by_zoom([Tile(2, 1, 0), Tile(3, 5, 6), Tile(2, 3, 2)]),
+                         {2: ([1, 3], [0, 2]), 3: ([5], [6])})
+
+    def test_compress_tile(self):
+        for tile in (b'', b'tile data', bytes(range(256)) * 10):
+            self.assertEqual(decompress_tile(compress_tile(tile)), tile)
+        # Empty tiles are stored as no data, and tiles compress the same every time
+        self.assertEqual(compress_tile(b''), b'')
+        self.assertEqual(compress_tile(b'tile data'), compress_tile(b'tile data'))
+
+    def test_blob_locking_order(self):
+        # Writers hold their blobs before writing tiles, writing blobs again if they
+        # were deleted, and deleters lock blobs before checking if they are unused
+        expected = ["insert blob", "share blob", "insert blob", "share blob", "write tile",
+                    "lock blob", "delete blob"]
+        pool = FakePool()
+        Storage(pool).save_tile("foo", Tile(1, 0, 0), b'tile')  # type: ignore[arg-type]
+        self.assertEqual(blob_steps(pool.statements), expected)
+
+        pool = FakePool()
+        Storage(pool).save_tiles("foo", [(Tile(1, 0, 0), b'tile'),  # type: ignore[arg-type]
+                                         (Tile(1, 0, 1), b'tile')])
+        self.assertEqual(blob_steps(pool.statements), expected)
+
+        pool = FakePool()
+        Storage(pool).delete_tiles("foo", [Tile(1, 0, 0)])  # type: ignore[arg-type]
+        self.assertEqual(blob_steps(pool.statements), ["delete tile", "lock blob", "delete blob"])
+        self.assertIn("ORDER BY hash FOR UPDATE", pool.statements[-2])
+
+    def test_save_tiles(self):
+        # Tiles are copied to the staging table and written in batches of SAVE_BATCH_SIZE,
+        # each committed, with a later copy of a tile replacing an earlier one
+        pool = FakePool()
+        tiles = [(Tile(12, x, 0), b'tile') for x in range(SAVE_BATCH_SIZE)]
+        tiles += [(Tile(12, 0, 0), b'new'), (Tile(12, 0, 1), b'tile')]
+        count = Storage(pool).save_tiles("foo", tiles)  # type: ignore[arg-type]
+        self.assertEqual(count, SAVE_BATCH_SIZE + 2)
+        self.assertEqual(pool.commits, 3)
+        self.assertEqual([len(rows) for rows in pool.copies], [SAVE_BATCH_SIZE, 2])
+        self.assertEqual(pool.copies[1], [(12, 0, 0, hashlib.sha256(b'new').digest(),
+                                           compress_tile(b'new')),
+                                          (12, 0, 1, hashlib.sha256(b'tile').digest(),
+                                           compress_tile(b'tile'))])
+        # Identical tiles in a batch are only sent once
+        self.assertEqual(pool.copies[0][0][4], compress_tile(b'tile'))
+        self.assertEqual({row[4] for row in pool.copies[0][1:]}, {None})
+
+        # Each tile of a full batch is notified, rather than the entire zoom
+        notified = next(params[1] for sql, params in zip(pool.statements, pool.params)
+                        if sql.startswith("SELECT pg_notify"))
+        self.assertEqual(len(notified), SAVE_BATCH_SIZE)
+        self.assertEqual(json.loads(notified[1]), {"id": "foo", "zoom": 12, "x": 1, "y": 0})
+
+        # Each batch writes blobs and tiles from the staging table, then empties it
+        steps = []
+        for sql in pool.statements:
+            if sql.startswith('INSERT INTO "tilekiln"."foo_blobs" (hash, tile) SELECT hash, '
+                              'tile FROM "tilekiln_staging" WHERE tile IS NOT NULL ORDER BY'):
+                steps.append("write blobs")
+            elif sql.startswith('INSERT INTO "tilekiln"."foo" (zoom, x, y, hash) '
+                                'SELECT zoom, x, y, hash FROM "tilekiln_staging"'):
+                steps.append("write tiles")
+            elif sql == 'TRUNCATE "tilekiln_staging"':
+                steps.append("empty staging")
+        self.assertEqual(steps, ["write blobs", "write tiles", "empty staging"] * 2)
+
+    def test_get_or_render_pending(self):
+        # Tiles waiting to be saved are found after taking the lock, without rendering
+        pool = FakePool()
+        metatile = Metatile(1, 0, 0, 2)
+        pending = {(0, 0): b'a', (1, 1): b'b'}
+        tiles = Storage(pool).get_or_render_metatile(  # type: ignore[arg-type]
+            "foo", Tile(1, 1, 1), metatile, lambda: self.fail("rendered"),
+            lambda tiles: None, lambda tile: pending.get((tile.x, tile.y)))
+        self.assertEqual(tiles, {(0, 0): (b'a', hashlib.sha256(b'a').digest()),
+                                 (1, 1): (b'b', hashlib.sha256(b'b').digest())})
+        self.assertEqual(len(pool.statements), 1)
+        self.assertIn("pg_advisory_xact_lock", pool.statements[0])
+
+    def test_delete_tiles(self):
+        # Tiles are staged in batches and deleted with one statement per zoom in each batch
+        pool = FakePool()
+        tiles = [Tile(2, 1, 0), Tile(1, 0, 0), Tile(2, 3, 2)]
+        with mock.patch("tilekiln.storage.DELETE_BATCH_SIZE", 2):
+            count = Storage(pool).delete_tiles("foo", tiles)  # type: ignore[arg-type]
+        self.assertEqual(pool.copies, [[(2, 1, 0), (1, 0, 0)], [(2, 3, 2)]])
+        self.assertEqual(count, 3)
+        deletes = [(sql.split()[2], params) for sql, params in zip(pool.statements, pool.params)
+                   if sql.startswith('DELETE FROM "tilekiln"."foo_z')]
+        self.assertEqual(deletes, [('"tilekiln"."foo_z1"', (1,)), ('"tilekiln"."foo_z2"', (2,)),
+                                   ('"tilekiln"."foo_z2"', (2,))])
+        for sql in pool.statements:
+            if sql.startswith('DELETE FROM "tilekiln"."foo_z'):
+                self.assertIn('USING "tilekiln_staging" AS s WHERE s.zoom = %s', sql)
+        self.assertEqual(pool.statements.count('TRUNCATE "tilekiln_staging"'), 2)
+
+    def test_delete_bbox(self):
+        # Each zoom of the tileset is deleted with one statement on the x and y ranges
+        pool = FakePool()
+        count = Storage(pool).delete_bbox("foo", None,  # type: ignore[arg-type]
+                                          [-170, 10, -10, 80])
+        self.assertEqual(count, 3)
+        deletes = [(sql.split()[2], params) for sql, params in zip(pool.statements, pool.params)
+                   if sql.startswith('DELETE FROM "tilekiln"."foo_z')]
+        self.assertEqual(deletes, [('"tilekiln"."foo_z0"', (0, 0, 0, 0)),
+                                   ('"tilekiln"."foo_z1"', (0, 0, 0, 0)),
+                                   ('"tilekiln"."foo_z2"', (0, 1, 0, 1))])
+
+        # Zooms outside the tileset are skipped
+        pool = FakePool()
+        Storage(pool).delete_bbox("foo", [5, 1], [-170, 10, -10, 80])  # type: ignore[arg-type]
+        self.assertEqual([sql.split()[2] for sql in pool.statements
+                          if sql.startswith('DELETE FROM "tilekiln"."foo_z')],
+                         ['"tilekiln"."foo_z1"'])
+
+    def test_async_get_tile(self):
+        pool = FakeAsyncPool()
+        storage = AsyncStorage(pool)  # type: ignore[arg-type]
+        self.assertEqual(asyncio.run(storage.get_tile("foo", Tile(1, 0, 0))), b'tile')
+        self.assertIsNone(asyncio.run(storage.get_tile("foo", Tile(1, 0, 1))))
+        # Deduplicated tiles are read from the blobs, looking up the tileset once
+        self.assertEqual(len([sql for sql in pool.statements
+                              if sql.startswith("SELECT deduplicate")]), 1)
+        self.assertIn('FROM "tilekiln"."foo" JOIN "tilekiln"."foo_blobs" USING (hash)',
+                      pool.statements[-1])
+
+        self.assertEqual(asyncio.run(storage.get_tile("bar", Tile(1, 0, 0))), b'tile')
+        self.assertIn('FROM "tilekiln"."bar" WHERE', pool.statements[-1])
+
+        with self.assertRaises(KeyError):
+            asyncio.run(storage.get_tile("baz", Tile(1, 0, 0)))
+
+    def test_async_get_tile_hash(self):
+        pool = FakeAsyncPool()
+        storage = AsyncStorage(pool)  # type: ignore[arg-type]
+        self.assertEqual(asyncio.run(storage.get_tile_hash("foo", Tile(1, 0, 0))), b'hash')
+        self.assertIsNone(asyncio.run(storage.get_tile_hash("foo", Tile(1, 0, 1))))
+        # The hash is read without the tile, so without looking at blobs
+        self.assertEqual(len(pool.statements), 2)
+        for sql in pool.statements:
+            self.assertTrue(sql.startswith('SELECT hash FROM "tilekiln"."foo" WHERE'))
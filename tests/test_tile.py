@@ -1,6 +1,6 @@
 from unittest import TestCase
 
-from tilekiln.tile import Tile
+from tilekiln.tile import Metatile, Tile, lonlat_to_xy, metatiles_in_bbox, tiles_in_bbox
 
 
 class TestConfig(TestCase):
@@ -14,3 +14,39 @@ class TestConfig(TestCase):
         t = Tile(3, 2, 1)
         self.assertEqual(t.bbox(0), 'ST_TileEnvelope(3, 2, 1, margin=>0)')
         self.assertEqual(t.bbox(8/4096), 'ST_TileEnvelope(3, 2, 1, margin=>0.001953125)')
+
+    def test_lonlat_to_xy(self):
+        self.assertEqual(lonlat_to_xy(0, 0, 0), (0, 0))
+        self.assertEqual(lonlat_to_xy(-180, 85.06, 1), (0, 0))
+        self.assertEqual(lonlat_to_xy(180, -85.06, 1), (1, 1))
+        self.assertEqual(lonlat_to_xy(-123.1, 49.3, 10), (161, 350))
+        # Points outside of web mercator are clamped
+        self.assertEqual(lonlat_to_xy(-200, 90, 2), (0, 0))
+        self.assertEqual(lonlat_to_xy(200, -90, 2), (3, 3))
+
+    def test_tiles_in_bbox(self):
+        tiles = [(t.zoom, t.x, t.y) for t in tiles_in_bbox([-180, -85.06, 180, 85.06], 0, 1)]
+        self.assertEqual(tiles, [(0, 0, 0), (1, 0, 0), (1, 0, 1), (1, 1, 0), (1, 1, 1)])
+
+        tiles = [(t.zoom, t.x, t.y) for t in tiles_in_bbox([1, 1, 2, 2], 2, 3)]
+        self.assertEqual(tiles, [(2, 2, 1), (3, 4, 3)])
+
+    def test_metatile(self):
+        m = Metatile.from_tile(Tile(4, 13, 6), 8)
+        self.assertEqual((m.zoom, m.x, m.y, m.size), (4, 8, 0, 8))
+        self.assertEqual((m.max_x, m.max_y), (15, 7))
+        self.assertEqual(len(list(m.tiles())), 64)
+
+        # Metatiles are limited to the size of the world
+        m = Metatile.from_tile(Tile(1, 1, 0), 8)
+        self.assertEqual((m.zoom, m.x, m.y, m.size), (1, 0, 0, 2))
+        self.assertEqual([(t.x, t.y) for t in m.tiles()], [(0, 0), (0, 1), (1, 0), (1, 1)])
+
+    def test_metatiles_in_bbox(self):
+        metatiles = [(m.zoom, m.x, m.y, m.size)
+                     for m in metatiles_in_bbox([-180, -85.06, 180, 85.06], 0, 2, 2)]
+        self.assertEqual(metatiles, [(0, 0, 0, 1), (1, 0, 0, 2),
+                                     (2, 0, 0, 2), (2, 0, 2, 2), (2, 2, 0, 2), (2, 2, 2, 2)])
+
+        metatiles = [(m.zoom, m.x, m.y, m.size) for m in metatiles_in_bbox([1, 1, 2, 2], 3, 3, 4)]
+        self.assertEqual(metatiles, [(3, 4, 0, 4)])
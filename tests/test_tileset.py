@@ -0,0 +1,28 @@
+import json
+from unittest import TestCase
+
+from tilekiln.tileset import Tileset
+
+
+class TestTileset(TestCase):
+    def test_cache_control(self):
+        tileset = Tileset(None, "foo", 0, 14, "{}")  # type: ignore[arg-type]
+        self.assertIsNone(tileset.get_cache_control(3))
+
+        tileset = Tileset(None, "foo", 0, 14, "{}",  # type: ignore[arg-type]
+                          {2: "max-age=3600", 10: "max-age=60"})
+        self.assertIsNone(tileset.get_cache_control(1))
+        self.assertEqual(tileset.get_cache_control(2), "max-age=3600")
+        self.assertEqual(tileset.get_cache_control(9), "max-age=3600")
+        self.assertEqual(tileset.get_cache_control(14), "max-age=60")
+
+    def test_tilejson(self):
+        tileset = Tileset(None, "foo", 0, 14,  # type: ignore[arg-type]
+                          '{"name": "foo", "tiles": ["REPLACED_BY_SERVER"]}')
+        tilejson = tileset.get_tilejson("http://example.com/foo")
+        self.assertEqual(json.loads(tilejson),
+                         {"name": "foo", "tiles": ["http://example.com/foo/{z}/{x}/{y}.mvt"]})
+        # The TileJSON is only computed once for a URL
+        self.assertIs(tileset.get_tilejson("http://example.com/foo"), tilejson)
+        self.assertEqual(json.loads(tileset.get_tilejson("/foo"))["tiles"],
+                         ["/foo/{z}/{x}/{y}.mvt"])
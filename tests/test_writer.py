@@ -0,0 +1,52 @@
+import threading
+from unittest import TestCase
+
+from tilekiln.tile import Tile
+from tilekiln.writer import DROP, TileWriter
+
+
+class FakeStorage:
+    def __init__(self):
+        self.saved: list[tuple[str, list]] = []
+        # Held to stop the writer thread from saving
+        self.lock = threading.Lock()
+
+    def save_tiles(self, id, tiles):
+        with self.lock:
+            tiles = list(tiles)
+            self.saved.append((id, tiles))
+            return len(tiles)
+
+
+class TestWriter(TestCase):
+    def test_save(self):
+        storage = FakeStorage()
+        writer = TileWriter(storage, 10)  # type: ignore[arg-type]
+        with storage.lock:
+            self.assertTrue(writer.put("foo", [(Tile(1, 0, 0), b'abc')]))
+            writer.put("bar", [(Tile(1, 0, 0), b'def'), (Tile(1, 0, 1), b'ghi')])
+            self.assertEqual(writer.get_pending("bar", Tile(1, 0, 1)), b'ghi')
+            self.assertIsNone(writer.get_pending("foo", Tile(1, 0, 1)))
+        writer.close()
+
+        self.assertIsNone(writer.get_pending("bar", Tile(1, 0, 1)))
+        self.assertEqual(writer.written, 3)
+        self.assertEqual(writer.depth, 0)
+        saved = {(id, tile.zoom, tile.x, tile.y): data
+                 for id, tiles in storage.saved for tile, data in tiles}
+        self.assertEqual(saved, {("foo", 1, 0, 0): b'abc',
+                                 ("bar", 1, 0, 0): b'def',
+                                 ("bar", 1, 0, 1): b'ghi'})
+
+    def test_drop(self):
+        storage = FakeStorage()
+        writer = TileWriter(storage, 1, DROP)  # type: ignore[arg-type]
+        with storage.lock:
+            writer.put("foo", [(Tile(1, 0, 0), b'abc')])
+            # The writer thread may have taken the first tile off the queue, so
+            # fill it until something is dropped
+            tiles = [(Tile(2, x, 0), b'abc') for x in range(3)]
+            self.assertFalse(writer.put("foo", tiles))
+            self.assertGreater(writer.dropped, 0)
+        writer.close()
+        self.assertEqual(writer.written + writer.dropped, 4)
@@ -0,0 +1,164 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import click
+import psycopg
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+from tilekiln.storage import NOTIFY_CHANNEL
+from tilekiln.tile import Tile
+
+# Seconds to wait before reconnecting if listening for invalidations fails
+LISTEN_RETRY_DELAY = 5
+
+CacheKey = tuple[str, int, int, int]
+
+
+class TileCache:
+    '''
+    An in-memory LRU cache of tiles, limited to a total size in bytes
+
+    Tiles are cached for a TTL that can be set per zoom, and a TTL of 0 means tiles
+    at that zoom are not cached. This is safe to use from multiple threads.
+
+    The cache has a generation which changes on each invalidation. Reading
+    the generation before fetching a tile and passing it to put stops a tile that
+    was changed during the fetch from being cached.
+    '''
+    def __init__(self, max_bytes: int, ttl: float, zoom_ttls: dict[int, float] | None = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.zoom_ttls = zoom_ttls or {}
+
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+        self.__size = 0
+        # Tile data, its hash, and when it expires, from least to most recently used
+        self.__tiles: OrderedDict[CacheKey, tuple[bytes, bytes | None, float]] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        '''The total size of cached tiles, in bytes'''
+        return self.__size
+
+    def __len__(self) -> int:
+        return len(self.__tiles)
+
+    def get(self, id: str, tile: Tile) -> tuple[bytes, bytes | None] | None:
+        '''Returns a cached tile and its hash, or None if it is not cached'''
+        key = (id, tile.zoom, tile.x, tile.y)
+        with self.__lock:
+            entry = self.__tiles.get(key)
+            if entry is None or entry[2] < time.monotonic():
+                if entry is not None:
+                    self.__remove(key)
+                self.misses += 1
+                return None
+            self.__tiles.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, id: str, tile: Tile, data: bytes, hash: bytes | None = None,
+            generation: int | None = None) -> None:
+        '''Cache a tile and the hash of its content
+
+        If generation is given and there has been an invalidation since, the tile
+        might be out of date and is not cached.
+        '''
+        ttl = self.zoom_ttls.get(tile.zoom, self.ttl)
+        if ttl <= 0 or len(data) > self.max_bytes:
+            return
+
+        key = (id, tile.zoom, tile.x, tile.y)
+        with self.__lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self.__tiles:
+                self.__remove(key)
+            self.__tiles[key] = (data, hash, time.monotonic() + ttl)
+            self.__size += len(data)
+            while self.__size > self.max_bytes:
+                self.__remove(next(iter(self.__tiles)))
+
+    def invalidate(self, id: str, zoom: int | None = None,
+                   x: int | None = None, y: int | None = None) -> None:
+        '''Remove a tile from the cache, or every tile at a zoom or in a tileset'''
+        with self.__lock:
+            self.generation += 1
+            if x is not None and y is not None and zoom is not None:
+                if (id, zoom, x, y) in self.__tiles:
+                    self.__remove((id, zoom, x, y))
+                return
+            for key in [key for key in self.__tiles
+                        if key[0] == id and (zoom is None or key[1] == zoom)]:
+                self.__remove(key)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.generation += 1
+            self.__tiles.clear()
+            self.__size = 0
+
+    def handle_notification(self, payload: str) -> None:
+        '''Invalidate the tiles described by a notification from Storage'''
+        message = json.loads(payload)
+        self.invalidate(message["id"], message.get("zoom"), message.get("x"), message.get("y"))
+
+    def __remove(self, key: CacheKey) -> None:
+        data, _, _ = self.__tiles.pop(key)
+        self.__size -= len(data)
+
+
+class CacheCollector(Collector):
+    '''Prometheus metrics for a TileCache'''
+    def __init__(self, cache: TileCache):
+        self.__cache = cache
+        super().__init__()
+
+    def collect(self):
+        hits = CounterMetricFamily('tilekiln_cache_hits', 'Tiles found in the cache')
+        hits.add_metric([], self.__cache.hits)
+        yield hits
+        misses = CounterMetricFamily('tilekiln_cache_misses', 'Tiles not found in the cache')
+        misses.add_metric([], self.__cache.misses)
+        yield misses
+        size = GaugeMetricFamily('tilekiln_cache_bytes', 'Size of the tiles in the cache')
+        size.add_metric([], self.__cache.size)
+        yield size
+        max_size = GaugeMetricFamily('tilekiln_cache_max_bytes',
+                                     'Largest size of the tiles in the cache')
+        max_size.add_metric([], self.__cache.max_bytes)
+        yield max_size
+        entries = GaugeMetricFamily('tilekiln_cache_entries', 'Tiles in the cache')
+        entries.add_metric([], len(self.__cache))
+        yield entries
+
+
+def listen_for_invalidations(cache: TileCache, connect_args: dict) -> threading.Thread:
+    '''Start a thread which invalidates tiles in the cache when Storage changes them
+
+    If the connection is lost, notifications could have been missed, so the
+    cache is cleared before listening again.
+    '''
+    def listen():
+        while True:
+            try:
+                with psycopg.connect(**connect_args, autocommit=True) as conn:
+                    conn.execute(f'''LISTEN "{NOTIFY_CHANNEL}"''')
+                    cache.clear()
+                    for notify in conn.notifies():
+                        cache.handle_notification(notify.payload)
+            except Exception as e:
+                click.echo(f"Listening for tile cache invalidations failed: {e}", err=True)
+            cache.clear()
+            time.sleep(LISTEN_RETRY_DELAY)
+
+    thread = threading.Thread(target=listen, daemon=True, name="tilekiln-cache-invalidation")
+    thread.start()
+    return thread
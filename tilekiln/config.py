@@ -2,7 +2,7 @@ import json
 import yaml
 
 from tilekiln.definition import Definition
-from tilekiln.tile import Tile
+from tilekiln.tile import Metatile, Tile
 
 
 class Config:
@@ -20,6 +20,13 @@ class Config:
         self.bounds = config["metadata"].get("bounds")
         self.center = config["metadata"].get("center")
 
+        # Cache-Control headers for tiles, by the zoom they start applying at. A string
+        # applies to all zooms.
+        cache_control = config["metadata"].get("cache_control", {})
+        if isinstance(cache_control, str):
+            cache_control = {0: cache_control}
+        self.cache_control = {int(zoom): value for zoom, value in cache_control.items()}
+
         # TODO: Make private and expose needed operations through proper functions
         self.layers = []
         for id, l in config.get("vector_layers", {}).items():
@@ -31,6 +38,17 @@ class Config:
             self.minzoom = min([layer.minzoom for layer in self.layers])
             self.maxzoom = max([layer.maxzoom for layer in self.layers])
 
+        # The definitions to render at each zoom, in layer order
+        self.__zoom_definitions: dict[int, list[Definition]] = {}
+        if self.minzoom is not None and self.maxzoom is not None:
+            for zoom in range(self.minzoom, self.maxzoom + 1):
+                self.__zoom_definitions[zoom] = [d for d in (layer.definition(zoom)
+                                                             for layer in self.layers)
+                                                 if d is not None]
+        # Prepared statement SQL only depends on zoom, so it is only rendered once
+        self.__prepared_queries: dict[int, list[str | None]] = {}
+        self.__prepared_metatile_queries: dict[int, list[str | None]] = {}
+
     def tilejson(self, url) -> str:
         '''Returns a TileJSON'''
 
@@ -56,9 +74,46 @@ class Config:
         return json.dumps({k: v for k, v in result.items() if v is not None},
                           sort_keys=True, indent=4)
 
+    def layer_ids(self, zoom: int) -> list[str]:
+        '''Returns the IDs of the layers at a zoom, in the same order as their queries'''
+        return [d.id for d in self.__zoom_definitions.get(zoom, [])]
+
     def layer_queries(self, tile: Tile):
-        return {layer.render_sql(tile) for layer in self.layers
-                if layer.render_sql(tile) is not None}
+        return [d.render_sql(tile) for d in self.__zoom_definitions.get(tile.zoom, [])]
+
+    def metatile_layer_queries(self, metatile: Metatile):
+        '''Returns the SQL for each layer for all tiles in a metatile
+
+        Layers which use x or y in template logic can't be rendered for metatiles, and
+        are None, so they need rendering for each tile instead.
+        '''
+        return [d.render_metatile_sql(metatile) if d.sql_coordinates else None
+                for d in self.__zoom_definitions.get(metatile.zoom, [])]
+
+    def prepared_layer_queries(self, zoom: int):
+        '''Returns the SQL for each layer at a zoom, taking x and y as parameters $1 and $2
+
+        Layers which use x or y in template logic can't be prepared, and are None.
+        '''
+        queries = self.__prepared_queries.get(zoom)
+        if queries is None:
+            queries = [d.render_prepared_sql(zoom) if d.sql_coordinates else None
+                       for d in self.__zoom_definitions.get(zoom, [])]
+            self.__prepared_queries[zoom] = queries
+        return queries
+
+    def prepared_metatile_layer_queries(self, zoom: int):
+        '''Returns the SQL for each layer at a zoom for metatiles, taking the minimum x,
+           maximum x, minimum y, and maximum y as parameters $1 to $4
+
+        Layers which use x or y in template logic are None, as for metatile_layer_queries.
+        '''
+        queries = self.__prepared_metatile_queries.get(zoom)
+        if queries is None:
+            queries = [d.render_prepared_metatile_sql(zoom) if d.sql_coordinates else None
+                       for d in self.__zoom_definitions.get(zoom, [])]
+            self.__prepared_metatile_queries[zoom] = queries
+        return queries
 
 
 class LayerConfig:
@@ -73,22 +128,28 @@ class LayerConfig:
         self.definitions = []
         self.geometry_type = set(layer_yaml.get("geometry_type", []))
 
-        self.__definitions = set()
+        self.__definitions = []
         for definition in layer_yaml.get("sql", []):
-            self.__definitions.add(Definition(id, definition, filesystem))
+            self.__definitions.append(Definition(id, definition, filesystem))
 
         self.minzoom = min({d.minzoom for d in self.__definitions})
         self.maxzoom = max({d.maxzoom for d in self.__definitions})
 
+        # Look up the definition by zoom instead of searching each time
+        self.__zoom_definitions: dict[int, Definition] = {}
+        for d in self.__definitions:
+            for zoom in range(d.minzoom, d.maxzoom + 1):
+                self.__zoom_definitions.setdefault(zoom, d)
+
+    def definition(self, zoom) -> Definition | None:
+        '''Returns the definition for a zoom, or None if it is outside the zoom range of the
+           definitions
+        '''
+        return self.__zoom_definitions.get(zoom)
+
     def render_sql(self, tile):
         '''Returns the SQL for a layer, given a tile, or None if it is outside the zoom range
            of the definitions
         '''
-        if tile.zoom > self.maxzoom or tile.zoom < self.minzoom:
-            return None
-
-        for d in self.__definitions:
-            if tile.zoom <= d.maxzoom and tile.zoom >= d.minzoom:
-                return d.render_sql(tile)
-
-        return None
+        d = self.definition(tile.zoom)
+        return None if d is None else d.render_sql(tile)
@@ -1,4 +1,7 @@
+import re
+
 import jinja2 as j2
+import jinja2.nodes
 
 
 DEFAULT_EXTENT = 4096
@@ -9,6 +12,13 @@ HALF_WORLD = 20037508.34
 
 j2Environment = j2.Environment(loader=j2.BaseLoader())
 
+# Template variables which change between tiles of the same zoom
+TILE_VARIABLES = ("x", "y", "bbox", "unbuffered_bbox")
+# Placeholders for tile variables when rendering a template for a zoom. SQL
+# can't contain NUL characters, so these can't clash with anything in a template.
+TILE_PLACEHOLDERS = {name: f"\0{name}\0" for name in TILE_VARIABLES}
+TILE_PLACEHOLDER_RE = re.compile("\0(" + "|".join(TILE_VARIABLES) + ")\0")
+
 
 class Definition:
     def __init__(self, id, definition_yaml, filesystem):
@@ -19,7 +29,19 @@ class Definition:
         self.buffer = definition_yaml.get("buffer", DEFAULT_BUFFER)
 
         # TODO: Let is use directories so one file can include others.
-        self.__template = j2Environment.from_string(filesystem.readtext(definition_yaml["file"]))
+        source = filesystem.readtext(definition_yaml["file"])
+        self.__template = j2Environment.from_string(source)
+
+        # If tile variables are only directly substituted into the output, the template
+        # can be rendered once per zoom and the tile variables substituted in afterwards
+        parsed = j2Environment.parse(source)
+        self.__substitutable = substitutable(parsed)
+        # If x and y can be SQL expressions, as they are in prepared statements and
+        # metatiles. This isn't possible if the template uses them in logic.
+        self.sql_coordinates = substitutable(parsed, ("x", "y"))
+        # Rendered template split into fragments for each zoom. Even fragments are SQL,
+        # odd fragments are the name of a tile variable.
+        self.__fragments: dict[int, list[str]] = {}
 
     def render_sql(self, tile):
         '''Generate the SQL for a layer
@@ -29,25 +51,121 @@ class Definition:
         assert tile.zoom >= self.minzoom
         assert tile.zoom <= self.maxzoom
 
+        return self.__render_tile_sql(tile.zoom, tile.x, tile.y)
+
+    def render_prepared_sql(self, zoom):
+        '''Generate the SQL for a layer at a zoom, with x and y as the parameters $1 and $2
+
+        The SQL is suitable for a prepared statement that can be used for any tile
+        at the zoom.
+        '''
+        assert zoom >= self.minzoom
+        assert zoom <= self.maxzoom
+        self.__check_sql_coordinates("prepared statements")
+
+        return self.__render_tile_sql(zoom, "$1", "$2")
+
+    def render_metatile_sql(self, metatile):
+        '''Generate the SQL for a layer for every tile in a metatile
+
+        The template is joined laterally against each tile of the metatile, with
+        x and y being SQL columns instead of numbers. The result has a row of x, y,
+        and the MVT for each tile with features.
+
+        This saves planning and round trips, but the template still runs once for each
+        tile, with its own index scans. Templates use the tile bbox both to find
+        features and in ST_AsMVTGeom, so they can't be run once for the whole metatile.
+        '''
+        assert metatile.zoom >= self.minzoom
+        assert metatile.zoom <= self.maxzoom
+        self.__check_sql_coordinates("metatiles")
+
+        return self.__render_metatile_sql(metatile.zoom, metatile.x, metatile.max_x,
+                                          metatile.y, metatile.max_y)
+
+    def render_prepared_metatile_sql(self, zoom):
+        '''Generate the SQL for a layer for metatiles at a zoom, with the minimum x, maximum x,
+           minimum y, and maximum y of the metatile as the parameters $1 to $4
+        '''
+        assert zoom >= self.minzoom
+        assert zoom <= self.maxzoom
+        self.__check_sql_coordinates("metatiles")
+
+        return self.__render_metatile_sql(zoom, "$1", "$2", "$3", "$4")
+
+    def __check_sql_coordinates(self, use):
+        if not self.sql_coordinates:
+            raise ValueError(f"Layer {self.id} uses x or y in template logic, so it can't be "
+                             f"rendered for {use}")
+
+    def __render_tile_sql(self, zoom, x, y):
         # See https://postgis.net/docs/ST_AsMVT.html for SQL source
 
-        inner = self.__template.render(zoom=tile.zoom, x=tile.x, y=tile.y,
-                                       bbox=tile.bbox(self.buffer/self.extent),
-                                       unbuffered_bbox=tile.bbox(0),
-                                       extent=self.extent, buffer=self.buffer,
-                                       tile_length=tile_length(tile),
-                                       tile_area=tile_length(tile)**2,
-                                       coordinate_length=tile_length(tile)/self.extent,
-                                       coordinate_area=(tile_length(tile)/self.extent)**2)
+        inner = self.__render_template(zoom, x, y,
+                                       envelope(zoom, x, y, self.buffer/self.extent),
+                                       envelope(zoom, x, y, 0))
 
         # TODO: Use proper escaping for self.id in SQL
         return ('''WITH mvtgeom AS\n(\n''' + inner + '''\n)\n''' +
                 f'''SELECT ST_AsMVT(mvtgeom.*, '{self.id}', {self.extent}, 'way', NULL)\n''' +
                 '''FROM mvtgeom;''')
 
+    def __render_metatile_sql(self, zoom, min_x, max_x, min_y, max_y):
+        x = "metatile.x"
+        y = "metatile.y"
+        inner = self.__render_template(zoom, x, y,
+                                       envelope(zoom, x, y, self.buffer/self.extent),
+                                       envelope(zoom, x, y, 0))
+
+        return ('''WITH metatile AS\n(\n''' +
+                f'''SELECT x, y FROM generate_series({min_x}, {max_x}) AS x\n''' +
+                f'''CROSS JOIN generate_series({min_y}, {max_y}) AS y\n)\n''' +
+                '''SELECT metatile.x, metatile.y, ''' +
+                f'''ST_AsMVT(mvtgeom.*, '{self.id}', {self.extent}, 'way', NULL)\n''' +
+                '''FROM metatile CROSS JOIN LATERAL\n(\n''' + inner + '''\n) AS mvtgeom\n''' +
+                '''GROUP BY metatile.x, metatile.y;''')
+
+    def __render_template(self, zoom, x, y, bbox, unbuffered_bbox):
+        if not self.__substitutable:
+            return self.__template.render(x=x, y=y, bbox=bbox, unbuffered_bbox=unbuffered_bbox,
+                                          **self.__zoom_variables(zoom))
+
+        fragments = self.__fragments.get(zoom)
+        if fragments is None:
+            fragments = TILE_PLACEHOLDER_RE.split(
+                self.__template.render(**TILE_PLACEHOLDERS, **self.__zoom_variables(zoom)))
+            self.__fragments[zoom] = fragments
+
+        values = {"x": str(x), "y": str(y), "bbox": bbox, "unbuffered_bbox": unbuffered_bbox}
+        return "".join([values[fragment] if i % 2 else fragment
+                        for i, fragment in enumerate(fragments)])
+
+    def __zoom_variables(self, zoom):
+        '''Returns the template variables which only depend on zoom'''
+        length = HALF_WORLD/(2**(zoom-1))
+        return {"zoom": zoom,
+                "extent": self.extent,
+                "buffer": self.buffer,
+                "tile_length": length,
+                "tile_area": length**2,
+                "coordinate_length": length/self.extent,
+                "coordinate_area": (length/self.extent)**2}
+
+
+def substitutable(template: jinja2.nodes.Template,
+                  variables: tuple[str, ...] = TILE_VARIABLES) -> bool:
+    '''Returns if every use of the tile variables in a template is a direct substitution
+       like {{ x }}, rather than being used in an expression, filter, or statement.
+    '''
+    uses = [node for node in template.find_all(jinja2.nodes.Name)
+            if node.name in variables]
+    substitutions = [node for output in template.find_all(jinja2.nodes.Output)
+                     for node in output.nodes
+                     if isinstance(node, jinja2.nodes.Name) and node.name in variables]
+    return len(uses) == len(substitutions)
+
 
-def tile_length(tile):
-    '''Returns the length of a tile, in projected units
+def envelope(zoom, x, y, buffer):
+    '''Returns the SQL for the bounding box of a tile, where x and y can be SQL expressions
     '''
-    # -1 for half vs full world
-    return HALF_WORLD/(2**(tile.zoom-1))
+    return f'''ST_TileEnvelope({zoom}, {x}, {y}, margin=>{buffer})'''
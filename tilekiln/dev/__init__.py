@@ -1,4 +1,6 @@
 import os
+import re
+import time
 
 import psycopg
 from fastapi import FastAPI, Response, HTTPException
@@ -6,7 +8,7 @@ from fastapi.responses import RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 import tilekiln
-from tilekiln.kiln import Kiln
+from tilekiln.kiln import Kiln, KilnPool, KilnPoolFull, LayerProfile
 from tilekiln.config import Config
 from tilekiln.tile import Tile
 
@@ -15,17 +17,28 @@ from tilekiln.tile import Tile
 TILEKILN_CONFIG = "TILEKILN_CONFIG"
 TILEKILN_URL = "TILEKILN_URL"
 TILEKILN_ID = "TILEKILN_ID"
+TILEKILN_LAYER_CONCURRENCY = "TILEKILN_LAYER_CONCURRENCY"
+TILEKILN_PREPARED = "TILEKILN_PREPARED"
+TILEKILN_RENDER_POOL_SIZE = "TILEKILN_RENDER_POOL_SIZE"
+TILEKILN_RENDER_QUEUE_SIZE = "TILEKILN_RENDER_QUEUE_SIZE"
 
 STANDARD_HEADERS = {"Cache-Control": "no-cache"}
+# Seconds a client is asked to wait before retrying when renders are turned away
+RETRY_AFTER = 1
 
-kiln: Kiln
+# Characters not allowed in a Server-Timing metric name, which are also replaced in the
+# layer names in X-Tilekiln-Layers
+NON_TOKEN_RE = re.compile(r"[^!#$%&'*+\-.^_`|~0-9A-Za-z]")
+
+kilns: KilnPool
 config: Config
 
 dev = FastAPI()
 dev.add_middleware(CORSMiddleware,
                    allow_origins=["*"],
                    allow_methods=["*"],
-                   allow_headers=["*"])
+                   allow_headers=["*"],
+                   expose_headers=["Server-Timing", "X-Tilekiln-Layers"])
 
 
 @dev.on_event("startup")
@@ -36,10 +49,18 @@ def load_config():
     # Because the DB connection variables are passed as standard PG* vars,
     # a plain connect() will connect to the right DB
 
-    conn = psycopg.connect()
+    kiln_list = []
+    for _ in range(int(os.environ.get(TILEKILN_RENDER_POOL_SIZE, 1))):
+        conns = [psycopg.connect()
+                 for _ in range(int(os.environ.get(TILEKILN_LAYER_CONCURRENCY, 1)))]
+        kiln_list.append(Kiln(config, conns[0], conns[1:],
+                              prepared=TILEKILN_PREPARED in os.environ))
 
-    global kiln
-    kiln = Kiln(config, conn)
+    max_waiting = None
+    if TILEKILN_RENDER_QUEUE_SIZE in os.environ:
+        max_waiting = int(os.environ[TILEKILN_RENDER_QUEUE_SIZE])
+    global kilns
+    kilns = KilnPool(kiln_list, max_waiting)
 
 
 @dev.head("/")
@@ -78,7 +99,34 @@ def serve_tile(prefix: str, zoom: int, x: int, y:  int):
     global config
     if prefix != config.id:
         raise HTTPException(status_code=404, detail=f"Tileset {prefix} not found on server.")
-    global kiln
-    return Response(kiln.render(Tile(zoom, x, y)),
+    global kilns
+    try:
+        with kilns.kiln() as kiln:
+            start = time.perf_counter()
+            tile, layers = kiln.render_profile(Tile(zoom, x, y))
+            seconds = time.perf_counter() - start
+    except KilnPoolFull as e:
+        raise HTTPException(status_code=503, detail=f"Server is busy: {e}",
+                            headers={"Retry-After": str(RETRY_AFTER)})
+    return Response(tile,
                     media_type="application/vnd.mapbox-vector-tile",
-                    headers=STANDARD_HEADERS)
+                    headers=STANDARD_HEADERS | profile_headers(layers, seconds))
+
+
+def profile_headers(layers: list[LayerProfile], seconds: float) -> dict[str, str]:
+    '''Headers with the render time and size of each layer, so they can be seen in a browser
+
+    Server-Timing has the time for each layer, named after the layer ID, with the size in
+    the description. The time for the whole tile is named render. X-Tilekiln-Layers has
+    the sizes of the layers in bytes. Characters which are not allowed in a token are
+    replaced in layer IDs, so they can't break the header values.
+    '''
+    names = [NON_TOKEN_RE.sub("_", layer.id) for layer in layers]
+    timings = [f'{name};dur={layer.seconds * 1000:.1f};desc="{layer.size} bytes"'
+               for name, layer in zip(names, layers)]
+    timings.append(f"render;dur={seconds * 1000:.1f}")
+    return {"Server-Timing": ", ".join(timings),
+            # Allows the timings to be read from pages on other origins
+            "Timing-Allow-Origin": "*",
+            "X-Tilekiln-Layers": ", ".join(f"{name}={layer.size}"
+                                           for name, layer in zip(names, layers))}
@@ -0,0 +1,116 @@
+from collections.abc import Iterable, Iterator
+
+from tilekiln.tile import Tile
+
+
+class ExpiredTiles:
+    '''
+    A set of expired tiles, expanded over a range of zooms
+
+    An expired tile also expires its parent at every lower zoom and all of its
+    children at every higher zoom, limited to minzoom and maxzoom. Expire lists
+    usually have a lot of tiles, so tiles are stored as integers in a set per zoom
+    instead of as Tile objects.
+
+    Only the tiles which are added are stored. Parents are computed per zoom when
+    iterating, and children are generated as needed, so expanding to higher zooms
+    does not take more memory.
+    '''
+    def __init__(self, minzoom: int, maxzoom: int):
+        assert minzoom <= maxzoom
+        self.minzoom = minzoom
+        self.maxzoom = maxzoom
+        # Added tiles by zoom. Tiles above maxzoom are stored as their parent at maxzoom.
+        self.__tiles: dict[int, set[int]] = {}
+        # Computed from the added tiles when first needed
+        self.__roots: dict[int, set[int]] | None = None
+
+    def add(self, tile: Tile) -> None:
+        zoom = min(tile.zoom, self.maxzoom)
+        shift = tile.zoom - zoom
+        self.__tiles.setdefault(zoom, set()).add(pack(zoom, tile.x >> shift, tile.y >> shift))
+        self.__roots = None
+
+    def update(self, tiles: Iterable[Tile]) -> None:
+        for tile in tiles:
+            self.add(tile)
+
+    def zooms(self) -> Iterator[int]:
+        '''Yields the zooms with expired tiles'''
+        if self.__tiles:
+            yield from range(self.minzoom, self.maxzoom + 1)
+
+    def tiles(self, zoom: int) -> Iterator[Tile]:
+        '''Yields the expired tiles at a zoom, without duplicates
+
+        Tiles are in order of x then y, except for tiles which are children of
+        tiles added at a lower zoom, which follow the other tiles.
+        '''
+        roots = self.__get_roots()
+
+        # Tiles added at this zoom or higher expire their parent at this zoom. Roots
+        # don't contain each other, so none of these is a child of a lower zoom root.
+        parents: set[int] = set()
+        for root_zoom, keys in roots.items():
+            if root_zoom >= zoom:
+                shift = root_zoom - zoom
+                parents.update(pack(zoom, x >> shift, y >> shift)
+                               for x, y in (unpack(root_zoom, key) for key in keys))
+        for key in sorted(parents):
+            yield Tile(zoom, *unpack(zoom, key))
+
+        # Tiles added at lower zooms expire all of their children. Children of
+        # different roots are distinct, so this does not need to track what was yielded.
+        for root_zoom in sorted(roots):
+            if root_zoom >= zoom:
+                break
+            shift = zoom - root_zoom
+            for key in sorted(roots[root_zoom]):
+                x, y = unpack(root_zoom, key)
+                for child_x in range(x << shift, (x + 1) << shift):
+                    for child_y in range(y << shift, (y + 1) << shift):
+                        yield Tile(zoom, child_x, child_y)
+
+    def __iter__(self) -> Iterator[Tile]:
+        '''Yields every expired tile, one zoom at a time'''
+        for zoom in self.zooms():
+            yield from self.tiles(zoom)
+
+    def __get_roots(self) -> dict[int, set[int]]:
+        '''Returns the added tiles which are not inside another added tile at a lower zoom'''
+        if self.__roots is not None:
+            return self.__roots
+
+        roots: dict[int, set[int]] = {}
+        for zoom in sorted(self.__tiles):
+            lower = list(roots.items())
+            keys = set()
+            for key in self.__tiles[zoom]:
+                x, y = unpack(zoom, key)
+                if not any(pack(root_zoom, x >> (zoom - root_zoom), y >> (zoom - root_zoom))
+                           in root_keys for root_zoom, root_keys in lower):
+                    keys.add(key)
+            roots[zoom] = keys
+        self.__roots = roots
+        return roots
+
+
+def pack(zoom: int, x: int, y: int) -> int:
+    '''Packs the x and y of a tile at a zoom into one integer'''
+    return (x << zoom) | y
+
+
+def unpack(zoom: int, key: int) -> tuple[int, int]:
+    '''Returns the x and y of a tile packed with pack'''
+    return key >> zoom, key & ((1 << zoom) - 1)
+
+
+def read_expire_list(lines: Iterable[str]) -> Iterator[Tile]:
+    '''Yields the tiles in an osm2pgsql expire list, with one z/x/y tile per line
+
+    Blank lines are skipped.
+    '''
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield Tile.from_string(line)
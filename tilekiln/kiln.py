@@ -1,33 +1,255 @@
+import queue
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import TypeVar
+
 import psycopg
 
 from tilekiln.config import Config
-from tilekiln.tile import Tile
+from tilekiln.stats import RenderStats
+from tilekiln.tile import Metatile, Tile
+
+S = TypeVar("S")
+T = TypeVar("T")
+# SQL, and the arguments for it if it should be run as a prepared statement
+Query = tuple[str, tuple[int, ...] | None]
+# The query for a layer of a metatile, or the query for each tile of a layer which can't
+# be rendered for metatiles
+MetatileQuery = Query | list[tuple[Tile, Query]]
+
+
+@dataclass(frozen=True)
+class LayerProfile:
+    '''How long a layer of a tile took to render, and its size in bytes'''
+    id: str
+    seconds: float
+    size: int
 
 
 class Kiln:
     '''
     The kiln is what actually generates the tiles, using the config to compute SQL,
     and a DB connection to execute it
+
+    If layer_connections are given, the layer queries for a tile are run
+    concurrently over them and the main connection, instead of one after another.
+
+    If prepared is set, the SQL for each layer is rendered once per zoom with x and
+    y as parameters, and prepared on each connection the first time it is used. This
+    avoids planning each query for every tile.
+
+    If stats are given, the time taken by each render and each layer of it is
+    counted in them.
     '''
-    def __init__(self, config: Config, connection: psycopg.Connection):
+    def __init__(self, config: Config, connection: psycopg.Connection,
+                 layer_connections: Sequence[psycopg.Connection] = (), prepared: bool = False,
+                 stats: RenderStats | None = None):
         self.__config = config
-        self.__connection = connection
+        self.__prepared = prepared
+        self.__stats = stats
+
+        # Statement names by SQL, shared between all connections
+        self.__statement_names: dict[str, str] = {}
+        self.__statement_lock = threading.Lock()
+        # Statements which have been prepared on each connection
+        self.__prepared_statements: dict[psycopg.Connection, set[str]] = {}
+
+        # Idle connections, taken by each query while it runs
+        self.__connections: queue.SimpleQueue[psycopg.Connection] = queue.SimpleQueue()
+        for conn in [connection, *layer_connections]:
+            # New connection setup
+            conn.autocommit = True
+            conn.prepare_threshold = None
+            conn.execute('''SET default_transaction_read_only = true;''')
+            self.__prepared_statements[conn] = set()
+            self.__connections.put(conn)
 
-        # New connection setup
-        self.__connection.autocommit = True
-        self.__connection.prepare_threshold = None
-        self.__connection.execute('''SET default_transaction_read_only = true;''')
+        self.__executor = None
+        if layer_connections:
+            self.__executor = ThreadPoolExecutor(max_workers=len(layer_connections) + 1)
 
     def render(self, tile: Tile) -> bytes:
-        with self.__connection.cursor() as curs:
-            result = b''
-            for sql in self.__config.layer_queries(tile):
-                result += self.__render_layer(curs, sql)
+        if self.__stats is not None:
+            return self.render_profile(tile)[0]
+        return b''.join(self.__map(self.__render_layer, self.__tile_queries(tile)))
+
+    def render_profile(self, tile: Tile) -> tuple[bytes, list[LayerProfile]]:
+        '''Render a tile, also returning the time taken and size of each layer'''
+        start = time.perf_counter()
+        layers = self.__map(self.__profile_layer, self.__tile_queries(tile))
+        profiles = [LayerProfile(id, seconds, len(data))
+                    for id, (data, seconds) in zip(self.__config.layer_ids(tile.zoom), layers)]
+        self.__record(tile.zoom, 1, time.perf_counter() - start, profiles)
+        return b''.join(data for data, _ in layers), profiles
+
+    def render_metatile(self, metatile: Metatile) -> list[tuple[Tile, bytes]]:
+        '''Render every tile in a metatile, with one query per layer'''
+        start = time.perf_counter()
+        args = None
+        if self.__prepared:
+            args = (metatile.x, metatile.max_x, metatile.y, metatile.max_y)
+            sqls = self.__config.prepared_metatile_layer_queries(metatile.zoom)
+        else:
+            sqls = self.__config.metatile_layer_queries(metatile)
+
+        queries: list[MetatileQuery] = [(sql, args) for sql in sqls if sql is not None]
+        if None in sqls:
+            # Layers which can't be rendered for metatiles are rendered for each tile
+            tile_sqls = [(tile, self.__config.layer_queries(tile)) for tile in metatile.tiles()]
+            queries = [(sql, args) if sql is not None
+                       else [(tile, (layer_sqls[i], None)) for tile, layer_sqls in tile_sqls]
+                       for i, sql in enumerate(sqls)]
+
+        results = {(tile.x, tile.y): b'' for tile in metatile.tiles()}
+        profiles = []
+        for id, (rows, seconds) in zip(self.__config.layer_ids(metatile.zoom),
+                                       self.__map(self.__profile_query, queries)):
+            # Tiles without any features in the layer have no row
+            for x, y, data in rows:
+                results[(x, y)] += data
+            profiles.append(LayerProfile(id, seconds, sum(len(row[2]) for row in rows)))
+        self.__record(metatile.zoom, len(results), time.perf_counter() - start, profiles)
+
+        return [(Tile(metatile.zoom, x, y), data) for (x, y), data in results.items()]
+
+    def __tile_queries(self, tile: Tile) -> list[Query]:
+        if self.__prepared:
+            args = (tile.x, tile.y)
+            prepared = self.__config.prepared_layer_queries(tile.zoom)
+            if None not in prepared:
+                return [(sql, args) for sql in prepared]
+            # Layers which can't be prepared are rendered for the tile
+            return [(sql, args) if sql is not None else (unprepared, None)
+                    for sql, unprepared in zip(prepared, self.__config.layer_queries(tile))]
+        return [(sql, None) for sql in self.__config.layer_queries(tile)]
+
+    def __map(self, fn: Callable[[S], T], queries: Iterable[S]) -> list[T]:
+        '''Run fn on each query, returning results in the same order as the queries'''
+        if self.__executor is None:
+            return [fn(query) for query in queries]
+        return list(self.__executor.map(fn, queries))
+
+    def __query(self, query: Query) -> list[tuple]:
+        '''Run a query, which is SQL and arguments if it is to be prepared'''
+        sql, args = query
+        conn = self.__connections.get()
+        try:
+            with conn.cursor() as curs:
+                if args is None:
+                    curs.execute(sql, binary=True)
+                else:
+                    name = self.__prepare(conn, sql, len(args))
+                    # EXECUTE can't take bind parameters, but the arguments are all integers
+                    curs.execute(f'''EXECUTE {name}({", ".join(str(a) for a in args)})''',
+                                 binary=True)
+                return curs.fetchall()
+        finally:
+            self.__connections.put(conn)
 
-        return result
+    def __prepare(self, conn: psycopg.Connection, sql: str, num_args: int) -> str:
+        '''Returns the name of a prepared statement for SQL, preparing it on the connection
+           if needed
+        '''
+        with self.__statement_lock:
+            name = self.__statement_names.setdefault(sql,
+                                                     f"tilekiln_{len(self.__statement_names)}")
+        if name not in self.__prepared_statements[conn]:
+            types = ", ".join(["integer"] * num_args)
+            conn.execute(f'''PREPARE {name} ({types}) AS {sql}''')
+            self.__prepared_statements[conn].add(name)
+        return name
 
-    def __render_layer(self, curs: psycopg.Cursor, sql: str) -> bytes:
-        curs.execute(sql, binary=True)
-        for record in curs:
-            return record[0]
+    def __render_layer(self, query: Query) -> bytes:
+        for record in self.__query(query):
+            # A layer without any features is an empty MVT, so the layers of an
+            # empty tile join to b''. Some PostGIS versions give NULL instead.
+            return record[0] or b''
         raise RuntimeError("No rows in tile query result, should never reach here")
+
+    def __profile_layer(self, query: Query) -> tuple[bytes, float]:
+        start = time.perf_counter()
+        data = self.__render_layer(query)
+        return data, time.perf_counter() - start
+
+    def __profile_query(self, query: MetatileQuery) -> tuple[list[tuple], float]:
+        start = time.perf_counter()
+        if isinstance(query, list):
+            rows = [(tile.x, tile.y, self.__render_layer(tile_query))
+                    for tile, tile_query in query]
+        else:
+            rows = self.__query(query)
+        return rows, time.perf_counter() - start
+
+    def __record(self, zoom: int, num_tiles: int, seconds: float,
+                 profiles: list[LayerProfile]) -> None:
+        if self.__stats is not None:
+            self.__stats.record(self.__config.id, zoom, num_tiles, seconds,
+                                [(profile.id, profile.seconds) for profile in profiles])
+
+
+class KilnPoolFull(Exception):
+    '''Raised when a KilnPool has no kiln free and too many renders are waiting for one'''
+
+
+class KilnPool:
+    '''
+    A pool of kilns, each with their own connections, for rendering tiles concurrently
+
+    Each render takes a kiln for as long as it runs. If all are in use, up to
+    max_waiting renders wait for one, and any more raise KilnPoolFull straight
+    away, so a server can turn requests away instead of queuing them until they
+    time out. If max_waiting is None, renders always wait.
+    '''
+    def __init__(self, kilns: Sequence[Kiln], max_waiting: int | None = None):
+        self.size = len(kilns)
+        self.max_waiting = max_waiting
+        self.rejected = 0
+
+        self.__idle: queue.SimpleQueue[Kiln] = queue.SimpleQueue()
+        for kiln in kilns:
+            self.__idle.put(kiln)
+        # Renders which are running or waiting for a kiln
+        self.__renders = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def in_use(self) -> int:
+        '''Number of kilns rendering'''
+        return min(self.__renders, self.size)
+
+    @property
+    def waiting(self) -> int:
+        '''Number of renders waiting for a kiln'''
+        return max(self.__renders - self.size, 0)
+
+    @contextmanager
+    def kiln(self) -> Iterator[Kiln]:
+        '''Take a kiln from the pool, waiting if they are all in use'''
+        with self.__lock:
+            if (self.max_waiting is not None
+                    and self.__renders >= self.size + self.max_waiting):
+                self.rejected += 1
+                raise KilnPoolFull(f"All {self.size} kilns are in use and "
+                                   f"{self.max_waiting} renders are waiting")
+            self.__renders += 1
+        try:
+            kiln = self.__idle.get()
+            try:
+                yield kiln
+            finally:
+                self.__idle.put(kiln)
+        finally:
+            with self.__lock:
+                self.__renders -= 1
+
+    def render(self, tile: Tile) -> bytes:
+        with self.kiln() as kiln:
+            return kiln.render(tile)
+
+    def render_metatile(self, metatile: Metatile) -> list[tuple[Tile, bytes]]:
+        with self.kiln() as kiln:
+            return kiln.render_metatile(metatile)
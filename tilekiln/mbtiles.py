@@ -0,0 +1,78 @@
+import itertools
+import json
+import os
+import sqlite3
+from collections.abc import Iterable
+
+from tilekiln.storage import Storage
+
+# Number of tiles written to an MBTiles file in each transaction
+MBTILES_BATCH_SIZE = 100000
+
+
+def mbtiles_metadata(tilejson: str, minzoom: int, maxzoom: int) -> dict[str, str]:
+    '''Returns the MBTiles metadata for a tileset from its TileJSON'''
+    parsed = json.loads(tilejson)
+    metadata = {"name": parsed.get("name") or parsed.get("id") or "",
+                "format": "pbf",
+                "type": "overlay",
+                "minzoom": str(minzoom),
+                "maxzoom": str(maxzoom),
+                "json": json.dumps({"vector_layers": parsed.get("vector_layers", [])})}
+    if parsed.get("bounds") is not None:
+        metadata["bounds"] = ",".join(str(b) for b in parsed["bounds"])
+    if parsed.get("center") is not None:
+        metadata["center"] = ",".join(str(c) for c in parsed["center"])
+    for key in ("attribution", "description"):
+        if parsed.get(key) is not None:
+            metadata[key] = parsed[key]
+    return metadata
+
+
+def export_mbtiles(storage: Storage, id: str, path: str,
+                   zooms: Iterable[int] | None = None) -> int:
+    '''Export the tiles of a tileset to a new MBTiles file, returning the number of tiles
+
+    Tiles are streamed from storage and written as stored, without recompressing
+    them, in transactions of MBTILES_BATCH_SIZE tiles. Empty tiles are left out, as
+    readers treat missing tiles as empty.
+    '''
+    if os.path.exists(path):
+        raise FileExistsError(f"{path} already exists")
+    tileset = storage.get_tileset(id)
+    exported = sorted({zoom for zoom in (zooms if zooms is not None
+                                         else range(tileset.minzoom, tileset.maxzoom + 1))
+                       if tileset.minzoom <= zoom <= tileset.maxzoom})
+    if not exported:
+        raise ValueError(f"No zooms of tileset {id} to export")
+
+    db = sqlite3.connect(path)
+    try:
+        # The file is not usable until the export has finished, so it does not need
+        # to survive crashes part way through
+        db.execute('''PRAGMA journal_mode = OFF''')
+        db.execute('''PRAGMA synchronous = OFF''')
+        db.execute('''CREATE TABLE metadata (name text, value text)''')
+        db.execute('''CREATE TABLE tiles (zoom_level integer, tile_column integer,
+                                          tile_row integer, tile_data blob)''')
+        db.executemany('''INSERT INTO metadata (name, value) VALUES (?, ?)''',
+                       mbtiles_metadata(tileset.tilejson, exported[0], exported[-1]).items())
+        db.commit()
+
+        # MBTiles rows count from the south, unlike y
+        rows = ((tile.zoom, tile.x, 2**tile.zoom - 1 - tile.y, data)
+                for tile, data in storage.export_tiles(id, exported) if data)
+        count = 0
+        while batch := list(itertools.islice(rows, MBTILES_BATCH_SIZE)):
+            db.executemany('''INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data)
+                              VALUES (?, ?, ?, ?)''', batch)
+            db.commit()
+            count += len(batch)
+
+        # Creating the index after the tiles are written is faster than keeping it updated
+        db.execute('''CREATE UNIQUE INDEX tile_index
+                      ON tiles (zoom_level, tile_column, tile_row)''')
+        db.commit()
+    finally:
+        db.close()
+    return count
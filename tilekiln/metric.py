@@ -8,4 +8,29 @@ class Metric:
     zoom: int
     num_tiles: int
     size: int
+    physical_size: int | None
     percentiles: dict[float, float]
+
+
+@dataclass(kw_only=True, frozen=True)
+class BlobMetric:
+    """ Class for a metric about the blobs of a deduplicated tileset in storage """
+    id: str
+    num_blobs: int
+    size: int
+
+
+@dataclass(kw_only=True, frozen=True)
+class RenderStat:
+    """ Class for the tiles rendered at a zoom of a tileset, and the time they took
+
+    The layer is '' for the time taken by whole renders. buckets has the number of
+    renders that took up to each of RENDER_TIME_BUCKETS seconds, and then the
+    number that took longer.
+    """
+    id: str
+    zoom: int
+    layer: str
+    num_rendered: int
+    time_rendered: float
+    buckets: list[int]
@@ -1,9 +1,13 @@
 import time
+from collections.abc import Sequence
 
 import prometheus_client
 from prometheus_client.registry import Collector
-from prometheus_client.core import GaugeMetricFamily, REGISTRY
+from prometheus_client.core import (CounterMetricFamily, GaugeMetricFamily,
+                                    HistogramMetricFamily, REGISTRY)
 
+from tilekiln.sketch import QUANTILES
+from tilekiln.stats import RENDER_TIME_BUCKETS
 from tilekiln.storage import Storage
 
 # Disable default metrics since we're not monitoring this process, we're monitoring
@@ -30,19 +34,69 @@ class TilekilnCollector(Collector):
         # Native histograms would be nice here, but are still only experimental
         size = GaugeMetricFamily('tilekiln_stored_bytes_sum', 'Total size of tiles',
                                  labels=['tileset', 'zoom'])
-        quantiles = GaugeMetricFamily('tilekiln_stored_bytes', 'Tile percentiles',
+        physical_size = GaugeMetricFamily('tilekiln_stored_physical_bytes_sum',
+                                          'Total size of tiles after deduplication',
+                                          labels=['tileset', 'zoom'])
+        quantiles = GaugeMetricFamily('tilekiln_stored_bytes', 'Tile size quantiles',
                                       labels=['tileset', 'zoom', 'quantile'])
         total = GaugeMetricFamily('tilekiln_stored_count', 'Tiles in tilekiln storage',
                                   labels=['tileset', 'zoom'])
         for metric in self.__storage.metrics():
             size.add_metric([metric.id, str(metric.zoom)], metric.size)
+            # Deduplicated tilesets share blobs between zooms, so their size after
+            # deduplication is only for the whole tileset, below
+            if metric.physical_size is not None:
+                physical_size.add_metric([metric.id, str(metric.zoom)], metric.physical_size)
             total.add_metric([metric.id, str(metric.zoom)], metric.num_tiles)
             for i in range(0, len(metric.percentiles[0])):
                 quantiles.add_metric([metric.id, str(metric.zoom), str(metric.percentiles[0][i])],
                                      metric.percentiles[1][i])
         yield total
         yield size
+        yield physical_size
         yield quantiles
+        yield from self.__collect_blob_metrics()
+        yield from self.__collect_render_stats()
+
+    def __collect_blob_metrics(self):
+        blobs = GaugeMetricFamily('tilekiln_stored_blobs',
+                                  'Distinct tiles stored in deduplicated tilesets',
+                                  labels=['tileset'])
+        blob_size = GaugeMetricFamily('tilekiln_stored_blob_bytes_sum',
+                                      'Total size of deduplicated tilesets after deduplication',
+                                      labels=['tileset'])
+        for metric in self.__storage.blob_metrics():
+            blobs.add_metric([metric.id], metric.num_blobs)
+            blob_size.add_metric([metric.id], metric.size)
+        yield blobs
+        yield blob_size
+
+    def __collect_render_stats(self):
+        rendered = CounterMetricFamily('tilekiln_rendered_tiles', 'Tiles rendered',
+                                       labels=['tileset', 'zoom'])
+        render_time = HistogramMetricFamily('tilekiln_render_seconds',
+                                            'Time taken to render tiles or metatiles',
+                                            labels=['tileset', 'zoom'])
+        layer_time = HistogramMetricFamily('tilekiln_layer_render_seconds',
+                                           'Time taken to render layers of tiles or metatiles',
+                                           labels=['tileset', 'zoom', 'layer'])
+        for stat in self.__storage.render_stats():
+            # Prometheus histogram buckets count everything up to their bound
+            buckets = []
+            count = 0
+            for bound, num_renders in zip([*map(str, RENDER_TIME_BUCKETS), '+Inf'],
+                                          stat.buckets):
+                count += num_renders
+                buckets.append((bound, count))
+            if stat.layer == '':
+                rendered.add_metric([stat.id, str(stat.zoom)], stat.num_rendered)
+                render_time.add_metric([stat.id, str(stat.zoom)], buckets, stat.time_rendered)
+            else:
+                layer_time.add_metric([stat.id, str(stat.zoom), stat.layer], buckets,
+                                      stat.time_rendered)
+        yield rendered
+        yield render_time
+        yield layer_time
 
     def update(self):
         self.__i = self.__i + 1
@@ -54,16 +108,17 @@ METRIC_UPDATE_TIME = prometheus_client.Summary('tilekiln_metrics_storage_seconds
 
 
 @METRIC_UPDATE_TIME.time()
-def monitored_update_metrics(storage: Storage):
+def monitored_update_metrics(storage: Storage, quantiles: Sequence[float] = QUANTILES):
     '''Update storage metrics while tracking call time
 
     The easiest way to monitor a function is to annotate it. Rather than require
     prometheus in storage.py, we wrap it and annotate the wrapper to track call time.
     '''
-    storage.update_metrics()
+    storage.update_metrics(quantiles)
 
 
-def serve_prometheus(storage: Storage, addr, port, sleep):
+def serve_prometheus(storage: Storage, addr, port, sleep,
+                     quantiles: Sequence[float] = QUANTILES):
     '''Start a prometheus server for storage info.'''
     collector = TilekilnCollector(storage)
     REGISTRY.register(collector)
@@ -71,5 +126,5 @@ def serve_prometheus(storage: Storage, addr, port, sleep):
     prometheus_client.start_http_server(port=port, addr=addr)
     while True:
         # TODO: Time this with prometheus
-        monitored_update_metrics(storage)
+        monitored_update_metrics(storage, quantiles)
         time.sleep(sleep)
@@ -1,5 +1,8 @@
+import multiprocessing
 import os
+import queue
 import sys
+from collections.abc import Iterable, Iterator
 
 import click
 import psycopg
@@ -9,8 +12,13 @@ import uvicorn
 import tilekiln
 import tilekiln.dev
 import tilekiln.server
-from tilekiln.tile import Tile
+import tilekiln.writer
+from tilekiln.expire import ExpiredTiles, pack, read_expire_list
+from tilekiln.mbtiles import export_mbtiles
+from tilekiln.tile import Metatile, Tile, metatiles_in_bbox, tiles_in_bbox
 from tilekiln.tileset import Tileset
+from tilekiln.sketch import QUANTILES
+from tilekiln.stats import RenderStats, save_render_stats, save_render_stats_periodically
 from tilekiln.storage import Storage
 from tilekiln.kiln import Kiln
 
@@ -18,6 +26,10 @@ from tilekiln.kiln import Kiln
 # Allocated as per https://github.com/prometheus/prometheus/wiki/Default-port-allocations
 PROMETHEUS_PORT = 10013
 
+# Tiles queued per worker process. This keeps workers busy without reading all of
+# stdin into memory.
+QUEUE_DEPTH_PER_WORKER = 64
+
 
 # TODO: Refactor this into one file per group
 
@@ -78,6 +90,16 @@ def sql(config, layer, zoom, x, y):
               type=click.INT, help='Bind socket to this port.')
 @click.option('-n', '--num-threads', default=len(os.sched_getaffinity(0)),
               show_default=True, help='Number of worker processes.')
+@click.option('--layer-concurrency', default=1, show_default=True, type=click.IntRange(min=1),
+              help='Source connections per worker, for rendering layers concurrently.')
+@click.option('--prepared-statements', is_flag=True,
+              help='Prepare layer queries once per zoom instead of planning them for every tile.')
+@click.option('--render-pool-size', default=1, show_default=True, type=click.IntRange(min=1),
+              help='Tiles rendered at once per worker process, each with its own source '
+              'connections.')
+@click.option('--render-queue-size', type=click.IntRange(min=0),
+              help='Renders which can wait per worker process when all are in use. '
+              'More requests get a 503 response. Defaults to unlimited.')
 @click.option('--source-dbname')
 @click.option('--source-host')
 @click.option('--source-port')
@@ -85,12 +107,19 @@ def sql(config, layer, zoom, x, y):
 @click.option('--base-url', help='Defaults to http://127.0.0.1:8000' +
               ' or the bind host and port')
 @click.option('--id', help='Override YAML config ID')
-def dev(config, bind_host, bind_port, num_threads,
+def dev(config, bind_host, bind_port, num_threads, layer_concurrency, prepared_statements,
+        render_pool_size, render_queue_size,
         source_dbname, source_host, source_port, source_username, base_url, id):
     '''Starts a server for development
     '''
     os.environ[tilekiln.dev.TILEKILN_CONFIG] = config
     os.environ[tilekiln.dev.TILEKILN_ID] = id or tilekiln.load_config(config).id
+    os.environ[tilekiln.dev.TILEKILN_LAYER_CONCURRENCY] = str(layer_concurrency)
+    if prepared_statements:
+        os.environ[tilekiln.dev.TILEKILN_PREPARED] = "1"
+    os.environ[tilekiln.dev.TILEKILN_RENDER_POOL_SIZE] = str(render_pool_size)
+    if render_queue_size is not None:
+        os.environ[tilekiln.dev.TILEKILN_RENDER_QUEUE_SIZE] = str(render_queue_size)
 
     if base_url is not None:
         os.environ[tilekiln.dev.TILEKILN_URL] = base_url
@@ -116,6 +145,34 @@ def dev(config, bind_host, bind_port, num_threads,
               type=click.INT, help='Bind socket to this port.')
 @click.option('-n', '--num-threads', default=len(os.sched_getaffinity(0)),
               show_default=True, help='Number of worker processes.')
+@click.option('--metatile-size', default=1, show_default=True, type=click.IntRange(min=1),
+              help='Render blocks of this many tiles across with one query per layer.')
+@click.option('--layer-concurrency', default=1, show_default=True, type=click.IntRange(min=1),
+              help='Source connections per worker, for rendering layers concurrently.')
+@click.option('--prepared-statements', is_flag=True,
+              help='Prepare layer queries once per zoom instead of planning them for every tile.')
+@click.option('--render-pool-size', default=1, show_default=True, type=click.IntRange(min=1),
+              help='Tiles rendered at once per worker process, each with its own source '
+              'connections.')
+@click.option('--render-queue-size', type=click.IntRange(min=0),
+              help='Renders which can wait per worker process when all are in use. '
+              'More requests get a 503 response. Defaults to unlimited.')
+@click.option('--storage-pool-size', default=tilekiln.server.DEFAULT_STORAGE_POOL_SIZE,
+              show_default=True, type=click.IntRange(min=1),
+              help='Storage connections per worker process.')
+@click.option('--write-queue-size', default=0, show_default=True, type=click.IntRange(min=0),
+              help='Tiles queued per worker process to save in the background. '
+              '0 saves tiles before responding.')
+@click.option('--write-queue-policy', default=tilekiln.writer.BLOCK, show_default=True,
+              type=click.Choice(tilekiln.writer.POLICIES),
+              help='If requests wait or tiles are not saved when the write queue is full.')
+@click.option('--cache-size', default=0, show_default=True, type=click.IntRange(min=0),
+              help='Bytes of tiles to cache in memory per worker process. 0 disables the cache.')
+@click.option('--cache-ttl', default=tilekiln.server.DEFAULT_CACHE_TTL, show_default=True,
+              type=click.FloatRange(min=0), help='Seconds to cache tiles for.')
+@click.option('--cache-zoom-ttl', type=(click.INT, click.FloatRange(min=0)), multiple=True,
+              metavar='ZOOM SECONDS',
+              help='Seconds to cache tiles at a zoom for, overriding --cache-ttl.')
 @click.option('--source-dbname')
 @click.option('--source-host')
 @click.option('--source-port')
@@ -126,12 +183,29 @@ def dev(config, bind_host, bind_port, num_threads,
 @click.option('--storage-username')
 @click.option('--base-url', help='Defaults to http://127.0.0.1:8000' +
               ' or the bind host and port')
-def live(config, bind_host, bind_port, num_threads,
+def live(config, bind_host, bind_port, num_threads, metatile_size, layer_concurrency,
+         prepared_statements, render_pool_size, render_queue_size, storage_pool_size,
+         write_queue_size, write_queue_policy,
+         cache_size, cache_ttl, cache_zoom_ttl,
          source_dbname, source_host, source_port, source_username,
          storage_dbname, storage_host, storage_port, storage_username, base_url):
     '''Starts a server for pre-generated tiles from DB'''
     os.environ[tilekiln.server.TILEKILN_CONFIG] = config
     os.environ[tilekiln.server.TILEKILN_THREADS] = str(num_threads)
+    os.environ[tilekiln.server.TILEKILN_METATILE_SIZE] = str(metatile_size)
+    os.environ[tilekiln.server.TILEKILN_LAYER_CONCURRENCY] = str(layer_concurrency)
+    if prepared_statements:
+        os.environ[tilekiln.server.TILEKILN_PREPARED] = "1"
+    os.environ[tilekiln.server.TILEKILN_RENDER_POOL_SIZE] = str(render_pool_size)
+    if render_queue_size is not None:
+        os.environ[tilekiln.server.TILEKILN_RENDER_QUEUE_SIZE] = str(render_queue_size)
+    os.environ[tilekiln.server.TILEKILN_STORAGE_POOL_SIZE] = str(storage_pool_size)
+    os.environ[tilekiln.server.TILEKILN_WRITE_QUEUE_SIZE] = str(write_queue_size)
+    os.environ[tilekiln.server.TILEKILN_WRITE_QUEUE_POLICY] = write_queue_policy
+    os.environ[tilekiln.server.TILEKILN_CACHE_SIZE] = str(cache_size)
+    os.environ[tilekiln.server.TILEKILN_CACHE_TTL] = str(cache_ttl)
+    os.environ[tilekiln.server.TILEKILN_CACHE_ZOOM_TTLS] = ",".join(
+        f"{zoom}={ttl}" for zoom, ttl in cache_zoom_ttl)
 
     if base_url is not None:
         os.environ[tilekiln.dev.TILEKILN_URL] = base_url
@@ -165,17 +239,32 @@ def live(config, bind_host, bind_port, num_threads,
               type=click.INT, help='Bind socket to this port.')
 @click.option('-n', '--num-threads', default=len(os.sched_getaffinity(0)),
               show_default=True, help='Number of worker processes.')
+@click.option('--storage-pool-size', default=tilekiln.server.DEFAULT_STORAGE_POOL_SIZE,
+              show_default=True, type=click.IntRange(min=1),
+              help='Storage connections per worker process.')
+@click.option('--cache-size', default=0, show_default=True, type=click.IntRange(min=0),
+              help='Bytes of tiles to cache in memory per worker process. 0 disables the cache.')
+@click.option('--cache-ttl', default=tilekiln.server.DEFAULT_CACHE_TTL, show_default=True,
+              type=click.FloatRange(min=0), help='Seconds to cache tiles for.')
+@click.option('--cache-zoom-ttl', type=(click.INT, click.FloatRange(min=0)), multiple=True,
+              metavar='ZOOM SECONDS',
+              help='Seconds to cache tiles at a zoom for, overriding --cache-ttl.')
 @click.option('--storage-dbname')
 @click.option('--storage-host')
 @click.option('--storage-port')
 @click.option('--storage-username')
 @click.option('--base-url', help='Defaults to http://127.0.0.1:8000' +
               ' or the bind host and port')
-def serve(bind_host, bind_port, num_threads,
-          storage_dbname, storage_host, storage_port, storage_username, base_url):
+def serve(bind_host, bind_port, num_threads, storage_pool_size, cache_size, cache_ttl,
+          cache_zoom_ttl, storage_dbname, storage_host, storage_port, storage_username, base_url):
     '''Starts a server for pre-generated tiles from DB'''
 
     os.environ[tilekiln.server.TILEKILN_THREADS] = str(num_threads)
+    os.environ[tilekiln.server.TILEKILN_STORAGE_POOL_SIZE] = str(storage_pool_size)
+    os.environ[tilekiln.server.TILEKILN_CACHE_SIZE] = str(cache_size)
+    os.environ[tilekiln.server.TILEKILN_CACHE_TTL] = str(cache_ttl)
+    os.environ[tilekiln.server.TILEKILN_CACHE_ZOOM_TTLS] = ",".join(
+        f"{zoom}={ttl}" for zoom, ttl in cache_zoom_ttl)
 
     if base_url is not None:
         os.environ[tilekiln.dev.TILEKILN_URL] = base_url
@@ -206,7 +295,9 @@ def storage():
 @click.option('--storage-port')
 @click.option('--storage-username')
 @click.option('--id', help='Override YAML config ID')
-def init(config, storage_dbname, storage_host, storage_port, storage_username, id):
+@click.option('--deduplicate', is_flag=True,
+              help='Store each distinct tile once, referenced by hash.')
+def init(config, storage_dbname, storage_host, storage_port, storage_username, id, deduplicate):
     ''' Initialize storage for tiles'''
 
     c = tilekiln.load_config(config)
@@ -218,7 +309,26 @@ def init(config, storage_dbname, storage_host, storage_port, storage_username, i
     storage = Storage(pool)
     storage.create_schema()
     tileset = Tileset.from_config(storage, c)
-    tileset.prepare_storage()
+    tileset.prepare_storage(deduplicate)
+    pool.close()
+
+
+@storage.command()
+@click.option('--storage-dbname')
+@click.option('--storage-host')
+@click.option('--storage-port')
+@click.option('--storage-username')
+def upgrade(storage_dbname, storage_host, storage_port, storage_username):
+    '''Upgrade storage made by an older version of tilekiln'''
+    pool = psycopg_pool.NullConnectionPool(kwargs={"dbname": storage_dbname,
+                                                   "host": storage_host,
+                                                   "port": storage_port,
+                                                   "user": storage_username})
+    storage = Storage(pool)
+    if storage.upgrade_schema():
+        click.echo("Upgraded storage")
+    else:
+        click.echo("Storage is already up to date")
     pool.close()
 
 
@@ -256,9 +366,13 @@ def destroy(config, storage_dbname, storage_host, storage_port, storage_username
 @click.option('--storage-port')
 @click.option('--storage-username')
 @click.option('-z', '--zoom', type=click.INT, multiple=True)
+@click.option('--bbox', type=click.FLOAT, nargs=4,
+              help='West, south, east, north bounds in degrees. Only tiles covering it '
+                   'are deleted')
 @click.option('--id', help='Override YAML config ID')
-def delete(config, storage_dbname, storage_host, storage_port, storage_username, zoom, id):
-    ''' Delete tiles from storage, optionally by-zoom'''
+def delete(config, storage_dbname, storage_host, storage_port, storage_username, zoom, bbox,
+           id):
+    ''' Delete tiles from storage, optionally by-zoom and by bounding box'''
     if config is None and id is None:
         raise click.UsageError('''Missing one of '--id' or '--config' options''')
 
@@ -274,7 +388,10 @@ def delete(config, storage_dbname, storage_host, storage_port, storage_username,
                                                    "user": storage_username})
     storage = Storage(pool)
 
-    if (zoom == ()):
+    if bbox:
+        count = storage.delete_bbox(id, zoom or None, bbox)
+        click.echo(f"Deleted {count} tiles")
+    elif (zoom == ()):
         storage.truncate_tables(id)
     else:
         storage.truncate_tables(id, zoom)
@@ -307,11 +424,56 @@ def tiledelete(config, storage_dbname, storage_host, storage_port, storage_usern
                                                    "user": storage_username})
     storage = Storage(pool)
 
-    # TODO: This requires reading all of stdin before starting. This lets it display
-    # how many tiles to delete but also means it has to read them all in before starting
-    tiles = {Tile.from_string(t) for t in sys.stdin}
-    click.echo(f"Deleting {len(tiles)} tiles")
-    storage.delete_tiles(id, tiles)
+    # Tiles are deleted as they are read, so stdin can be any length
+    tiles = (Tile.from_string(t) for t in sys.stdin if t.strip())
+    count = storage.delete_tiles(id, tiles)
+    click.echo(f"Deleted {count} tiles")
+    pool.close()
+
+
+@storage.command()
+@click.option('--config', type=click.Path(exists=True))
+@click.option('--storage-dbname')
+@click.option('--storage-host')
+@click.option('--storage-port')
+@click.option('--storage-username')
+@click.option('-z', '--zoom', type=click.INT, multiple=True,
+              help='Zoom to export. Can be given multiple times, and defaults to all zooms')
+@click.option('--format', 'output_format', type=click.Choice(['mbtiles']), default='mbtiles',
+              show_default=True)
+@click.option('--id', help='Override YAML config ID')
+@click.argument('output', type=click.Path(dir_okay=False))
+def export(config, storage_dbname, storage_host, storage_port, storage_username, zoom,
+           output_format, id, output):
+    '''Export tiles from storage to a file'''
+    if config is None and id is None:
+        raise click.UsageError('''Missing one of '--id' or '--config' options''')
+
+    # No id specified, so load the config for one. We know from above config is not none.
+    c = None
+    if id is None:
+        c = tilekiln.load_config(config)
+        id = c.id
+
+    if os.path.exists(output):
+        raise click.UsageError(f"{output} already exists")
+
+    pool = psycopg_pool.NullConnectionPool(kwargs={"dbname": storage_dbname,
+                                                   "host": storage_host,
+                                                   "port": storage_port,
+                                                   "user": storage_username})
+    storage = Storage(pool)
+
+    try:
+        count = export_mbtiles(storage, id, output, zoom or None)
+    except KeyError:
+        raise click.ClickException(f"Failed to retrieve tileset for id {id}, "
+                                   f"does it exist in storage DB?")
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    finally:
+        pool.close()
+    click.echo(f"Exported {count} tiles to {output}")
 
 
 @cli.group()
@@ -324,6 +486,10 @@ def generate():
 @click.option('--config', required=True, type=click.Path(exists=True))
 @click.option('-n', '--num-threads', default=len(os.sched_getaffinity(0)),
               show_default=True, help='Number of worker processes.')
+@click.option('--metatile-size', default=1, show_default=True, type=click.IntRange(min=1),
+              help='Render blocks of this many tiles across with one query per layer.')
+@click.option('--prepared-statements', is_flag=True,
+              help='Prepare layer queries once per zoom instead of planning them for every tile.')
 @click.option('--source-dbname')
 @click.option('--source-host')
 @click.option('--source-port')
@@ -332,31 +498,310 @@ def generate():
 @click.option('--storage-host')
 @click.option('--storage-port')
 @click.option('--storage-username')
-def tiles(config, num_threads, source_dbname, source_host, source_port, source_username,
+def tiles(config, num_threads, metatile_size, prepared_statements,
+          source_dbname, source_host, source_port, source_username,
           storage_dbname, storage_host, storage_port, storage_username):
     '''Generate specific tiles.
        Pass a list of z/x/y to stdin to generate those tiles'''
 
+    source_args = {"dbname": source_dbname,
+                   "host": source_host,
+                   "port": source_port,
+                   "user": source_username}
+    storage_args = {"dbname": storage_dbname,
+                    "host": storage_host,
+                    "port": storage_port,
+                    "user": storage_username}
+
+    click.echo(f"Rendering tiles over {num_threads} threads")
+    tiles = (Tile.from_string(t) for t in sys.stdin)
+    if metatile_size == 1:
+        count = generate_tiles(config, tiles, num_threads, source_args, storage_args,
+                               prepared_statements)
+        click.echo(f"Rendered {count} tiles")
+    else:
+        count = generate_tiles(config, unique_metatiles(tiles, metatile_size), num_threads,
+                               source_args, storage_args, prepared_statements)
+        click.echo(f"Rendered {count} metatiles")
+
+
+@generate.command()
+@click.option('--config', required=True, type=click.Path(exists=True))
+@click.option('-n', '--num-threads', default=len(os.sched_getaffinity(0)),
+              show_default=True, help='Number of worker processes.')
+@click.option('--bbox', type=click.FLOAT, nargs=4,
+              help='West, south, east, north bounds in degrees. Defaults to the config bounds')
+@click.option('--min-zoom', type=click.INT, help='Defaults to the config min zoom')
+@click.option('--max-zoom', type=click.INT, help='Defaults to the config max zoom')
+@click.option('--metatile-size', default=1, show_default=True, type=click.IntRange(min=1),
+              help='Render blocks of this many tiles across with one query per layer.')
+@click.option('--prepared-statements', is_flag=True,
+              help='Prepare layer queries once per zoom instead of planning them for every tile.')
+@click.option('--source-dbname')
+@click.option('--source-host')
+@click.option('--source-port')
+@click.option('--source-username')
+@click.option('--storage-dbname')
+@click.option('--storage-host')
+@click.option('--storage-port')
+@click.option('--storage-username')
+def area(config, num_threads, bbox, min_zoom, max_zoom, metatile_size, prepared_statements,
+         source_dbname, source_host, source_port, source_username,
+         storage_dbname, storage_host, storage_port, storage_username):
+    '''Generate all tiles in an area.
+       Tiles covering a bounding box are generated for a range of zooms'''
+
     c = tilekiln.load_config(config)
 
-    tiles = {Tile.from_string(t) for t in sys.stdin}
-    threads = min(num_threads, len(tiles))  # No point in more threads than tiles
+    if not bbox:
+        bbox = c.bounds or [-180, -90, 180, 90]
+    if min_zoom is None:
+        min_zoom = c.minzoom
+    if max_zoom is None:
+        max_zoom = c.maxzoom
+    if min_zoom is None or max_zoom is None:
+        raise click.UsageError("No zooms to generate, config has no layers")
+
+    source_args = {"dbname": source_dbname,
+                   "host": source_host,
+                   "port": source_port,
+                   "user": source_username}
+    storage_args = {"dbname": storage_dbname,
+                    "host": storage_host,
+                    "port": storage_port,
+                    "user": storage_username}
+
+    click.echo(f"Rendering zoom {min_zoom} to {max_zoom} over {num_threads} threads")
+    if metatile_size == 1:
+        count = generate_tiles(config, tiles_in_bbox(bbox, min_zoom, max_zoom), num_threads,
+                               source_args, storage_args, prepared_statements)
+        click.echo(f"Rendered {count} tiles")
+    else:
+        count = generate_tiles(config, metatiles_in_bbox(bbox, min_zoom, max_zoom, metatile_size),
+                               num_threads, source_args, storage_args, prepared_statements)
+        click.echo(f"Rendered {count} metatiles")
 
-    click.echo(f"Rendering {len(tiles)} tiles over {threads} threads")
 
-    pool = psycopg_pool.NullConnectionPool(kwargs={"dbname": storage_dbname,
-                                                   "host": storage_host,
-                                                   "port": storage_port,
-                                                   "user": storage_username})
-    storage = Storage(pool)
+@generate.command()
+@click.option('--config', required=True, type=click.Path(exists=True))
+@click.option('-n', '--num-threads', default=len(os.sched_getaffinity(0)),
+              show_default=True, help='Number of worker processes.')
+@click.option('--min-zoom', type=click.INT,
+              help='Lowest zoom to expire parent tiles at. Defaults to the config min zoom')
+@click.option('--max-zoom', type=click.INT,
+              help='Highest zoom to expire child tiles at. Defaults to the config max zoom')
+@click.option('--delete', is_flag=True,
+              help='Delete expired tiles from storage instead of rendering them.')
+@click.option('--metatile-size', default=1, show_default=True, type=click.IntRange(min=1),
+              help='Render blocks of this many tiles across with one query per layer.')
+@click.option('--prepared-statements', is_flag=True,
+              help='Prepare layer queries once per zoom instead of planning them for every tile.')
+@click.option('--source-dbname')
+@click.option('--source-host')
+@click.option('--source-port')
+@click.option('--source-username')
+@click.option('--storage-dbname')
+@click.option('--storage-host')
+@click.option('--storage-port')
+@click.option('--storage-username')
+@click.argument('expire_files', nargs=-1, type=click.File())
+def expired(config, num_threads, min_zoom, max_zoom, delete, metatile_size, prepared_statements,
+            source_dbname, source_host, source_port, source_username,
+            storage_dbname, storage_host, storage_port, storage_username, expire_files):
+    '''Generate or delete expired tiles.
+       Reads osm2pgsql expire lists of z/x/y from the files, or stdin if there are none.
+       Each expired tile also expires its parents and children between the min and
+       max zoom.'''
 
-    tileset = Tileset.from_config(storage, c)
-    gen_conn = psycopg.connect(dbname=source_dbname, host=source_host,
-                               port=source_port, username=source_username)
-    kiln = Kiln(c, gen_conn)
+    c = tilekiln.load_config(config)
+
+    if min_zoom is None:
+        min_zoom = c.minzoom
+    if max_zoom is None:
+        max_zoom = c.maxzoom
+    if min_zoom is None or max_zoom is None:
+        raise click.UsageError("No zooms to generate, config has no layers")
+
+    expired_tiles = ExpiredTiles(min_zoom, max_zoom)
+    for f in expire_files or [sys.stdin]:
+        expired_tiles.update(read_expire_list(f))
+
+    storage_args = {"dbname": storage_dbname,
+                    "host": storage_host,
+                    "port": storage_port,
+                    "user": storage_username}
+
+    if delete:
+        pool = psycopg_pool.NullConnectionPool(kwargs=storage_args)
+        storage = Storage(pool)
+        count = storage.delete_tiles(c.id, expired_tiles)
+        pool.close()
+        click.echo(f"Deleted {count} tiles")
+        return
+
+    source_args = {"dbname": source_dbname,
+                   "host": source_host,
+                   "port": source_port,
+                   "user": source_username}
+
+    click.echo(f"Rendering expired tiles from zoom {min_zoom} to {max_zoom} "
+               f"over {num_threads} threads")
+    if metatile_size == 1:
+        count = generate_tiles(config, expired_tiles, num_threads, source_args, storage_args,
+                               prepared_statements)
+        click.echo(f"Rendered {count} tiles")
+    else:
+        count = generate_tiles(config, unique_expired_metatiles(expired_tiles, metatile_size),
+                               num_threads, source_args, storage_args, prepared_statements)
+        click.echo(f"Rendered {count} metatiles")
+
+
+def unique_metatiles(tiles: Iterable[Tile], size: int) -> Iterator[Metatile]:
+    '''Yields the metatiles containing tiles, skipping metatiles already yielded
+
+    Metatiles which have been yielded are stored as integers in a set per zoom, like
+    ExpiredTiles does, so this takes one integer per metatile.
+    '''
+    seen: dict[int, set[int]] = {}
     for tile in tiles:
-        mvt = kiln.render(tile)
-        tileset.save_tile(tile, mvt)
+        metatile = Metatile.from_tile(tile, size)
+        keys = seen.setdefault(metatile.zoom, set())
+        key = pack(metatile.zoom, metatile.x, metatile.y)
+        if key not in keys:
+            keys.add(key)
+            yield metatile
+
+
+def unique_expired_metatiles(expired_tiles: ExpiredTiles, size: int) -> Iterator[Metatile]:
+    '''Yields the metatiles containing expired tiles, without duplicates
+
+    Expired tiles are yielded one zoom at a time, so only the metatiles of one zoom are
+    stored at once.
+    '''
+    for zoom in expired_tiles.zooms():
+        yield from unique_metatiles(expired_tiles.tiles(zoom), size)
+
+
+def generate_tiles(config_path: str, tiles: Iterable[Tile | Metatile], num_threads: int,
+                   source_args: dict, storage_args: dict, prepared: bool = False) -> int:
+    '''Render tiles or metatiles over a pool of worker processes and save them to storage
+
+    Tiles are passed to the workers through a bounded queue, so tiles can be
+    a lazy iterable of any length. Each worker has its own Kiln and source
+    connection, and sends rendered tiles to a storage writer process.
+
+    Returns the number of tiles or metatiles rendered.
+    '''
+    c = tilekiln.load_config(config_path)
+
+    # Storage made by an older version can't have render stats saved to it
+    pool = psycopg_pool.NullConnectionPool(kwargs=storage_args)
+    Storage(pool).upgrade_schema()
+    pool.close()
+
+    tile_queue: multiprocessing.Queue = multiprocessing.Queue(QUEUE_DEPTH_PER_WORKER * num_threads)
+    result_queue: multiprocessing.Queue = multiprocessing.Queue(QUEUE_DEPTH_PER_WORKER *
+                                                                num_threads)
+
+    workers = [multiprocessing.Process(target=_render_worker, daemon=True,
+                                       args=(config_path, source_args, storage_args, prepared,
+                                             tile_queue, result_queue))
+               for _ in range(num_threads)]
+    writer = multiprocessing.Process(target=_storage_writer, daemon=True,
+                                     args=(c.id, storage_args, result_queue, num_threads))
+    processes = workers + [writer]
+    for process in processes:
+        process.start()
+
+    count = 0
+    try:
+        for tile in tiles:
+            _put_checked(tile_queue, tile, processes)
+            count += 1
+
+        # One sentinel per worker tells them there are no more tiles
+        for _ in workers:
+            _put_checked(tile_queue, None, processes)
+
+        _join_checked(processes)
+    except click.ClickException:
+        # Tiles left for failed workers would stop this process exiting
+        tile_queue.cancel_join_thread()
+        raise
+    return count
+
+
+def _join_checked(processes: list[multiprocessing.Process]):
+    '''Wait for processes to finish, failing as soon as one fails
+
+    Other processes can be blocked on a queue a failed process was using, so they are
+    not waited for. They are daemons, so they are stopped when this process exits.
+    '''
+    while any(process.exitcode is None for process in processes):
+        next(process for process in processes if process.exitcode is None).join(timeout=1)
+        if any(process.exitcode not in (None, 0) for process in processes):
+            raise click.ClickException("Tile generation process failed")
+    if any(process.exitcode != 0 for process in processes):
+        raise click.ClickException("Tile generation process failed")
+
+
+def _put_checked(q: multiprocessing.Queue, item, processes: list[multiprocessing.Process]):
+    '''Put an item on a queue, failing if a process exits instead of blocking forever'''
+    while True:
+        try:
+            q.put(item, timeout=1)
+            return
+        except queue.Full:
+            if not all(process.is_alive() for process in processes):
+                raise click.ClickException("Tile generation process exited unexpectedly")
+
+
+def _render_worker(config_path: str, source_args: dict, storage_args: dict, prepared: bool,
+                   tile_queue: multiprocessing.Queue, result_queue: multiprocessing.Queue):
+    '''Render tiles from the tile queue until a None sentinel is received
+
+    Render stats are saved to storage periodically and when the worker is done. The
+    writer is told the worker is done even if it fails, so it doesn't wait forever.
+    '''
+    try:
+        c = tilekiln.load_config(config_path)
+        pool = psycopg_pool.NullConnectionPool(kwargs=storage_args)
+        storage = Storage(pool)
+        stats = RenderStats()
+        save_render_stats_periodically(stats, storage)
+        try:
+            with psycopg.connect(**source_args) as conn:
+                kiln = Kiln(c, conn, prepared=prepared, stats=stats)
+                while (tile := tile_queue.get()) is not None:
+                    if isinstance(tile, Metatile):
+                        result_queue.put(kiln.render_metatile(tile))
+                    else:
+                        result_queue.put([(tile, kiln.render(tile))])
+        finally:
+            save_render_stats(stats, storage)
+    finally:
+        # Tell the writer this worker is done
+        result_queue.put(None)
+
+
+def _storage_writer(id: str, storage_args: dict, result_queue: multiprocessing.Queue,
+                    num_workers: int):
+    '''Save rendered tiles from the result queue until every worker is done'''
+    pool = psycopg_pool.NullConnectionPool(kwargs=storage_args)
+    storage = Storage(pool)
+    storage.save_tiles(id, _results(result_queue, num_workers))
+    pool.close()
+
+
+def _results(result_queue: multiprocessing.Queue, num_workers: int) -> Iterator[tuple[Tile, bytes]]:
+    '''Yield rendered tiles from the result queue until every worker is done'''
+    finished = 0
+    while finished < num_workers:
+        result = result_queue.get()
+        if result is None:
+            finished += 1
+        else:
+            yield from result
 
 
 @cli.command()
@@ -368,8 +813,11 @@ def tiles(config, num_threads, source_dbname, source_host, source_port, source_u
 @click.option('--storage-host')
 @click.option('--storage-port')
 @click.option('--storage-username')
+@click.option('--quantile', 'quantiles', type=click.FloatRange(0, 1), multiple=True,
+              help='Quantile of tile sizes to export. Can be given multiple times, '
+                   f'and defaults to {", ".join(str(q) for q in QUANTILES)}')
 def prometheus(bind_host, bind_port,
-               storage_dbname, storage_host, storage_port, storage_username):
+               storage_dbname, storage_host, storage_port, storage_username, quantiles):
     ''' Run a prometheus exporter which can be accessed for gathering metrics
         on stored tiles. '''
     pool = psycopg_pool.NullConnectionPool(kwargs={"dbname": storage_dbname,
@@ -377,10 +825,12 @@ def prometheus(bind_host, bind_port,
                                                    "port": storage_port,
                                                    "user": storage_username})
     storage = Storage(pool)
+    # Storage made by an older version doesn't have the size histograms metrics are read from
+    storage.upgrade_schema()
 
     # tilekiln.prometheus brings in a bunch of stuff, so only do this
     # for this command
     from tilekiln.prometheus import serve_prometheus
     # TODO: make sleep a parameter
     click.echo(f'Running prometheus exporter on http://{bind_host}:{bind_port}/')
-    serve_prometheus(storage, bind_host, bind_port, 15)
+    serve_prometheus(storage, bind_host, bind_port, 15, sorted(quantiles) or QUANTILES)
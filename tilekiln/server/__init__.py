@@ -1,58 +1,282 @@
-import json
+import hashlib
 import os
+import struct
+from collections.abc import Iterable
+from functools import partial
 
+import prometheus_client
 import psycopg
 import psycopg_pool
-from fastapi import FastAPI, Response, HTTPException
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, REGISTRY
+from prometheus_client.registry import Collector
+from fastapi import Body, FastAPI, Header, Response, HTTPException
 
 import tilekiln
+from tilekiln.cache import CacheCollector, TileCache, listen_for_invalidations
 from tilekiln.config import Config
-from tilekiln.kiln import Kiln
-from tilekiln.tile import Tile
+from tilekiln.kiln import Kiln, KilnPool, KilnPoolFull
+from tilekiln.singleflight import SingleFlight
+from tilekiln.stats import RenderStats, save_render_stats, save_render_stats_periodically
+from tilekiln.writer import BLOCK, TileWriter, WriterCollector
+from tilekiln.tile import Metatile, Tile
 from tilekiln.tileset import Tileset
-from tilekiln.storage import Storage
+from tilekiln.storage import AsyncStorage, Storage, compress_tile, decompress_tile
 
 # Constants for MVTs
 MVT_MIME_TYPE = "application/vnd.mapbox-vector-tile"
+# Many tiles in one response, each as its length and then the tile
+TILES_MIME_TYPE = "application/vnd.tilekiln.tiles"
+# Length sent for a tile which is not in storage
+MISSING_TILE_LENGTH = -1
+# Most tiles which can be requested at once
+MAX_BATCH_TILES = 1000
 
 # Constants for environment variable names
 # Passing around enviornment variables really is the best way to get this to fastapi
 TILEKILN_CONFIG = "TILEKILN_CONFIG"
 TILEKILN_URL = "TILEKILN_URL"
 TILEKILN_THREADS = "TILEKILN_THREADS"
+TILEKILN_METATILE_SIZE = "TILEKILN_METATILE_SIZE"
+TILEKILN_LAYER_CONCURRENCY = "TILEKILN_LAYER_CONCURRENCY"
+TILEKILN_PREPARED = "TILEKILN_PREPARED"
+TILEKILN_STORAGE_POOL_SIZE = "TILEKILN_STORAGE_POOL_SIZE"
+TILEKILN_RENDER_POOL_SIZE = "TILEKILN_RENDER_POOL_SIZE"
+TILEKILN_RENDER_QUEUE_SIZE = "TILEKILN_RENDER_QUEUE_SIZE"
+TILEKILN_CACHE_SIZE = "TILEKILN_CACHE_SIZE"
+TILEKILN_CACHE_TTL = "TILEKILN_CACHE_TTL"
+# Per-zoom TTLs, as comma-separated zoom=seconds
+TILEKILN_CACHE_ZOOM_TTLS = "TILEKILN_CACHE_ZOOM_TTLS"
+TILEKILN_WRITE_QUEUE_SIZE = "TILEKILN_WRITE_QUEUE_SIZE"
+TILEKILN_WRITE_QUEUE_POLICY = "TILEKILN_WRITE_QUEUE_POLICY"
+
+# Storage connections per worker for serving tiles
+DEFAULT_STORAGE_POOL_SIZE = 10
+# Seconds to cache tiles for, if there is a cache
+DEFAULT_CACHE_TTL = 60
+# Seconds a client is asked to wait before retrying when renders are turned away
+RETRY_AFTER = 1
 
 STANDARD_HEADERS: dict[str, str] = {"Access-Control-Allow-Origin": "*",
                                     "Access-Control-Allow-Methods": "GET, HEAD"}
+GZIP_HEADERS: dict[str, str] = {"Content-Encoding": "gzip",
+                                "Vary": "Accept-Encoding"}
 
-kiln: Kiln
+# Tiles are hashed with SHA-256 when they are saved
+EMPTY_TILE_HASH = hashlib.sha256(b'').digest()
+
+kilns: KilnPool
 config: Config
 storage: Storage
+async_storage: AsyncStorage
 tilesets: dict[str, Tileset] = {}
+cache: TileCache | None = None
+writer: TileWriter | None = None
+# Render stats of the live server, saved to storage periodically
+render_stats = RenderStats()
+# Renders in progress in the live server, by tileset and metatile
+render_flight: SingleFlight[dict[tuple[int, int], tuple[bytes, bytes]]] = SingleFlight()
 
 # Two types of server are defined - one for static tiles, the other for live generated tiles.
 server = FastAPI()
 live = FastAPI()
+# Metrics for the servers' own operation, such as the tile cache and write queue
+server.mount("/metrics", prometheus_client.make_asgi_app())
+live.mount("/metrics", prometheus_client.make_asgi_app())
+
+
+def load_kilns(config: Config, connect_args: dict,
+               stats: RenderStats | None = None) -> KilnPool:
+    '''Create the pool of kilns for rendering tiles, each with its own connections'''
+    kilns = []
+    for _ in range(int(os.environ.get(TILEKILN_RENDER_POOL_SIZE, 1))):
+        conns = [psycopg.connect(**connect_args)
+                 for _ in range(int(os.environ.get(TILEKILN_LAYER_CONCURRENCY, 1)))]
+        kilns.append(Kiln(config, conns[0], conns[1:], prepared=TILEKILN_PREPARED in os.environ,
+                          stats=stats))
+    max_waiting = None
+    if TILEKILN_RENDER_QUEUE_SIZE in os.environ:
+        max_waiting = int(os.environ[TILEKILN_RENDER_QUEUE_SIZE])
+    return KilnPool(kilns, max_waiting)
+
+
+def overloaded_exception(e: KilnPoolFull) -> HTTPException:
+    '''A 503 response for a render turned away because the server is busy'''
+    return HTTPException(status_code=503, detail=f"Server is busy: {e}",
+                         headers={"Retry-After": str(RETRY_AFTER)})
+
+
+class KilnPoolCollector(Collector):
+    '''Prometheus metrics for a KilnPool'''
+    def __init__(self, kilns: KilnPool):
+        self.__kilns = kilns
+        super().__init__()
+
+    def collect(self):
+        in_use = GaugeMetricFamily('tilekiln_render_pool_in_use', 'Kilns rendering tiles')
+        in_use.add_metric([], self.__kilns.in_use)
+        yield in_use
+        size = GaugeMetricFamily('tilekiln_render_pool_size', 'Kilns for rendering tiles')
+        size.add_metric([], self.__kilns.size)
+        yield size
+        waiting = GaugeMetricFamily('tilekiln_render_pool_waiting',
+                                    'Renders waiting for a kiln')
+        waiting.add_metric([], self.__kilns.waiting)
+        yield waiting
+        rejected = CounterMetricFamily('tilekiln_render_pool_rejected',
+                                       'Renders turned away because too many were waiting')
+        rejected.add_metric([], self.__kilns.rejected)
+        yield rejected
+
+
+def load_cache(connect_args: dict) -> TileCache | None:
+    '''Create the tile cache from the environment, if it is enabled
+
+    The cache is invalidated by listening for notifications from the storage DB.
+    '''
+    size = int(os.environ.get(TILEKILN_CACHE_SIZE, 0))
+    if size <= 0:
+        return None
+    zoom_ttls = {}
+    for zoom_ttl in filter(None, os.environ.get(TILEKILN_CACHE_ZOOM_TTLS, "").split(",")):
+        zoom, ttl = zoom_ttl.split("=")
+        zoom_ttls[int(zoom)] = float(ttl)
+    tile_cache = TileCache(size, float(os.environ.get(TILEKILN_CACHE_TTL, DEFAULT_CACHE_TTL)),
+                           zoom_ttls)
+    listen_for_invalidations(tile_cache, connect_args)
+    REGISTRY.register(CacheCollector(tile_cache))
+    return tile_cache
+
+
+def tile_response(tile: bytes | None, compressed: bool = False,
+                  accept_encoding: str | None = None, hash: bytes | None = None,
+                  cache_control: str | None = None) -> Response:
+    '''Returns the response for a tile, which is empty for an empty tile
+
+    The tile is sent gzipped if the client accepts gzip, whether or not it was
+    compressed, so stored and freshly rendered tiles get the same response. Tiles
+    compress the same way they are compressed for storage. If the hash of the tile is
+    known, it is used for the ETag.
+    '''
+    if tile is None:
+        return Response(tile,
+                        media_type=MVT_MIME_TYPE,
+                        headers=STANDARD_HEADERS)
 
-
-# TODO: Move elsewhere
-def change_tilejson_url(tilejson: str, baseurl: str) -> str:
-    modified_tilejson = json.loads(tilejson)
-    modified_tilejson["tiles"] = [baseurl + "/{z}/{x}/{y}.mvt"]
-    return json.dumps(modified_tilejson)
+    gzipped = tile != b'' and accepts_gzip(accept_encoding)
+    headers = tile_headers(hash, gzipped, cache_control)
+    if tile == b'':
+        return Response(status_code=204, headers=headers)
+    if gzipped:
+        return Response(tile if compressed else compress_tile(tile),
+                        media_type=MVT_MIME_TYPE,
+                        headers={**headers, **GZIP_HEADERS})
+    return Response(decompress_tile(tile) if compressed else tile,
+                    media_type=MVT_MIME_TYPE,
+                    headers={**headers, "Vary": "Accept-Encoding"})
+
+
+def pack_tiles(tiles: Iterable[bytes | None]) -> bytes:
+    '''Join tiles into one body, each as a 4-byte big-endian signed length followed by
+       the tile, with MISSING_TILE_LENGTH and no data for a missing tile
+    '''
+    parts = []
+    for tile in tiles:
+        if tile is None:
+            parts.append(struct.pack(">i", MISSING_TILE_LENGTH))
+        else:
+            parts.append(struct.pack(">i", len(tile)))
+            parts.append(tile)
+    return b''.join(parts)
+
+
+def not_modified_response(hash: bytes, accept_encoding: str | None = None,
+                          cache_control: str | None = None) -> Response:
+    '''Returns the response for a tile which the client already has'''
+    gzipped = hash != EMPTY_TILE_HASH and accepts_gzip(accept_encoding)
+    return Response(status_code=304, headers=tile_headers(hash, gzipped, cache_control))
+
+
+def tile_headers(hash: bytes | None, gzipped: bool, cache_control: str | None) -> dict[str, str]:
+    '''Returns the headers for a tile, other than for the content'''
+    headers = dict(STANDARD_HEADERS)
+    if cache_control is not None:
+        headers["Cache-Control"] = cache_control
+    if hash is not None:
+        headers["ETag"] = etag(hash, gzipped)
+    return headers
+
+
+def etag(hash: bytes, gzipped: bool) -> str:
+    '''Returns the strong ETag for a tile, given the hash of its content
+
+    The gzipped and uncompressed responses are different representations, so they
+    need different ETags.
+    '''
+    return f'''"{hash.hex()}{'-gzip' if gzipped else ''}"'''
+
+
+def etag_matches(if_none_match: str | None, hash: bytes | None) -> bool:
+    '''Returns if an If-None-Match header matches a tile with the hash
+
+    Either representation of the tile matches, since they have the same content.
+    '''
+    if if_none_match is None or hash is None:
+        return False
+    etags = (etag(hash, False), etag(hash, True))
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") in etags:
+            return True
+    return False
+
+
+def accepts_gzip(accept_encoding: str | None) -> bool:
+    '''Returns if an Accept-Encoding header allows a gzip response'''
+    if accept_encoding is None:
+        return False
+    # Quality values for gzip and the wildcard, with gzip taking precedence
+    qualities: dict[str, float] = {}
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        name = name.strip().lower()
+        if name not in ("gzip", "*"):
+            continue
+        q = params.strip()
+        try:
+            qualities[name] = float(q[2:]) if q.startswith("q=") else 1.0
+        except ValueError:
+            qualities[name] = 0.0
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
 
 
 @server.on_event("startup")
-def load_server_config():
+async def load_server_config():
     '''Load the config for the server with static pre-rendered tiles'''
-    global storage
+    global async_storage
     global tilesets
+    global cache
     # Because the DB connection variables are passed as standard PG* vars,
-    # a plain ConnectionPool() will connect to the right DB
-    pool = psycopg_pool.ConnectionPool(min_size=1, max_size=1)
+    # a plain ConnectionPool() will connect to the right DB. This is only used to
+    # load the tilesets, as tiles are read with async_storage.
+    with psycopg_pool.NullConnectionPool() as pool:
+        storage = Storage(pool)
+        # Storage made by an older version is missing columns which tiles are read with
+        storage.upgrade_schema()
+        for tileset in storage.get_tilesets():
+            tilesets[tileset.id] = tileset
+
+    # Tiles are read with asyncio so one worker can have many reads in flight
+    pool_size = int(os.environ.get(TILEKILN_STORAGE_POOL_SIZE, DEFAULT_STORAGE_POOL_SIZE))
+    async_pool = psycopg_pool.AsyncConnectionPool(min_size=1, max_size=pool_size, open=False)
+    await async_pool.open()
+    async_storage = AsyncStorage(async_pool)
+    cache = load_cache({})
+
 
-    storage = Storage(pool)
-    for tileset in storage.get_tilesets():
-        tilesets[tileset.id] = tileset
+@server.on_event("shutdown")
+async def close_server_pool():
+    global async_storage
+    await async_storage.close()
 
 
 @live.on_event("startup")
@@ -60,6 +284,7 @@ def load_live_config():
     global config
     global storage
     global tilesets
+    global cache
     config = tilekiln.load_config(os.environ[TILEKILN_CONFIG])
 
     generate_args = {}
@@ -70,7 +295,7 @@ def load_live_config():
     if "GENERATE_PGPORT" in os.environ:
         generate_args["port"] = os.environ["GENERATE_PGPORT"]
     if "GENERATE_PGUSER" in os.environ:
-        generate_args["username"] = os.environ["GENERATE_PGUSER"]
+        generate_args["user"] = os.environ["GENERATE_PGUSER"]
 
     storage_args = {}
     if "STORAGE_PGDATABASE" in os.environ:
@@ -80,16 +305,39 @@ def load_live_config():
     if "STORAGE_PGPORT" in os.environ:
         storage_args["port"] = os.environ["STORAGE_PGPORT"]
     if "STORAGE_PGUSER" in os.environ:
-        storage_args["username"] = os.environ["STORAGE_PGUSER"]
+        storage_args["user"] = os.environ["STORAGE_PGUSER"]
 
-    storage_pool = psycopg_pool.ConnectionPool(min_size=1, max_size=1, kwargs=storage_args)
+    # Each render in progress holds a connection for its lock, so there need to be
+    # more connections than that
+    pool_size = int(os.environ.get(TILEKILN_STORAGE_POOL_SIZE, DEFAULT_STORAGE_POOL_SIZE))
+    storage_pool = psycopg_pool.ConnectionPool(min_size=1, max_size=pool_size,
+                                               kwargs=storage_args)
     storage = Storage(storage_pool)
+    storage.upgrade_schema()
+    cache = load_cache(storage_args)
 
     # Storing the tileset in the dict allows some commonalities in code later
     tilesets[config.id] = Tileset.from_config(storage, config)
-    conn = psycopg.connect(**generate_args)
-    global kiln
-    kiln = Kiln(config, conn)
+    global kilns
+    kilns = load_kilns(config, generate_args, render_stats)
+    REGISTRY.register(KilnPoolCollector(kilns))
+    save_render_stats_periodically(render_stats, storage)
+
+    global writer
+    write_queue_size = int(os.environ.get(TILEKILN_WRITE_QUEUE_SIZE, 0))
+    if write_queue_size > 0:
+        writer = TileWriter(storage, write_queue_size,
+                            os.environ.get(TILEKILN_WRITE_QUEUE_POLICY, BLOCK))
+        REGISTRY.register(WriterCollector(writer))
+
+
+@live.on_event("shutdown")
+def close_live_writer():
+    global writer
+    global storage
+    if writer is not None:
+        writer.close()
+    save_render_stats(render_stats, storage)
 
 
 @server.head("/")
@@ -116,46 +364,180 @@ def tilejson(prefix: str):
     global tilesets
     if prefix not in tilesets:
         raise HTTPException(status_code=404, detail=f'''Tileset {prefix} not found on server.''')
-    return Response(content=change_tilejson_url(tilesets[prefix].tilejson,
-                                                os.environ[TILEKILN_URL] + f"/{prefix}"),
+    return Response(content=tilesets[prefix].get_tilejson(os.environ[TILEKILN_URL] + f"/{prefix}"),
                     media_type="application/json",
                     headers=STANDARD_HEADERS)
 
 
 @server.head("/{prefix}/{zoom}/{x}/{y}.mvt")
 @server.get("/{prefix}/{zoom}/{x}/{y}.mvt")
-def serve_tile(prefix: str, zoom: int, x: int, y: int):
+async def serve_tile(prefix: str, zoom: int, x: int, y: int,
+                     accept_encoding: str | None = Header(None),
+                     if_none_match: str | None = Header(None)):
     global tilesets
     if prefix not in tilesets:
         raise HTTPException(status_code=404, detail=f"Tileset {prefix} not found on server.")
 
-    return Response(tilesets[prefix].get_tile(Tile(zoom, x, y)),
-                    media_type=MVT_MIME_TYPE,
+    global async_storage
+    global cache
+    tile = Tile(zoom, x, y)
+    cache_control = tilesets[prefix].get_cache_control(zoom)
+    cached = cache.get(prefix, tile) if cache is not None else None
+
+    # Conditional requests only need the hash, not the tile
+    if if_none_match is not None:
+        if cached is not None:
+            hash = cached[1]
+        else:
+            hash = await async_storage.get_tile_hash(prefix, tile)
+        if hash is not None and etag_matches(if_none_match, hash):
+            return not_modified_response(hash, accept_encoding, cache_control)
+
+    # Tiles are read and cached as stored, since most clients accept gzip
+    if cached is not None:
+        return tile_response(cached[0], True, accept_encoding, cached[1], cache_control)
+    generation = cache.generation if cache is not None else None
+    stored = await async_storage.get_stored_tile(prefix, tile)
+    if stored is None:
+        return tile_response(None)
+    if cache is not None:
+        cache.put(prefix, tile, stored[0], stored[1], generation)
+    return tile_response(stored[0], True, accept_encoding, stored[1], cache_control)
+
+
+@server.post("/{prefix}/tiles")
+async def serve_tiles(prefix: str, tiles: list[str] = Body()):
+    '''Serve many tiles in one response, for cache warmers and prefetching clients
+
+    The body is a JSON array of tiles as "zoom/x/y". The response has the tiles in the
+    same order, joined with pack_tiles. Tiles are decompressed.
+    '''
+    global tilesets
+    if prefix not in tilesets:
+        raise HTTPException(status_code=404, detail=f"Tileset {prefix} not found on server.")
+    if len(tiles) > MAX_BATCH_TILES:
+        raise HTTPException(status_code=413,
+                            detail=f"At most {MAX_BATCH_TILES} tiles can be requested at once.")
+    try:
+        requested = [Tile.from_string(tile) for tile in tiles]
+    except (AssertionError, IndexError, ValueError):
+        raise HTTPException(status_code=400, detail="Tiles must be zoom/x/y.")
+
+    global async_storage
+    global cache
+    results: list[bytes | None] = [None] * len(requested)
+    missed = []
+    for i, tile in enumerate(requested):
+        cached = cache.get(prefix, tile) if cache is not None else None
+        if cached is not None:
+            results[i] = cached[0]
+        else:
+            missed.append(i)
+
+    if missed:
+        generation = cache.generation if cache is not None else None
+        stored = await async_storage.get_tiles(prefix, [requested[i] for i in missed])
+        for i, result in zip(missed, stored):
+            if result is None:
+                continue
+            results[i] = result[0]
+            if cache is not None:
+                cache.put(prefix, requested[i], result[0], result[1], generation)
+
+    return Response(pack_tiles(None if tile is None else decompress_tile(tile)
+                               for tile in results),
+                    media_type=TILES_MIME_TYPE,
                     headers=STANDARD_HEADERS)
 
 
 @live.head("/{prefix}/{zoom}/{x}/{y}.mvt")
 @live.get("/{prefix}/{zoom}/{x}/{y}.mvt")
-def live_serve_tile(prefix: str, zoom: int, x: int, y:  int):
+def live_serve_tile(prefix: str, zoom: int, x: int, y:  int,
+                    accept_encoding: str | None = Header(None),
+                    if_none_match: str | None = Header(None)):
     global tilesets
     if prefix not in tilesets:
         raise HTTPException(status_code=404, detail=f"Tileset {prefix} not found on server.")
 
+    global cache
+    tile = Tile(zoom, x, y)
+    cache_control = tilesets[prefix].get_cache_control(zoom)
+    cached = cache.get(prefix, tile) if cache is not None else None
+
+    # Conditional requests only need the hash, not the tile
+    if if_none_match is not None:
+        if cached is not None:
+            hash = cached[1]
+        else:
+            hash = tilesets[prefix].get_tile_hash(tile)
+        if hash is not None and etag_matches(if_none_match, hash):
+            return not_modified_response(hash, accept_encoding, cache_control)
+
+    if cached is not None:
+        return tile_response(cached[0], True, accept_encoding, cached[1], cache_control)
+    generation = cache.generation if cache is not None else None
+
+    # Tiles waiting to be saved are newer than any in storage
+    global writer
+    if writer is not None:
+        pending = writer.get_pending(prefix, tile)
+        if pending is not None:
+            return tile_response(pending, False, accept_encoding,
+                                 hashlib.sha256(pending).digest(), cache_control)
+
     # Attempt to serve a stored tile
-    existing = tilesets[prefix].get_tile(Tile(zoom, x, y))
+    stored = tilesets[prefix].get_stored_tile(tile)
 
     # Handle storage hits
-    if existing is not None:
-        return Response(existing,
-                        media_type=MVT_MIME_TYPE,
-                        headers=STANDARD_HEADERS)
-
-    # Storage miss, so generate a new tile
-    global kiln
-    tile = Tile(zoom, x, y)
-    generated = kiln.render(tile)
-    # TODO: Make async so tile is saved and response returned in parallel
-    tilesets[prefix].save_tile(tile, generated)
-    return Response(generated,
-                    media_type=MVT_MIME_TYPE,
-                    headers=STANDARD_HEADERS)
+    if stored is not None:
+        if cache is not None:
+            cache.put(prefix, tile, stored[0], stored[1], generation)
+        return tile_response(stored[0], True, accept_encoding, stored[1], cache_control)
+
+    # Storage miss, so generate a new tile. It isn't cached here because saving it
+    # invalidates it, and it will be cached when it is next read from storage.
+    # Concurrent misses for tiles of the same metatile in this worker wait for one
+    # render, and other workers wait on a lock in storage.
+    metatile = Metatile.from_tile(tile, int(os.environ.get(TILEKILN_METATILE_SIZE, 1)))
+    try:
+        rendered = render_flight.do((prefix, metatile.zoom, metatile.x, metatile.y,
+                                     metatile.size),
+                                    lambda: render_missing_metatile(tilesets[prefix], tile,
+                                                                    metatile))
+        # The render waited on found its own tile in storage, but not this one
+        if (x, y) not in rendered:
+            rendered = render_missing_metatile(tilesets[prefix], tile, metatile)
+    except KilnPoolFull as e:
+        raise overloaded_exception(e)
+    generated, hash = rendered[(x, y)]
+    return tile_response(generated, False, accept_encoding, hash, cache_control)
+
+
+def render_missing_metatile(tileset: Tileset, tile: Tile,
+                            metatile: Metatile) -> dict[tuple[int, int], tuple[bytes, bytes]]:
+    '''Render and save a metatile with a tile missing from storage
+
+    Returns the tiles of the metatile and their hashes by x and y. If another process
+    saved the tile while waiting for the lock on the metatile, the saved tiles are
+    returned without rendering. Raises KilnPoolFull if too many renders are already
+    waiting for a kiln.
+    '''
+    global kilns
+    global writer
+    # With a writer, tiles are saved in the background instead of before responding,
+    # so they are looked for in the writer after taking the lock
+    save = None
+    pending = None
+    if writer is not None:
+        save = partial(writer.put, tileset.id)
+        pending = partial(writer.get_pending, tileset.id)
+
+    # The kiln is only taken once the lock is held and the tile is still missing, so
+    # renders waiting for the lock don't hold kilns
+    def render() -> list[tuple[Tile, bytes]]:
+        with kilns.kiln() as kiln:
+            if metatile.size == 1:
+                return [(tile, kiln.render(tile))]
+            return kiln.render_metatile(metatile)
+
+    return tileset.get_or_render_metatile(tile, metatile, render, save, pending)
@@ -0,0 +1,50 @@
+import threading
+from collections.abc import Callable, Hashable
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class _Call(Generic[T]):
+    '''A call in progress, which other callers can wait on for the result'''
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: T
+        self.error: BaseException | None = None
+
+
+class SingleFlight(Generic[T]):
+    '''
+    Runs at most one call at a time for each key
+
+    Threads which call with a key that already has a call in progress wait for it
+    and get the same result, or exception, instead of calling again.
+    '''
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__calls: dict[Hashable, _Call[T]] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if call is None:
+                call = _Call()
+                self.__calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call.done.set()
+        return call.result
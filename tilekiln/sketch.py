@@ -0,0 +1,94 @@
+import math
+from collections.abc import Iterable, Sequence
+
+# Tile sizes are counted in buckets which each cover sizes SIZE_GAMMA times bigger
+# than the last, so sizes estimated from a sketch are within SIZE_ACCURACY of the
+# real size. Changing this needs the histograms in storage rebuilding.
+SIZE_ACCURACY = 0.01
+SIZE_GAMMA = (1 + SIZE_ACCURACY) / (1 - SIZE_ACCURACY)
+
+# Quantiles of tile sizes kept in the tile stats by default.
+# Lower quantiles are typically not interesting, because generally the
+# smallest 50% of tiles are identical water tiles or something similarly
+# sparse. Where the data gets interesting is p95 and above.
+QUANTILES = (0.0, 0.25, 0.50, 0.75, 0.90, 0.95, 0.99, 0.999, 1.0)
+
+
+def size_bucket(size: int) -> int:
+    '''Returns the bucket for a tile size, matching tilekiln_size_bucket in SQL
+
+    Empty tiles are bucket 0, and bucket n covers sizes above SIZE_GAMMA ** (n - 2) up to
+    SIZE_GAMMA ** (n - 1).
+    '''
+    if size == 0:
+        return 0
+    return math.ceil(math.log(size) / math.log(SIZE_GAMMA)) + 1
+
+
+def bucket_size(bucket: int) -> float:
+    '''Returns the size representing a bucket, within SIZE_ACCURACY of any size in it'''
+    if bucket == 0:
+        return 0.0
+    return 2 * SIZE_GAMMA ** (bucket - 1) / (SIZE_GAMMA + 1)
+
+
+class SizeSketch:
+    '''
+    A sketch of tile sizes, for estimating quantiles of them
+
+    This counts the number of tiles in each size bucket, so any quantile can be
+    estimated to within SIZE_ACCURACY of the real size, however many tiles there are.
+    Sketches are merged by adding their counts, which is how storage keeps one for each
+    tileset and zoom without reading the tiles.
+    '''
+    def __init__(self, buckets: Iterable[tuple[int, int]] = ()):
+        self.__buckets: dict[int, int] = {}
+        for bucket, num_tiles in buckets:
+            self.add_bucket(bucket, num_tiles)
+
+    @property
+    def count(self) -> int:
+        '''The number of tiles in the sketch'''
+        return sum(self.__buckets.values())
+
+    def buckets(self) -> list[tuple[int, int]]:
+        '''The bucket and number of tiles of each bucket with tiles, in bucket order'''
+        return sorted(self.__buckets.items())
+
+    def add(self, size: int, num_tiles: int = 1) -> None:
+        '''Add tiles of a size, or remove them if num_tiles is negative'''
+        self.add_bucket(size_bucket(size), num_tiles)
+
+    def add_bucket(self, bucket: int, num_tiles: int) -> None:
+        '''Add tiles to a bucket, or remove them if num_tiles is negative'''
+        num_tiles += self.__buckets.get(bucket, 0)
+        if num_tiles > 0:
+            self.__buckets[bucket] = num_tiles
+        else:
+            self.__buckets.pop(bucket, None)
+
+    def merge(self, other: "SizeSketch") -> None:
+        '''Add the tiles in another sketch to this one'''
+        for bucket, num_tiles in other.buckets():
+            self.add_bucket(bucket, num_tiles)
+
+    def quantile(self, quantile: float) -> float:
+        '''Estimate a quantile of the tile sizes, or 0 if there are no tiles'''
+        return self.quantiles([quantile])[0]
+
+    def quantiles(self, quantiles: Sequence[float]) -> list[float]:
+        '''Estimate quantiles of the tile sizes, each by nearest rank'''
+        buckets = self.buckets()
+        total = sum(num_tiles for _, num_tiles in buckets)
+        results = []
+        for quantile in quantiles:
+            rank = quantile * (total - 1)
+            seen = 0
+            result = 0.0
+            for bucket, num_tiles in buckets:
+                seen += num_tiles
+                if seen > rank:
+                    result = bucket_size(bucket)
+                    break
+            results.append(result)
+        return results
@@ -0,0 +1,98 @@
+import bisect
+import threading
+import time
+from collections.abc import Iterable
+
+import click
+
+from tilekiln.metric import RenderStat
+from tilekiln.storage import Storage
+
+# Upper bounds in seconds of the buckets render times are counted in
+RENDER_TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Seconds between saving render stats to storage
+RENDER_STATS_FLUSH_INTERVAL = 10
+
+StatKey = tuple[str, int, str]
+
+
+class RenderStats:
+    '''
+    Counts of tiles rendered and the time they took, by tileset, zoom and layer
+
+    Stats are counted in memory as tiles are rendered, and taken in batches to be
+    saved to storage, where they are added to the stats saved by other processes.
+    This is safe to use from multiple threads.
+    '''
+    def __init__(self):
+        self.__stats: dict[StatKey, RenderStat] = {}
+        self.__lock = threading.Lock()
+
+    def record(self, id: str, zoom: int, num_tiles: int, seconds: float,
+               layers: Iterable[tuple[str, float]] = ()) -> None:
+        '''Count a render of num_tiles tiles, and the seconds it and each layer took
+
+        A metatile is one render of many tiles, with the time of the whole metatile.
+        '''
+        with self.__lock:
+            self.__add(id, zoom, '', num_tiles, seconds)
+            for layer, layer_seconds in layers:
+                self.__add(id, zoom, layer, num_tiles, layer_seconds)
+
+    def take(self) -> list[RenderStat]:
+        '''Returns the stats counted since they were last taken, and resets them'''
+        with self.__lock:
+            stats = list(self.__stats.values())
+            self.__stats = {}
+        return stats
+
+    def merge(self, stats: Iterable[RenderStat]) -> None:
+        '''Add stats back, such as ones which could not be saved'''
+        with self.__lock:
+            for stat in stats:
+                self.__merge(stat)
+
+    def __add(self, id: str, zoom: int, layer: str, num_tiles: int, seconds: float) -> None:
+        buckets = [0] * (len(RENDER_TIME_BUCKETS) + 1)
+        buckets[bisect.bisect_left(RENDER_TIME_BUCKETS, seconds)] = 1
+        self.__merge(RenderStat(id=id, zoom=zoom, layer=layer, num_rendered=num_tiles,
+                                time_rendered=seconds, buckets=buckets))
+
+    def __merge(self, stat: RenderStat) -> None:
+        key = (stat.id, stat.zoom, stat.layer)
+        existing = self.__stats.get(key)
+        if existing is not None:
+            stat = RenderStat(id=stat.id, zoom=stat.zoom, layer=stat.layer,
+                              num_rendered=existing.num_rendered + stat.num_rendered,
+                              time_rendered=existing.time_rendered + stat.time_rendered,
+                              buckets=[a + b for a, b in zip(existing.buckets, stat.buckets)])
+        self.__stats[key] = stat
+
+
+def save_render_stats(stats: RenderStats, storage: Storage) -> None:
+    '''Save the stats counted since they were last saved
+
+    If saving fails, the stats are kept to be saved next time.
+    '''
+    taken = stats.take()
+    if not taken:
+        return
+    try:
+        storage.save_render_stats(taken)
+    except Exception as e:
+        stats.merge(taken)
+        click.echo(f"Failed to save render stats: {e}", err=True)
+
+
+def save_render_stats_periodically(stats: RenderStats, storage: Storage,
+                                   interval: float = RENDER_STATS_FLUSH_INTERVAL
+                                   ) -> threading.Thread:
+    '''Start a thread which saves render stats to storage every interval seconds'''
+    def save():
+        while True:
+            time.sleep(interval)
+            save_render_stats(stats, storage)
+
+    thread = threading.Thread(target=save, daemon=True, name="tilekiln-render-stats")
+    thread.start()
+    return thread
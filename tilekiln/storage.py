@@ -1,24 +1,89 @@
 import gzip
+import hashlib
 import json
 import sys
-from collections.abc import Iterator
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from contextlib import contextmanager
 
 import click
 import psycopg.rows
-from psycopg_pool import ConnectionPool
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
 
-from tilekiln.metric import Metric
-from tilekiln.tile import Tile
+from tilekiln.metric import BlobMetric, Metric, RenderStat
+from tilekiln.sketch import QUANTILES, SIZE_GAMMA, SizeSketch
+from tilekiln.tile import Metatile, Tile, lonlat_to_xy
 from tilekiln.tileset import Tileset
 
 METADATA_TABLE = "metadata"
+# Version of the storage schema, for finding storage made by an older version
+SCHEMA_VERSION_TABLE = "schema_version"
+# Increase this when create_schema changes existing storage
+SCHEMA_VERSION = 1
 GENERATE_STATS_TABLE = "generate_stats"
 TILE_STATS_TABLE = "tile_stats"
+# Number and total size of tiles in each size bucket, by tileset and zoom
+SIZE_HISTOGRAM_TABLE = "tile_size_histogram"
+# Changes to the size histogram from writes, which are added into it when metrics
+# are updated. Writers append to this instead of updating the histogram, so they
+# don't contend for the same rows.
+SIZE_DELTAS_TABLE = "tile_size_deltas"
+# Number and total size of the blobs of each deduplicated tileset, and the changes to
+# them from writes, which are added in the same way as the size histogram deltas
+BLOB_SIZES_TABLE = "tile_blob_sizes"
+BLOB_SIZE_DELTAS_TABLE = "tile_blob_size_deltas"
+# Temporary table used to COPY tiles into before writing them to storage
+STAGING_TABLE = "tilekiln_staging"
 
-# Lower percentiles are typically not interesting, because generally the
-# smallest 50% of tiles are identical water tiles or something similarly
-# sparse. Where the data gets interesting is p95 and above.
-PERCENTILES = [0.0, 0.25, 0.50, 0.75, 0.90, 0.95, 0.99, 0.999, 1.0]
+# Number of tiles written and committed at once by save_tiles
+SAVE_BATCH_SIZE = 1000
+# Number of tiles deleted at once by delete_tiles
+DELETE_BATCH_SIZE = 10000
+# Number of tiles fetched at once by export_tiles
+EXPORT_FETCH_SIZE = 10000
+
+# Channel notified with the tiles changed by each transaction, for caches to listen on
+NOTIFY_CHANNEL = "tilekiln_tiles"
+# Above this many tiles changed at a zoom, one notification is sent for the entire zoom.
+# This is at least SAVE_BATCH_SIZE so saving a full batch notifies the tiles it changed
+# instead of the whole zoom, which would empty caches of the zoom during generate.
+NOTIFY_TILE_LIMIT = SAVE_BATCH_SIZE
+
+# Statements which change tiles, and the transition tables their size triggers get
+SIZE_TRIGGER_EVENTS = {"INSERT": "NEW TABLE AS new_tiles",
+                       "UPDATE": "OLD TABLE AS old_tiles NEW TABLE AS new_tiles",
+                       "DELETE": "OLD TABLE AS old_tiles"}
+# Statements which change blobs, and the transition tables their size triggers get.
+# Blobs are never changed once written, only added and removed.
+BLOB_TRIGGER_EVENTS = {"INSERT": "NEW TABLE AS changed_blobs",
+                       "DELETE": "OLD TABLE AS changed_blobs"}
+
+
+def compress_tile(tiledata: bytes) -> bytes:
+    '''Compress a tile for storage
+
+    Empty tiles are stored as zero bytes rather than as a gzip of nothing, which
+    lets them be recognized without decompressing.
+    '''
+    if not tiledata:
+        return b''
+    return gzip.compress(tiledata, mtime=0)
+
+
+def decompress_tile(data: bytes) -> bytes:
+    '''Decompress a tile from storage'''
+    if not data:
+        return b''
+    return gzip.decompress(data)
+
+
+def coordinates_by_zoom(tiles: Iterable[Tile]) -> dict[int, tuple[list[int], list[int]]]:
+    '''Group tiles by zoom, as lists of x and y to pass as arrays to a query'''
+    zooms: dict[int, tuple[list[int], list[int]]] = {}
+    for tile in tiles:
+        xs, ys = zooms.setdefault(tile.zoom, ([], []))
+        xs.append(tile.x)
+        ys.append(tile.y)
+    return zooms
 
 
 class Storage:
@@ -31,31 +96,81 @@ class Storage:
     def __init__(self, dbpool: ConnectionPool, schema="tilekiln"):
         self.__pool = dbpool
         self.__schema = schema
+        # If each tileset is deduplicated, as it is looked up. This can't change once
+        # a tileset is created.
+        self.__deduplicated: dict[str, bool] = {}
+        # Tilesets by ID, loaded from the metadata table when first needed and again
+        # by refresh_metadata. None when they need loading.
+        self.__tilesets: dict[str, Tileset] | None = None
 
     '''
     Methods that manipulate schema-related stuff and don't involve any tiles
     '''
     def create_schema(self) -> None:
+        '''Create the storage schema, or bring storage made by an older version up to date
+
+        This does not create or change any tileset's metadata.
+        '''
         with self.__pool.connection() as conn:
             with conn.cursor() as cur:
+                # Processes upgrading at once wait for each other. The lock is released
+                # when the transaction ends.
+                cur.execute('''SELECT pg_advisory_xact_lock(hashtext(%s))''',
+                            (f"{self.__schema}/schema",))
                 # Perform one-time setup using CREATE ... IF NOT EXISTS
                 # This is safe to rerun multiple times
                 cur.execute(f'''CREATE SCHEMA IF NOT EXISTS "{self.__schema}"''')
                 self.__setup_stats(cur)
                 self.__setup_metadata(cur)
+                self.__upgrade_tables(cur)
+                cur.execute(f'''CREATE TABLE IF NOT EXISTS
+                                "{self.__schema}"."{SCHEMA_VERSION_TABLE}" (
+                                version integer NOT NULL)''')
+                cur.execute(f'''DELETE FROM "{self.__schema}"."{SCHEMA_VERSION_TABLE}"''')
+                cur.execute(f'''INSERT INTO "{self.__schema}"."{SCHEMA_VERSION_TABLE}" (version)
+                                VALUES (%s)''', (SCHEMA_VERSION,))
                 conn.commit()
 
+    def upgrade_schema(self) -> bool:
+        '''Upgrade storage made by an older version, returning if it needed upgrading
+
+        Up to date storage is only read, so this is cheap enough to run whenever
+        storage is opened.
+        '''
+        with self.__read_only_cursor() as cur:
+            cur.execute('''SELECT to_regclass(format('%%I.%%I', %s::text, %s::text))''',
+                        (self.__schema, SCHEMA_VERSION_TABLE))
+            version = None
+            if cur.fetchall() != [(None,)]:
+                cur.execute(f'''SELECT version
+                                FROM "{self.__schema}"."{SCHEMA_VERSION_TABLE}"''')
+                version = max((record[0] for record in cur.fetchall()), default=None)
+        if version is not None and version >= SCHEMA_VERSION:
+            return False
+        self.create_schema()
+        return True
+
     '''
     Methods for tilesets
     '''
-    def create_tileset(self, id: str, minzoom: int, maxzoom: int, tilejson: str) -> None:
+    def create_tileset(self, id: str, minzoom: int, maxzoom: int, tilejson: str,
+                       deduplicate: bool = False,
+                       cache_control: dict[int, str] | None = None) -> None:
+        '''Create the tables for a tileset
+
+        If deduplicate is set, each distinct tile is stored once in a blob table
+        keyed by its hash, and the tileset tables reference it by hash.
+        '''
         with self.__pool.connection() as conn:
             with conn.cursor() as cur:
-                self.__set_metadata(cur, id, minzoom, maxzoom, tilejson)
+                self.__set_metadata(cur, id, minzoom, maxzoom, tilejson, cache_control,
+                                    deduplicate)
 
-                self.__setup_tables(cur, id, minzoom, maxzoom)
+                self.__setup_tables(cur, id, minzoom, maxzoom, deduplicate)
 
                 conn.commit()
+        self.__deduplicated[id] = deduplicate
+        self.__tilesets = None
 
     def remove_tileset(self, id: str) -> None:
         with self.__pool.connection() as conn:
@@ -63,56 +178,121 @@ class Storage:
                 cur.execute(f'''DELETE FROM "{self.__schema}"."{METADATA_TABLE}" WHERE id = %s''',
                             (id,))
                 cur.execute(f'''DROP TABLE "{self.__schema}"."{id}" CASCADE''')
-                cur.execute(f'''DELETE FROM "{self.__schema}"."{TILE_STATS_TABLE}" WHERE id = %s''',
-                            (id,))
+                cur.execute(f'''DROP TABLE IF EXISTS "{self.__schema}"."{id}_blobs"''')
+                for table in (TILE_STATS_TABLE, SIZE_DELTAS_TABLE, SIZE_HISTOGRAM_TABLE,
+                              BLOB_SIZE_DELTAS_TABLE, BLOB_SIZES_TABLE, GENERATE_STATS_TABLE):
+                    cur.execute(f'''DELETE FROM "{self.__schema}"."{table}" WHERE id = %s''',
+                                (id,))
+                self.__notify(cur, id)
                 conn.commit()
+        self.__deduplicated.pop(id, None)
+        self.__tilesets = None
 
     def get_tilesets(self) -> Iterator[Tileset]:
         '''
         Gets all tilesets in the storage
         '''
-        with self.__pool.connection() as conn:
-            conn.read_only = True
-            with conn.cursor(row_factory=psycopg.rows.dict_row) as cur:
-                cur.execute(f'''SELECT id, minzoom, maxzoom, tilejson
-                             FROM "{self.__schema}"."{METADATA_TABLE}"''')
-                for record in cur:
-                    yield Tileset(self, record["id"], record["minzoom"], record["maxzoom"],
-                                  json.dumps(record["tilejson"]))
+        return iter(list(self.__get_metadata().values()))
 
     def get_tileset_ids(self) -> Iterator[str]:
         '''
         Get only the tileset IDs
         '''
-        with self.__pool.connection() as conn:
-            conn.read_only = True
-            with conn.cursor(row_factory=psycopg.rows.dict_row) as cur:
-                cur.execute(f'''SELECT id
-                             FROM "{self.__schema}"."{METADATA_TABLE}"''')
-                for record in cur:
-                    yield record["id"]
+        return iter(list(self.__get_metadata()))
+
+    def get_tileset(self, id: str) -> Tileset:
+        '''Gets a tileset in the storage, raising KeyError if it does not exist
+
+        Metadata is reloaded if the tileset has been created since it was loaded.
+        '''
+        tileset = self.__get_metadata().get(id)
+        if tileset is None:
+            self.refresh_metadata()
+            tileset = self.__get_metadata().get(id)
+        if tileset is None:
+            raise KeyError(f"Tileset {id} does not exist in storage")
+        return tileset
+
+    def refresh_metadata(self) -> None:
+        '''Reload the metadata of all tilesets, for if it has been changed elsewhere'''
+        with self.__read_only_cursor(row_factory=psycopg.rows.dict_row) as cur:
+            self.__read_metadata(cur)
 
     ''' Methods for metrics'''
     def metrics(self) -> Iterator[Metric]:
-        with self.__pool.connection() as conn:
-            conn.read_only = True
-            with conn.cursor(row_factory=psycopg.rows.class_row(Metric)) as cur:
-                cur.execute(f'''SELECT id, zoom, num_tiles, size, percentiles
-                             FROM "{self.__schema}"."{TILE_STATS_TABLE}"''')
-                for record in cur:
-                    yield record
-
-    def update_metrics(self) -> None:
+        with self.__read_only_cursor(row_factory=psycopg.rows.class_row(Metric)) as cur:
+            cur.execute(f'''SELECT id, zoom, num_tiles, size, physical_size, percentiles
+                         FROM "{self.__schema}"."{TILE_STATS_TABLE}"''')
+            yield from cur
+
+    def blob_metrics(self) -> Iterator[BlobMetric]:
+        '''Gets the number and size of the blobs of deduplicated tilesets, as of the last
+           update_metrics
+        '''
+        with self.__read_only_cursor(row_factory=psycopg.rows.class_row(BlobMetric)) as cur:
+            cur.execute(f'''SELECT id, num_blobs, size
+                         FROM "{self.__schema}"."{BLOB_SIZES_TABLE}"''')
+            yield from cur
+
+    def render_stats(self) -> Iterator[RenderStat]:
+        '''Gets the number of tiles rendered and the time they took, by tileset, zoom
+           and layer
+        '''
+        with self.__read_only_cursor(row_factory=psycopg.rows.class_row(RenderStat)) as cur:
+            cur.execute(f'''SELECT id, zoom, layer, num_rendered, time_rendered, buckets
+                         FROM "{self.__schema}"."{GENERATE_STATS_TABLE}"''')
+            yield from cur
+
+    def save_render_stats(self, stats: Iterable[RenderStat]) -> None:
+        '''Add render stats counted by a process to the stats in storage'''
+        # Rows are written in key order, so processes saving at once can't deadlock
+        rows = sorted(stats, key=lambda stat: (stat.id, stat.zoom, stat.layer))
         with self.__pool.connection() as conn:
             with conn.cursor() as cur:
-                for id in self.get_tileset_ids():
-                    minzoom = self.get_minzoom(id)
-                    maxzoom = self.get_maxzoom(id)
-                    self.__update_tileset_metrics(cur, id, minzoom, maxzoom)
+                cur.executemany(f'''INSERT INTO "{self.__schema}"."{GENERATE_STATS_TABLE}" AS g
+                                        (id, zoom, layer, num_rendered, time_rendered, buckets)
+                                    VALUES (%s, %s, %s, %s, %s, %s)
+                                    ON CONFLICT (id, zoom, layer)
+                                    DO UPDATE SET
+                                        num_rendered = g.num_rendered + EXCLUDED.num_rendered,
+                                        time_rendered = g.time_rendered + EXCLUDED.time_rendered,
+                                        buckets = ARRAY(
+                                            SELECT COALESCE(a, 0) + COALESCE(b, 0)
+                                            FROM unnest(g.buckets, EXCLUDED.buckets) AS u(a, b))
+                                ''',
+                                [(stat.id, stat.zoom, stat.layer, stat.num_rendered,
+                                  stat.time_rendered, stat.buckets) for stat in rows])
+                conn.commit()
+
+    def update_metrics(self, quantiles: Sequence[float] = QUANTILES) -> None:
+        '''Update the tile stats from the size histograms
+
+        Changes to the histograms and blob sizes since the last update are added in
+        first. This only reads the histograms, not the tiles. The histograms are sketches
+        of the tile sizes, so the quantiles can be any between 0 and 1.
+        '''
+        with self.__pool.connection() as conn:
+            with conn.cursor(row_factory=psycopg.rows.dict_row) as cur:
+                # This also refreshes the metadata, so it stays up to date in a long
+                # running process
+                tilesets = self.__read_metadata(cur)
+                self.__apply_size_deltas(cur)
+                sketches: dict[tuple[str, int], SizeSketch] = {}
+                sizes: dict[tuple[str, int], int] = {}
+                cur.execute(f'''SELECT id, zoom, bucket, num_tiles, size
+                                FROM "{self.__schema}"."{SIZE_HISTOGRAM_TABLE}"''')
+                for record in cur.fetchall():
+                    key = (record["id"], record["zoom"])
+                    sketches.setdefault(key, SizeSketch()).add_bucket(record["bucket"],
+                                                                      record["num_tiles"])
+                    sizes[key] = sizes.get(key, 0) + record["size"]
+                for tileset in tilesets.values():
+                    self.__update_tileset_metrics(cur, tileset.id, tileset.minzoom,
+                                                  tileset.maxzoom, sketches, sizes, quantiles)
                 conn.commit()
 
     '''Methods that set/get metadata'''
-    def set_metadata(self, id, minzoom, maxzoom, tilejson):
+    def set_metadata(self, id, minzoom, maxzoom, tilejson, cache_control=None):
         '''
         Saves metadata into storage
 
@@ -120,73 +300,83 @@ class Storage:
         '''
         with self.__pool.connection() as conn:
             with conn.cursor() as cur:
-                self.__set_metadata(cur, id, minzoom, maxzoom, tilejson)
+                self.__set_metadata(cur, id, minzoom, maxzoom, tilejson, cache_control)
                 conn.commit()
+        self.__tilesets = None
 
-    # TODO: Should the various get_* functions be separate? The query has to fetch from the
-    # DB each time, but only tilejson needs URL. Not an urgent issue.
     def get_tilejson(self, id, url) -> str:
         '''Gets the tilejson for a layer from storage.'''
-        with self.__pool.connection() as conn:
-            conn.read_only = True
-            with conn.cursor(row_factory=psycopg.rows.dict_row) as cur:
-                cur.execute(f'''SELECT tilejson
-                                FROM "{self.__schema}"."{METADATA_TABLE}"
-                                WHERE id = %s''', (id,))
-                result = cur.fetchone()
-                if result is None:
-                    # TODO: raise exception and handle it at the calling level
-                    click.echo(f"Failed to retrieve tilejson for id {id}, "
-                               f"does it exist in storage DB?",
-                               err=True)
-                    sys.exit(1)
-                tilejson = result["tilejson"]
-                tilejson["tiles"] = [f"{url}" + "/{z}/{x}/{y}.mvt"]
-                return json.dumps(tilejson)
+        return self.__get_tileset_or_exit(id, "tilejson").get_tilejson(url).decode()
 
     def get_minzoom(self, id):
         '''Gets the minzoom for a layer from storage.'''
-        with self.__pool.connection() as conn:
-            conn.read_only = True
-            with conn.cursor(row_factory=psycopg.rows.dict_row) as cur:
-                cur.execute(f'''SELECT minzoom
-                                FROM "{self.__schema}"."{METADATA_TABLE}"
-                                WHERE id = %s''', (id,))
-                result = cur.fetchone()
-                if result is None:
-                    # TODO: raise exception and handle it at the calling level
-                    click.echo(f"Failed to retrieve minzoom for id {id}, "
-                               f"does it exist in storage DB?",
-                               err=True)
-                    sys.exit(1)
-                return result["minzoom"]
+        return self.__get_tileset_or_exit(id, "minzoom").minzoom
 
     def get_maxzoom(self, id):
-        '''Gets the minzoom for a layer from storage.'''
-        with self.__pool.connection() as conn:
-            conn.read_only = True
-            with conn.cursor(row_factory=psycopg.rows.dict_row) as cur:
-                cur.execute(f'''SELECT maxzoom
-                                FROM "{self.__schema}"."{METADATA_TABLE}"
-                                WHERE id = %s''', (id,))
-                result = cur.fetchone()
-                if result is None:
-                    # TODO: raise exception and handle it at the calling level
-                    click.echo(f"Failed to retrieve minzoom for id {id}, "
-                               f"does it exist in storage DB?",
-                               err=True)
-                    sys.exit(1)
-                return result["maxzoom"]
+        '''Gets the maxzoom for a layer from storage.'''
+        return self.__get_tileset_or_exit(id, "maxzoom").maxzoom
 
     '''
     Methods that involve saving, fetching, and deleting tiles
     '''
-    def delete_tiles(self, id: str, tiles: Iterator[Tile]):
+    def delete_tiles(self, id: str, tiles: Iterable[Tile]) -> int:
+        '''Delete tiles, returning the number of tiles deleted
+
+        Tiles are copied into a staging table in batches of DELETE_BATCH_SIZE, and deleted
+        with one statement per zoom in each batch, so tiles can be in any order and
+        tiles can be a lazy iterable of any length.
+        '''
+        count = 0
         with self.__pool.connection() as conn:
             with conn.cursor() as cur:
+                self.__create_staging_table(cur)
+                hashes: set[bytes] = set()
+                batch: list[Tile] = []
                 for tile in tiles:
-                    self.__delete_tile(cur, id, tile)
+                    batch.append(tile)
+                    if len(batch) >= DELETE_BATCH_SIZE:
+                        count += self.__delete_batch(cur, id, batch, hashes)
+                        batch = []
+                count += self.__delete_batch(cur, id, batch, hashes)
+                if self.__is_deduplicated(cur, id):
+                    self.__delete_unreferenced_blobs(cur, id, list(hashes))
             conn.commit()
+        return count
+
+    def delete_bbox(self, id: str, zooms: Iterable[int] | None, bbox: Sequence[float]) -> int:
+        '''Delete the tiles covering a bounding box, returning the number of tiles deleted
+
+        The bounding box is [west, south, east, north] in degrees. Tiles are deleted
+        from each zoom with one statement on the ranges of x and y, without listing
+        the tiles. If zooms is None, tiles are deleted from every zoom of the tileset.
+        '''
+        tileset = self.get_tileset(id)
+        if zooms is None:
+            zooms = range(tileset.minzoom, tileset.maxzoom + 1)
+        west, south, east, north = bbox
+        count = 0
+        with self.__pool.connection() as conn:
+            with conn.cursor() as cur:
+                deduplicated = self.__is_deduplicated(cur, id)
+                hashes: set[bytes] = set()
+                for zoom in sorted(set(zooms)):
+                    if not tileset.minzoom <= zoom <= tileset.maxzoom:
+                        continue
+                    # y increases southwards, so the north-west corner has the minimum x and y
+                    min_x, min_y = lonlat_to_xy(west, north, zoom)
+                    max_x, max_y = lonlat_to_xy(east, south, zoom)
+                    cur.execute(f'''DELETE FROM "{self.__schema}"."{id}_z{zoom}"
+                                    WHERE x BETWEEN %s AND %s AND y BETWEEN %s AND %s
+                                    {"RETURNING hash" if deduplicated else ""}''',
+                                (min_x, max_x, min_y, max_y))
+                    count += cur.rowcount
+                    if deduplicated:
+                        hashes.update(record[0] for record in cur.fetchall())
+                    self.__notify(cur, id, zoom)
+                if deduplicated:
+                    self.__delete_unreferenced_blobs(cur, id, list(hashes))
+            conn.commit()
+        return count
 
     def truncate_tables(self, id: str, zooms=None):
         with self.__pool.connection() as conn:
@@ -195,23 +385,185 @@ class Storage:
                     zooms = range(self.get_minzoom(id), self.get_maxzoom(id)+1)
                 for zoom in zooms:
                     self.__truncate_table(cur, id, zoom)
+                    self.__notify(cur, id, zoom)
+                if self.__is_deduplicated(cur, id):
+                    self.__delete_unreferenced_blobs(cur, id)
                 conn.commit()
 
     def get_tile(self, id: str, tile: Tile) -> bytes | None:
+        compressed = self.get_tile_compressed(id, tile)
+        if compressed is None:
+            return None
+        return decompress_tile(compressed)
+
+    def get_tile_compressed(self, id: str, tile: Tile) -> bytes | None:
+        '''Gets a tile as stored, which is gzipped unless the tile is empty'''
+        stored = self.get_stored_tile(id, tile)
+        if stored is None:
+            return None
+        return stored[0]
+
+    def get_stored_tile(self, id: str, tile: Tile) -> tuple[bytes, bytes | None] | None:
+        '''Gets a tile as stored and the hash of its content
+
+        The hash is None for tiles saved before hashes were stored.
+        '''
         with self.__pool.connection() as conn:
             with conn.cursor() as cur:
-                cur.execute(f'''SELECT tile FROM "{self.__schema}"."{id}"
+                cur.execute(f'''SELECT tile, hash FROM {self.__tile_source(cur, id)}
                                 WHERE zoom = %s AND x = %s AND y = %s''',
                             (tile.zoom, tile.x, tile.y), binary=True)
                 result = cur.fetchone()
                 if result is None:
                     return None
-                return gzip.decompress(result[0])
+                return result[0], result[1]
+
+    def get_tile_hash(self, id: str, tile: Tile) -> bytes | None:
+        '''Gets the hash of the content of a tile, without reading the tile
+
+        Returns None if the tile does not exist or was saved before hashes were stored.
+        '''
+        with self.__pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f'''SELECT hash FROM "{self.__schema}"."{id}"
+                                WHERE zoom = %s AND x = %s AND y = %s''',
+                            (tile.zoom, tile.x, tile.y), binary=True)
+                result = cur.fetchone()
+                if result is None:
+                    return None
+                return result[0]
+
+    def export_tiles(self, id: str,
+                     zooms: Iterable[int] | None = None) -> Iterator[tuple[Tile, bytes]]:
+        '''Yields every tile of a tileset as stored, a zoom at a time in x and y order
+
+        Each zoom is read with a server-side cursor, so this runs in bounded memory
+        however many tiles there are. The tiles are all read from one snapshot of
+        storage. If zooms is None, every zoom of the tileset is exported.
+        '''
+        tileset = self.get_tileset(id)
+        if zooms is None:
+            zooms = range(tileset.minzoom, tileset.maxzoom + 1)
+        with self.__pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute('''SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY''')
+                deduplicated = self.__is_deduplicated(cur, id)
+            for zoom in sorted(set(zooms)):
+                if not tileset.minzoom <= zoom <= tileset.maxzoom:
+                    continue
+                source = f'''"{self.__schema}"."{id}_z{zoom}"'''
+                if deduplicated:
+                    source += f''' JOIN "{self.__schema}"."{id}_blobs" USING (hash)'''
+                with conn.cursor(name=f"tilekiln_export_z{zoom}", binary=True) as cur:
+                    cur.itersize = EXPORT_FETCH_SIZE
+                    # Filtering on zoom lets the rows be read in primary key order
+                    cur.execute(f'''SELECT x, y, tile FROM {source}
+                                    WHERE zoom = %s
+                                    ORDER BY x, y''', (zoom,))
+                    for x, y, data in cur:
+                        yield Tile(zoom, x, y), data
+            conn.commit()
+
+    def save_tile(self, id: str, tile: Tile, tiledata: bytes):
+        with self.__pool.connection() as conn:
+            with conn.cursor() as cur:
+                self.__write_to_storage(id, tile, tiledata, cur)
+
+    def save_tiles(self, id: str, tiles: Iterable[tuple[Tile, bytes]]) -> int:
+        '''Save many tiles over one connection
+
+        Tiles are saved in batches of SAVE_BATCH_SIZE. Each batch is copied into a
+        staging table and written to storage with one statement, then committed.
+        Returns the number of tiles saved.
+        '''
+        count = 0
+        with self.__pool.connection() as conn:
+            with conn.cursor() as cur:
+                self.__create_staging_table(cur)
+                conn.commit()
+
+                # Keyed by tile coordinates so a later copy of a tile replaces an earlier one
+                batch: dict[tuple[int, int, int], bytes] = {}
+                for tile, tiledata in tiles:
+                    batch[(tile.zoom, tile.x, tile.y)] = tiledata
+                    if len(batch) >= SAVE_BATCH_SIZE:
+                        count += self.__write_batch_to_storage(id, batch, cur)
+                        conn.commit()
+                        batch = {}
+                if batch:
+                    count += self.__write_batch_to_storage(id, batch, cur)
+                    conn.commit()
+        return count
+
+    def get_or_render_metatile(self, id: str, tile: Tile, metatile: Metatile,
+                               render: Callable[[], Iterable[tuple[Tile, bytes]]],
+                               save: Callable[[list[tuple[Tile, bytes]]], object] | None = None,
+                               pending: Callable[[Tile], bytes | None] | None = None
+                               ) -> dict[tuple[int, int], tuple[bytes, bytes]]:
+        '''Gets the tiles of a metatile, rendering and saving it if tile is missing
+
+        An advisory lock on the metatile is held while checking for the tile and
+        rendering, so if other processes are also doing this, only one renders the
+        metatile and the others wait for it and use the saved tile. render returns the
+        tiles of the metatile.
 
-    def save_tile(self, id: str, tile: Tile, tiledata: bytes, render_time=0):
+        If save is given, it is called with the rendered tiles instead of them being
+        saved before the lock is released. pending then returns tiles which were given
+        to save but might not be in storage yet, and is checked after taking the lock,
+        before storage. Other processes waiting on the lock might still not find the
+        tiles, and render them again.
+
+        Returns the tiles of the metatile and the hashes of their content, by x and y.
+        This always has tile. If tile was in storage, it only has the other tiles of the
+        metatile which were in storage too.
+        '''
         with self.__pool.connection() as conn:
             with conn.cursor() as cur:
-                self.__write_to_storage(id, tile, gzip.compress(tiledata, mtime=0), cur)
+                # The lock is released when the transaction ends
+                cur.execute('''SELECT pg_advisory_xact_lock(hashtext(%s))''',
+                            (f"{self.__schema}/{id}/{metatile.zoom}/{metatile.x}/"
+                             f"{metatile.y}/{metatile.size}",))
+                if pending is not None:
+                    waiting = {(t.x, t.y): data for t in metatile.tiles()
+                               if (data := pending(t)) is not None}
+                    if (tile.x, tile.y) in waiting:
+                        return {(x, y): (data, hashlib.sha256(data).digest())
+                                for (x, y), data in waiting.items()}
+                cur.execute(f'''SELECT x, y, tile, hash FROM {self.__tile_source(cur, id)}
+                                WHERE zoom = %s AND x BETWEEN %s AND %s
+                                AND y BETWEEN %s AND %s''',
+                            (metatile.zoom, metatile.x, metatile.max_x, metatile.y,
+                             metatile.max_y), binary=True)
+                stored = {}
+                for x, y, compressed, hash in cur.fetchall():
+                    tiledata = decompress_tile(compressed)
+                    stored[(x, y)] = (tiledata, hash or hashlib.sha256(tiledata).digest())
+                if (tile.x, tile.y) in stored:
+                    return stored
+
+                rendered = {(t.x, t.y): data for t, data in render()}
+                if save is not None:
+                    save([(Tile(metatile.zoom, x, y), data)
+                          for (x, y), data in rendered.items()])
+                elif len(rendered) == 1:
+                    self.__write_to_storage(id, tile, rendered[(tile.x, tile.y)], cur)
+                else:
+                    self.__create_staging_table(cur)
+                    self.__write_batch_to_storage(id, {(metatile.zoom, x, y): data
+                                                       for (x, y), data in rendered.items()},
+                                                  cur)
+                conn.commit()
+        return {(x, y): (data, hashlib.sha256(data).digest()) for (x, y), data in rendered.items()}
+
+    def __create_staging_table(self, cur):
+        '''Create the staging table for this connection, if it doesn't exist'''
+        cur.execute(f'''CREATE TEMPORARY TABLE IF NOT EXISTS "{STAGING_TABLE}" (
+                        zoom smallint,
+                        x int,
+                        y int,
+                        hash bytea,
+                        tile bytea
+                        )''')
 
     def __setup_metadata(self, cur):
         ''' Create the metadata table in storage. This is safe to rerun
@@ -225,22 +577,168 @@ class Storage:
             minzoom smallint NOT NULL,
             maxzoom smallint NOT NULL,
             tilejson jsonb NOT NULL)''')
+        # Added after the table was first released
+        cur.execute(f'''ALTER TABLE "{self.__schema}"."{METADATA_TABLE}"
+            ADD COLUMN IF NOT EXISTS deduplicate boolean NOT NULL DEFAULT FALSE''')
+        # Cache-Control header values by the zoom they start at
+        cur.execute(f'''ALTER TABLE "{self.__schema}"."{METADATA_TABLE}"
+            ADD COLUMN IF NOT EXISTS cache_control jsonb NOT NULL DEFAULT '{{}}'
+            ''')
+
+    def __upgrade_tables(self, cur):
+        '''Update the tables of existing tilesets to the current schema'''
+        cur.execute(f'''SELECT id FROM "{self.__schema}"."{METADATA_TABLE}"
+                        WHERE NOT deduplicate''')
+        for (id,) in cur.fetchall():
+            # Hashes of tiles were added after tilesets were first released, and are
+            # NULL until a tile is next saved
+            cur.execute(f'''ALTER TABLE "{self.__schema}"."{id}"
+                            ADD COLUMN IF NOT EXISTS hash bytea''')
 
-    def __set_metadata(self, cur, id, minzoom, maxzoom, tilejson):
+        # Size histograms were added later too, and need filling from the existing tiles
+        cur.execute(f'''SELECT id, minzoom, maxzoom, deduplicate
+                        FROM "{self.__schema}"."{METADATA_TABLE}" AS m
+                        WHERE NOT EXISTS (
+                            SELECT FROM pg_trigger
+                            WHERE tgrelid = format('%%I.%%I', %s::text, m.id)::regclass
+                            AND tgname = 'tilekiln_sizes_insert')''',
+                    (self.__schema,))
+        for id, minzoom, maxzoom, deduplicate in cur.fetchall():
+            # The triggers lock out writes until this commits, so no changes are missed
+            self.__setup_size_triggers(cur, id, minzoom, maxzoom, deduplicate)
+            size = "length(b.tile)" if deduplicate else "length(tile)"
+            source = (f'''"{self.__schema}"."{id}" AS t
+                         JOIN "{self.__schema}"."{id}_blobs" AS b USING (hash)'''
+                      if deduplicate else f'''"{self.__schema}"."{id}"''')
+            cur.execute(f'''DELETE FROM "{self.__schema}"."{SIZE_DELTAS_TABLE}" WHERE id = %s''',
+                        (id,))
+            cur.execute(f'''DELETE FROM "{self.__schema}"."{SIZE_HISTOGRAM_TABLE}"
+                            WHERE id = %s''', (id,))
+            cur.execute(f'''INSERT INTO "{self.__schema}"."{SIZE_HISTOGRAM_TABLE}"
+                                (id, zoom, bucket, num_tiles, size)
+                            SELECT %s, zoom, "{self.__schema}".tilekiln_size_bucket({size}),
+                                COUNT(*), SUM({size})
+                            FROM {source}
+                            GROUP BY 2, 3''', (id,))
+
+        # As were blob sizes, which need filling from the existing blobs
+        cur.execute(f'''SELECT id FROM "{self.__schema}"."{METADATA_TABLE}" AS m
+                        WHERE deduplicate
+                        AND NOT EXISTS (
+                            SELECT FROM pg_trigger
+                            WHERE tgrelid = format('%%I.%%I', %s::text, m.id || '_blobs')::regclass
+                            AND tgname = 'tilekiln_blob_sizes_insert')''',
+                    (self.__schema,))
+        for (id,) in cur.fetchall():
+            self.__setup_blob_triggers(cur, id)
+            for table in (BLOB_SIZE_DELTAS_TABLE, BLOB_SIZES_TABLE):
+                cur.execute(f'''DELETE FROM "{self.__schema}"."{table}" WHERE id = %s''',
+                            (id,))
+            cur.execute(f'''INSERT INTO "{self.__schema}"."{BLOB_SIZES_TABLE}"
+                                (id, num_blobs, size)
+                            SELECT %s, COUNT(*), COALESCE(SUM(length(tile)), 0)
+                            FROM "{self.__schema}"."{id}_blobs"''', (id,))
+
+    def __set_metadata(self, cur, id, minzoom, maxzoom, tilejson, cache_control=None,
+                       deduplicate=False):
         '''
         Sets metadata using a cursor
 
         This is separate from set_metadata because sometimes it needs
-        calling within a transaction
+        calling within a transaction. deduplicate is only set for a new tileset,
+        since it can't be changed once the tables exist.
         '''
         cur.execute(f'''INSERT INTO "{self.__schema}"."{METADATA_TABLE}"
-        (id, minzoom, maxzoom, tilejson)
-        VALUES (%s, %s, %s, %s)
+        (id, minzoom, maxzoom, tilejson, cache_control, deduplicate)
+        VALUES (%s, %s, %s, %s, %s, %s)
         ON CONFLICT (id)
         DO UPDATE SET minzoom = EXCLUDED.minzoom,
         maxzoom = EXCLUDED.maxzoom,
-        tilejson = EXCLUDED.tilejson
-        ''', (id, minzoom, maxzoom, tilejson))
+        tilejson = EXCLUDED.tilejson,
+        cache_control = EXCLUDED.cache_control
+        ''', (id, minzoom, maxzoom, tilejson, json.dumps(cache_control or {}), deduplicate))
+
+    def __notify(self, cur, id: str, zoom: int | None = None,
+                 tiles: list[tuple[int, int]] | None = None) -> None:
+        '''Notify listeners that tiles have changed, when the transaction commits
+
+        tiles are the x and y of tiles at zoom. If there are no tiles or too many, the
+        notification is for the entire zoom, or if there is no zoom, the entire tileset.
+        '''
+        if zoom is not None and tiles is not None and len(tiles) <= NOTIFY_TILE_LIMIT:
+            payloads = [json.dumps({"id": id, "zoom": zoom, "x": x, "y": y}) for x, y in tiles]
+        elif zoom is not None:
+            payloads = [json.dumps({"id": id, "zoom": zoom})]
+        else:
+            payloads = [json.dumps({"id": id})]
+        cur.execute('''SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload''',
+                    (NOTIFY_CHANNEL, payloads))
+
+    def __is_deduplicated(self, cur, id: str) -> bool:
+        '''Returns if a tileset is stored deduplicated, looking it up the first time'''
+        if id not in self.__deduplicated:
+            cur.execute(f'''SELECT deduplicate
+                            FROM "{self.__schema}"."{METADATA_TABLE}"
+                            WHERE id = %s''', (id,))
+            result = cur.fetchone()
+            if result is None:
+                # TODO: raise exception and handle it at the calling level
+                click.echo(f"Failed to retrieve metadata for id {id}, "
+                           f"does it exist in storage DB?",
+                           err=True)
+                sys.exit(1)
+            self.__deduplicated[id] = result[0]
+        return self.__deduplicated[id]
+
+    def __tile_source(self, cur, id: str) -> str:
+        '''Returns the SQL to select from to get zoom, x, y, and tile for a tileset'''
+        if self.__is_deduplicated(cur, id):
+            return (f'''"{self.__schema}"."{id}" '''
+                    f'''JOIN "{self.__schema}"."{id}_blobs" USING (hash)''')
+        return f'''"{self.__schema}"."{id}"'''
+
+    def __delete_unreferenced_blobs(self, cur, id: str, hashes: list[bytes] | None = None):
+        '''Delete blobs which no tile references any more
+
+        If hashes is given, only those blobs are checked. Otherwise every blob is.
+
+        The blobs are locked before checking if they are referenced. Writers lock the
+        blobs of the tiles they write until they commit, so this waits for them and
+        then sees their tiles, instead of deleting a blob that a tile is about to
+        reference. Blobs are locked in hash order. Writers lock blobs before writing
+        tiles, so that the size triggers can read them, and this locks them after
+        deleting tiles. A tile written and deleted at the same time can deadlock, which
+        postgres breaks by failing one of the transactions.
+        '''
+        if hashes is None:
+            cur.execute(f'''SELECT hash FROM "{self.__schema}"."{id}_blobs" AS b
+                            WHERE NOT EXISTS (SELECT FROM "{self.__schema}"."{id}" AS t
+                                              WHERE t.hash = b.hash)''')
+            hashes = [record[0] for record in cur.fetchall()]
+        if not hashes:
+            return
+        cur.execute(f'''SELECT FROM "{self.__schema}"."{id}_blobs"
+                        WHERE hash = ANY(%s)
+                        ORDER BY hash
+                        FOR UPDATE''', (hashes,))
+        # This is a new statement, so it sees tiles committed while waiting for locks
+        cur.execute(f'''DELETE FROM "{self.__schema}"."{id}_blobs" AS b
+                        WHERE b.hash = ANY(%s)
+                        AND NOT EXISTS (SELECT FROM "{self.__schema}"."{id}" AS t
+                                        WHERE t.hash = b.hash)''', (hashes,))
+
+    def __lock_blobs(self, cur, id: str, hashes: list[bytes]) -> list[bytes]:
+        '''Lock blobs so they can't be deleted until this transaction ends
+
+        Returns the hashes of any blobs which don't exist, because they were deleted
+        since they were written.
+        '''
+        cur.execute(f'''SELECT hash FROM "{self.__schema}"."{id}_blobs"
+                        WHERE hash = ANY(%s)
+                        ORDER BY hash
+                        FOR KEY SHARE''', (hashes,))
+        locked = {record[0] for record in cur.fetchall()}
+        return [hash for hash in hashes if hash not in locked]
 
     def __setup_stats(self, cur):
         '''Create the stats tables.
@@ -251,14 +749,26 @@ class Storage:
         # Periodic resets are okay.
         # It's necessary to store this in-db since we might call tilerender more than once
         # in a polling interval.
-        # TODO: Use this table
+        # Nothing was saved in this table before it had layers, so an old one can be replaced
+        cur.execute('''SELECT FROM information_schema.tables AS t
+                       WHERE table_schema = %s AND table_name = %s
+                       AND NOT EXISTS (SELECT FROM information_schema.columns AS c
+                                       WHERE c.table_schema = t.table_schema
+                                       AND c.table_name = t.table_name
+                                       AND c.column_name = 'layer')''',
+                    (self.__schema, GENERATE_STATS_TABLE))
+        if cur.fetchone() is not None:
+            cur.execute(f'''DROP TABLE "{self.__schema}"."{GENERATE_STATS_TABLE}"''')
+        # The layer is '' for whole renders, and buckets are counts of renders by time
         cur.execute(f'''CREATE UNLOGGED TABLE IF NOT EXISTS
             "{self.__schema}"."{GENERATE_STATS_TABLE}" (
             id text,
             zoom smallint,
-            num_rendered integer DEFAULT 0,
-            time_rendered interval DEFAULT '0',
-            PRIMARY KEY (id, zoom)
+            layer text,
+            num_rendered bigint NOT NULL DEFAULT 0,
+            time_rendered double precision NOT NULL DEFAULT 0,
+            buckets bigint[] NOT NULL,
+            PRIMARY KEY (id, zoom, layer)
         )
         ''')
 
@@ -274,52 +784,205 @@ class Storage:
             CHECK (array_length(percentiles, 1) = 2)
         )
         ''')
+        # Size after deduplication. This was added after the table was first released.
+        # It is NULL for deduplicated tilesets, which share blobs between zooms, so only
+        # have a size after deduplication for the entire tileset.
+        cur.execute(f'''ALTER TABLE "{self.__schema}"."{TILE_STATS_TABLE}"
+            ADD COLUMN IF NOT EXISTS physical_size bigint''')
+
+        # The stats are made from histograms of tile sizes, which are kept up to date as
+        # tiles are written instead of being calculated from the tiles each time
+        cur.execute(f'''CREATE TABLE IF NOT EXISTS "{self.__schema}"."{SIZE_HISTOGRAM_TABLE}" (
+            id text,
+            zoom smallint,
+            bucket smallint,
+            num_tiles bigint NOT NULL,
+            size bigint NOT NULL,
+            PRIMARY KEY (id, zoom, bucket)
+        )
+        ''')
+        cur.execute(f'''CREATE TABLE IF NOT EXISTS "{self.__schema}"."{SIZE_DELTAS_TABLE}" (
+            id text NOT NULL,
+            zoom smallint NOT NULL,
+            bucket smallint NOT NULL,
+            num_tiles bigint NOT NULL,
+            size bigint NOT NULL
+        )
+        ''')
+        cur.execute(f'''CREATE TABLE IF NOT EXISTS "{self.__schema}"."{BLOB_SIZES_TABLE}" (
+            id text PRIMARY KEY,
+            num_blobs bigint NOT NULL,
+            size bigint NOT NULL
+        )
+        ''')
+        cur.execute(f'''CREATE TABLE IF NOT EXISTS "{self.__schema}"."{BLOB_SIZE_DELTAS_TABLE}" (
+            id text NOT NULL,
+            num_blobs bigint NOT NULL,
+            size bigint NOT NULL
+        )
+        ''')
+        cur.execute(f'''CREATE OR REPLACE FUNCTION
+            "{self.__schema}".tilekiln_size_bucket(size bigint)
+            RETURNS smallint LANGUAGE sql IMMUTABLE AS $$
+            SELECT CASE WHEN size = 0 THEN 0
+                        ELSE ceil(ln(size) / ln({SIZE_GAMMA!r}))::smallint + 1 END
+            $$''')
+        # Records the changes to tile sizes from a statement as deltas. The trigger
+        # arguments are the tileset ID and if it is deduplicated.
+        cur.execute(f'''CREATE OR REPLACE FUNCTION
+            "{self.__schema}".tilekiln_record_tile_sizes()
+            RETURNS trigger LANGUAGE plpgsql AS $$
+            DECLARE
+                sizes text;
+                changed text[] := ARRAY[]::text[];
+            BEGIN
+                IF TG_ARGV[1]::boolean THEN
+                    sizes := format('SELECT zoom, COALESCE(length(b.tile), 0) AS size, %%s AS n
+                                     FROM %%s AS t LEFT JOIN %I.%I AS b USING (hash)',
+                                    TG_TABLE_SCHEMA, TG_ARGV[0] || '_blobs');
+                ELSE
+                    sizes := 'SELECT zoom, length(tile) AS size, %s AS n FROM %s';
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    changed := changed || format(sizes, 1, 'new_tiles');
+                END IF;
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    changed := changed || format(sizes, -1, 'old_tiles');
+                END IF;
+                EXECUTE format('INSERT INTO %I.{SIZE_DELTAS_TABLE}
+                                    (id, zoom, bucket, num_tiles, size)
+                                SELECT $1, zoom, %I.tilekiln_size_bucket(size),
+                                    SUM(n), SUM(n * size)
+                                FROM (%s) AS changed
+                                GROUP BY zoom, 3
+                                HAVING SUM(n) <> 0 OR SUM(n * size) <> 0',
+                               TG_TABLE_SCHEMA, TG_TABLE_SCHEMA,
+                               array_to_string(changed, ' UNION ALL '))
+                    USING TG_ARGV[0];
+                RETURN NULL;
+            END
+            $$''')
+        # Records the blobs added or removed by a statement as a delta. The trigger
+        # argument is the tileset ID.
+        cur.execute(f'''CREATE OR REPLACE FUNCTION
+            "{self.__schema}".tilekiln_record_blob_sizes()
+            RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                EXECUTE format('INSERT INTO %I.{BLOB_SIZE_DELTAS_TABLE} (id, num_blobs, size)
+                                SELECT $1, %s * COUNT(*), %s * SUM(length(tile))
+                                FROM changed_blobs
+                                HAVING COUNT(*) > 0',
+                               TG_TABLE_SCHEMA,
+                               CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END,
+                               CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END)
+                    USING TG_ARGV[0];
+                RETURN NULL;
+            END
+            $$''')
+
+    def __update_tileset_metrics(self, cur, id, minzoom, maxzoom,
+                                 sketches: dict[tuple[str, int], SizeSketch],
+                                 sizes: dict[tuple[str, int], int],
+                                 quantiles: Sequence[float]) -> None:
+        '''Update the stats of each zoom of a tileset from its size sketches
 
-    def __update_tileset_metrics(self, cur, id, minzoom, maxzoom) -> None:
+        sketches and sizes have the sketch and total size of tiles by tileset and zoom.
+        Zooms without any tiles get stats of 0.
+        '''
+        # Blobs can be shared between zooms, so deduplicated tilesets only have a size
+        # after deduplication for the entire tileset, from blob_metrics
+        deduplicated = self.__is_deduplicated(cur, id)
         for zoom in range(minzoom, maxzoom+1):
-            tablename = f"{id}_z{zoom}"
-            # This SQL statement needs to handle the case of an empty table.
-            # Except for COUNT(*) the aggregate functions return NULL for
-            # no rows, which is a problem. One option would be to save
-            # {{}, {}} as the array but 2-d empty arrays don't really work
-            # in PostgreSQL. Instead, we return 0 for all metrics.
-            #
-            # We set jit to ON as it is faster when the tables are large, but
-            # jit is commonly disabled on tile rendering servers because it
-            # slows down rendering queries.
-            # TODO: Consider if it would be better to completely skip the row
-            #       and emit no metric.
-            # TODO: Reformat this statement to be better with line breaks
-            cur.execute('SET LOCAL jit TO ON;')
+            sketch = sketches.get((id, zoom), SizeSketch())
+            num_tiles = sketch.count
+            size = sizes.get((id, zoom), 0)
+            physical_size = None if deduplicated else size
             cur.execute(f'''INSERT INTO "{self.__schema}"."{TILE_STATS_TABLE}"
-                        SELECT
-                            %(id)s AS id,
-                            %(zoom)s AS zoom,
-                            COUNT(*) AS num_tiles,
-                            COALESCE(SUM(length(tile)),0) AS size,
-                            ARRAY[%(percentile)s,
-                                COALESCE(PERCENTILE_CONT(%(percentile)s::double precision[])
-                                    WITHIN GROUP (ORDER BY length(tile)),
-                                    array_fill(0,
-                                    ARRAY[array_length(%(percentile)s, 1)]))] AS percentiles
-                            FROM "{self.__schema}"."{tablename}"
+                                (id, zoom, num_tiles, size, physical_size, percentiles)
+                            VALUES (%s, %s, %s, %s, %s, %s)
                             ON CONFLICT (id, zoom)
-                        DO UPDATE SET num_tiles = EXCLUDED.num_tiles,
-                            size = EXCLUDED.size,
-                            percentiles = EXCLUDED.percentiles;
-                        ''', {'id': id, 'zoom': zoom, 'percentile': PERCENTILES})
+                            DO UPDATE SET num_tiles = EXCLUDED.num_tiles,
+                                size = EXCLUDED.size,
+                                physical_size = EXCLUDED.physical_size,
+                                percentiles = EXCLUDED.percentiles''',
+                        (id, zoom, num_tiles, size, physical_size,
+                         [list(quantiles), sketch.quantiles(quantiles)]))
+
+    def __apply_size_deltas(self, cur) -> None:
+        '''Add the changes to tile sizes written since this was last run into the histograms
+
+        Rows are taken in key order, so this can run concurrently with itself.
+        '''
+        cur.execute(f'''WITH deltas AS (
+                            DELETE FROM "{self.__schema}"."{SIZE_DELTAS_TABLE}"
+                            RETURNING id, zoom, bucket, num_tiles, size)
+                        INSERT INTO "{self.__schema}"."{SIZE_HISTOGRAM_TABLE}" AS h
+                            (id, zoom, bucket, num_tiles, size)
+                        SELECT id, zoom, bucket, SUM(num_tiles), SUM(size)
+                            FROM deltas
+                            GROUP BY id, zoom, bucket
+                            ORDER BY id, zoom, bucket
+                        ON CONFLICT (id, zoom, bucket)
+                        DO UPDATE SET num_tiles = h.num_tiles + EXCLUDED.num_tiles,
+                            size = h.size + EXCLUDED.size''')
+        cur.execute(f'''DELETE FROM "{self.__schema}"."{SIZE_HISTOGRAM_TABLE}"
+                        WHERE num_tiles = 0''')
+        cur.execute(f'''WITH deltas AS (
+                            DELETE FROM "{self.__schema}"."{BLOB_SIZE_DELTAS_TABLE}"
+                            RETURNING id, num_blobs, size)
+                        INSERT INTO "{self.__schema}"."{BLOB_SIZES_TABLE}" AS b
+                            (id, num_blobs, size)
+                        SELECT id, SUM(num_blobs), SUM(size)
+                            FROM deltas
+                            GROUP BY id
+                            ORDER BY id
+                        ON CONFLICT (id)
+                        DO UPDATE SET num_blobs = b.num_blobs + EXCLUDED.num_blobs,
+                            size = b.size + EXCLUDED.size''')
+
+    def __setup_size_triggers(self, cur, id, minzoom, maxzoom, deduplicate=False):
+        '''Create the triggers which record the sizes of tiles written to a tileset
 
-    def __setup_tables(self, cur, id, minzoom, maxzoom):
+        Statement triggers on a partitioned table only fire for statements on it, not on
+        its partitions, so every table gets them.
+        '''
+        for tablename in [id] + [f"{id}_z{zoom}" for zoom in range(minzoom, maxzoom+1)]:
+            for event, transition_tables in SIZE_TRIGGER_EVENTS.items():
+                cur.execute(f'''CREATE TRIGGER tilekiln_sizes_{event.lower()}
+                                AFTER {event} ON "{self.__schema}"."{tablename}"
+                                REFERENCING {transition_tables}
+                                FOR EACH STATEMENT
+                                EXECUTE FUNCTION "{self.__schema}".tilekiln_record_tile_sizes(
+                                    '{id}', '{str(deduplicate).lower()}')''')
+
+    def __setup_blob_triggers(self, cur, id):
+        '''Create the triggers which record the sizes of blobs written to a deduplicated
+           tileset
+        '''
+        for event, transition_table in BLOB_TRIGGER_EVENTS.items():
+            cur.execute(f'''CREATE TRIGGER tilekiln_blob_sizes_{event.lower()}
+                            AFTER {event} ON "{self.__schema}"."{id}_blobs"
+                            REFERENCING {transition_table}
+                            FOR EACH STATEMENT
+                            EXECUTE FUNCTION "{self.__schema}".tilekiln_record_blob_sizes(
+                                '{id}')''')
+
+    def __setup_tables(self, cur, id, minzoom, maxzoom, deduplicate=False):
         '''Create the tile storage tables
 
         This creates the tile storage tables. It intentionally
         does not try to overwrite existing tables.
+
+        Each tile has the SHA-256 hash of its content. A deduplicated tileset stores
+        only the hash of the tile instead of the tile, and has an additional table of
+        tiles by hash.
         '''
+        columns = "hash bytea NOT NULL" if deduplicate else "tile bytea NOT NULL, hash bytea"
         cur.execute(f'''CREATE TABLE "{self.__schema}"."{id}" (
                     zoom smallint CHECK (zoom >= {minzoom} AND zoom <= {maxzoom}),
                     x int CHECK (x >= 0 AND x < 1 << zoom),
                     y int CHECK (x >= 0 AND x < 1 << zoom),
-                    tile bytea NOT NULL,
+                    {columns},
                     primary key (zoom, x, y)
                     ) PARTITION BY LIST (zoom)''')
         for zoom in range(minzoom, maxzoom+1):
@@ -327,53 +990,289 @@ class Storage:
             cur.execute(f'''CREATE TABLE "{self.__schema}"."{tablename}"
                             PARTITION OF "{self.__schema}"."{id}"
                             FOR VALUES IN ({zoom})''')
-            # tile is already compressed, so tell postgres to not compress it again
-            cur.execute(f'''ALTER TABLE "{self.__schema}"."{tablename}"
+            if not deduplicate:
+                # tile is already compressed, so tell postgres to not compress it again
+                cur.execute(f'''ALTER TABLE "{self.__schema}"."{tablename}"
+                                ALTER COLUMN tile SET STORAGE EXTERNAL''')
+
+        if deduplicate:
+            cur.execute(f'''CREATE TABLE "{self.__schema}"."{id}_blobs" (
+                            hash bytea PRIMARY KEY,
+                            tile bytea NOT NULL
+                            )''')
+            cur.execute(f'''ALTER TABLE "{self.__schema}"."{id}_blobs"
                             ALTER COLUMN tile SET STORAGE EXTERNAL''')
+            # Needed to find blobs which are no longer used
+            cur.execute(f'''CREATE INDEX ON "{self.__schema}"."{id}" (hash)''')
+            self.__setup_blob_triggers(cur, id)
 
-    def __load_metadata(self):
-        '''Load the stored metadata.
+        self.__setup_size_triggers(cur, id, minzoom, maxzoom, deduplicate)
 
-        This allows serving a TileJSON without having access to the config
+    @contextmanager
+    def __read_only_cursor(self, **kwargs) -> Iterator[psycopg.Cursor]:
+        '''A cursor in a read-only transaction
+
+        This is used instead of setting read_only on the connection, which would stay
+        set when the connection is returned to the pool.
         '''
         with self.__pool.connection() as conn:
-            with conn.cursor(row_factory=psycopg.rows.dict_row) as cur:
-                cur.execute(f'''SELECT minzoom, maxzoom, tilejson
-                                FROM "{self.__schema}"."{METADATA_TABLE}"
-                                WHERE id = %s''', (self.id,))
-                result = cur.fetchone()
-                if result is None:
-                    # TODO: raise exception and handle it at the calling level
-                    click.echo(f"Failed to retrieve metadata for id {self.id}, "
-                               f"does it exist in storage DB?",
-                               err=True)
-                    sys.exit(1)
-                self.minzoom = result["minzoom"]
-                self.maxzoom = result["maxzoom"]
-                self.__rawtilejson = result["tilejson"]
+            with conn.cursor(**kwargs) as cur:
+                cur.execute('''SET TRANSACTION READ ONLY''')
+                yield cur
+
+    def __get_metadata(self) -> dict[str, Tileset]:
+        '''Returns the tilesets by ID, loading them if needed'''
+        tilesets = self.__tilesets
+        if tilesets is None:
+            with self.__read_only_cursor(row_factory=psycopg.rows.dict_row) as cur:
+                tilesets = self.__read_metadata(cur)
+        return tilesets
+
+    def __read_metadata(self, cur) -> dict[str, Tileset]:
+        '''Load the stored metadata, using a cursor with dict rows.
+
+        This allows serving a TileJSON without having access to the config
+        '''
+        cur.execute(f'''SELECT id, minzoom, maxzoom, tilejson, cache_control, deduplicate
+                        FROM "{self.__schema}"."{METADATA_TABLE}"''')
+        tilesets = {}
+        for record in cur.fetchall():
+            tilesets[record["id"]] = Tileset(self, record["id"], record["minzoom"],
+                                             record["maxzoom"], json.dumps(record["tilejson"]),
+                                             {int(zoom): value for zoom, value
+                                              in record["cache_control"].items()})
+            self.__deduplicated[record["id"]] = record["deduplicate"]
+        self.__tilesets = tilesets
+        return tilesets
+
+    def __get_tileset_or_exit(self, id: str, name: str) -> Tileset:
+        try:
+            return self.get_tileset(id)
+        except KeyError:
+            # TODO: raise exception and handle it at the calling level
+            click.echo(f"Failed to retrieve {name} for id {id}, "
+                       f"does it exist in storage DB?",
+                       err=True)
+            sys.exit(1)
 
     def __truncate_table(self, cur, id: str, zoom: int) -> None:
         '''Remove every tile from a particular tileset and zoom'''
         tablename = f"{id}_z{zoom}"
         cur.execute(f'''TRUNCATE TABLE "{self.__schema}"."{tablename}"''')
+        # TRUNCATE doesn't fire the size triggers. Deltas are deleted first, so any being
+        # added to the histogram at the same time are finished before it is cleared.
+        for table in (SIZE_DELTAS_TABLE, SIZE_HISTOGRAM_TABLE):
+            cur.execute(f'''DELETE FROM "{self.__schema}"."{table}"
+                            WHERE id = %s AND zoom = %s''', (id, zoom))
 
-    def __delete_tile(self, cur, id: str, tile: Tile):
-        '''Delete an individual tile
+    def __delete_batch(self, cur, id: str, batch: list[Tile], hashes: set[bytes]) -> int:
+        '''Delete a batch of tiles using the staging table, with one statement per zoom
 
-        How this is implemented is not ideal for long lists of tiles
-        to delete, but generally a long list is an entire zoom or a box.
-
-        In the former case it is implemented as __truncate_table, and
-        the latter case is not implemented but would take min/max x/y.
+        The hashes of deleted deduplicated tiles are added to hashes.
         '''
-        cur.execute(f'''DELETE FROM "{self.__schema}"."{id}"
-                        WHERE zoom = %s AND x = %s AND y = %s''',
-                    (tile.zoom, tile.x, tile.y))
+        if not batch:
+            return 0
+        zooms: dict[int, list[tuple[int, int]]] = {}
+        with cur.copy(f'''COPY "{STAGING_TABLE}" (zoom, x, y)
+                         FROM STDIN (FORMAT BINARY)''') as copy:
+            copy.set_types(["int2", "int4", "int4"])
+            for tile in batch:
+                copy.write_row((tile.zoom, tile.x, tile.y))
+                zooms.setdefault(tile.zoom, []).append((tile.x, tile.y))
 
-    def __write_to_storage(self, id, tile: Tile, tiledata, cur):
+        deduplicated = self.__is_deduplicated(cur, id)
+        count = 0
+        for zoom, tiles in sorted(zooms.items()):
+            cur.execute(f'''DELETE FROM "{self.__schema}"."{id}_z{zoom}" AS t
+                            USING "{STAGING_TABLE}" AS s
+                            WHERE s.zoom = %s AND t.x = s.x AND t.y = s.y
+                            {"RETURNING t.hash" if deduplicated else ""}''',
+                        (zoom,))
+            count += cur.rowcount
+            if deduplicated:
+                hashes.update(record[0] for record in cur.fetchall())
+            self.__notify(cur, id, zoom, tiles)
+        cur.execute(f'''TRUNCATE "{STAGING_TABLE}"''')
+        return count
+
+    def __write_to_storage(self, id, tile: Tile, tiledata: bytes, cur):
         tablename = f"{id}_z{tile.zoom}"
-        cur.execute(f'''INSERT INTO "{self.__schema}"."{tablename}" (zoom, x, y, tile)
+        self.__notify(cur, id, tile.zoom, [(tile.x, tile.y)])
+        digest = hashlib.sha256(tiledata).digest()
+        if not self.__is_deduplicated(cur, id):
+            cur.execute(f'''INSERT INTO "{self.__schema}"."{tablename}" (zoom, x, y, tile, hash)
+VALUES (%s, %s, %s, %s, %s)
+ON CONFLICT (zoom, x, y)
+DO UPDATE SET tile = EXCLUDED.tile, hash = EXCLUDED.hash''',
+                        (tile.zoom, tile.x, tile.y, compress_tile(tiledata), digest))
+            return
+
+        cur.execute(f'''SELECT hash FROM "{self.__schema}"."{tablename}"
+                        WHERE zoom = %s AND x = %s AND y = %s''',
+                    (tile.zoom, tile.x, tile.y))
+        old = [record[0] for record in cur.fetchall() if record[0] != digest]
+        compressed = compress_tile(tiledata)
+        missing = [digest]
+        while missing:
+            cur.execute(f'''INSERT INTO "{self.__schema}"."{id}_blobs" (hash, tile)
+VALUES (%s, %s)
+ON CONFLICT (hash) DO NOTHING''',
+                        (digest, compressed))
+            missing = self.__lock_blobs(cur, id, missing)
+        cur.execute(f'''INSERT INTO "{self.__schema}"."{tablename}" (zoom, x, y, hash)
 VALUES (%s, %s, %s, %s)
 ON CONFLICT (zoom, x, y)
-DO UPDATE SET tile = EXCLUDED.tile''',
-                    (tile.zoom, tile.x, tile.y, tiledata))
+DO UPDATE SET hash = EXCLUDED.hash''',
+                    (tile.zoom, tile.x, tile.y, digest))
+        self.__delete_unreferenced_blobs(cur, id, old)
+
+    def __write_batch_to_storage(self, id, batch: dict[tuple[int, int, int], bytes], cur) -> int:
+        '''Write a batch of tiles using the staging table'''
+        zooms: dict[int, list[tuple[int, int]]] = {}
+        for zoom, x, y in batch:
+            zooms.setdefault(zoom, []).append((x, y))
+        for zoom, tiles in zooms.items():
+            self.__notify(cur, id, zoom, tiles)
+
+        if not self.__is_deduplicated(cur, id):
+            with cur.copy(f'''COPY "{STAGING_TABLE}" (zoom, x, y, hash, tile)
+                             FROM STDIN (FORMAT BINARY)''') as copy:
+                copy.set_types(["int2", "int4", "int4", "bytea", "bytea"])
+                for (zoom, x, y), tiledata in batch.items():
+                    copy.write_row((zoom, x, y, hashlib.sha256(tiledata).digest(),
+                                    compress_tile(tiledata)))
+            cur.execute(f'''INSERT INTO "{self.__schema}"."{id}" (zoom, x, y, tile, hash)
+SELECT zoom, x, y, tile, hash FROM "{STAGING_TABLE}"
+ON CONFLICT (zoom, x, y)
+DO UPDATE SET tile = EXCLUDED.tile, hash = EXCLUDED.hash''')
+            cur.execute(f'''TRUNCATE "{STAGING_TABLE}"''')
+            return len(batch)
+
+        with cur.copy(f'''COPY "{STAGING_TABLE}" (zoom, x, y, hash, tile)
+                         FROM STDIN (FORMAT BINARY)''') as copy:
+            copy.set_types(["int2", "int4", "int4", "bytea", "bytea"])
+            seen = set()
+            for (zoom, x, y), tiledata in batch.items():
+                digest = hashlib.sha256(tiledata).digest()
+                # Identical tiles in a batch are only compressed and sent once
+                if digest in seen:
+                    copy.write_row((zoom, x, y, digest, None))
+                else:
+                    seen.add(digest)
+                    copy.write_row((zoom, x, y, digest, compress_tile(tiledata)))
+
+        # Tiles being overwritten might leave a blob unused
+        cur.execute(f'''SELECT DISTINCT t.hash
+                        FROM "{self.__schema}"."{id}" AS t
+                        JOIN "{STAGING_TABLE}" AS s USING (zoom, x, y)
+                        WHERE t.hash <> s.hash''')
+        old = [record[0] for record in cur.fetchall()]
+        cur.execute(f'''INSERT INTO "{self.__schema}"."{id}_blobs" (hash, tile)
+SELECT hash, tile FROM "{STAGING_TABLE}" WHERE tile IS NOT NULL
+ORDER BY hash
+ON CONFLICT (hash) DO NOTHING''')
+        missing = self.__lock_blobs(cur, id, sorted(seen))
+        while missing:
+            # Blobs deleted by another transaction before they could be locked are
+            # written again
+            cur.execute(f'''INSERT INTO "{self.__schema}"."{id}_blobs" (hash, tile)
+SELECT hash, tile FROM "{STAGING_TABLE}" WHERE tile IS NOT NULL AND hash = ANY(%s)
+ON CONFLICT (hash) DO NOTHING''', (missing,))
+            missing = self.__lock_blobs(cur, id, missing)
+        cur.execute(f'''INSERT INTO "{self.__schema}"."{id}" (zoom, x, y, hash)
+SELECT zoom, x, y, hash FROM "{STAGING_TABLE}"
+ON CONFLICT (zoom, x, y)
+DO UPDATE SET hash = EXCLUDED.hash''')
+        self.__delete_unreferenced_blobs(cur, id, old)
+        cur.execute(f'''TRUNCATE "{STAGING_TABLE}"''')
+        return len(batch)
+
+
+class AsyncStorage:
+    '''
+    Read-only access to tiles in storage with asyncio
+
+    This is for serving tiles, where many reads can be in flight at once over a pool
+    of connections. It reads the same tables as Storage.
+    '''
+    def __init__(self, dbpool: AsyncConnectionPool, schema="tilekiln"):
+        self.__pool = dbpool
+        self.__schema = schema
+        # If each tileset is deduplicated, as it is looked up
+        self.__deduplicated: dict[str, bool] = {}
+
+    async def get_tile(self, id: str, tile: Tile) -> bytes | None:
+        compressed = await self.get_tile_compressed(id, tile)
+        if compressed is None:
+            return None
+        return decompress_tile(compressed)
+
+    async def get_tile_compressed(self, id: str, tile: Tile) -> bytes | None:
+        '''Gets a tile as stored, which is gzipped unless the tile is empty'''
+        stored = await self.get_stored_tile(id, tile)
+        if stored is None:
+            return None
+        return stored[0]
+
+    async def get_stored_tile(self, id: str, tile: Tile) -> tuple[bytes, bytes | None] | None:
+        '''Gets a tile as stored and the hash of its content'''
+        async with self.__pool.connection() as conn:
+            async with conn.cursor() as cur:
+                source = f'''"{self.__schema}"."{id}"'''
+                if await self.__is_deduplicated(cur, id):
+                    source += f''' JOIN "{self.__schema}"."{id}_blobs" USING (hash)'''
+                await cur.execute(f'''SELECT tile, hash FROM {source}
+                                      WHERE zoom = %s AND x = %s AND y = %s''',
+                                  (tile.zoom, tile.x, tile.y), binary=True)
+                result = await cur.fetchone()
+                if result is None:
+                    return None
+                return result[0], result[1]
+
+    async def get_tiles(self, id: str,
+                        tiles: Sequence[Tile]) -> list[tuple[bytes, bytes | None] | None]:
+        '''Gets many tiles as stored and the hashes of their content, in the same
+           order as tiles
+        '''
+        stored: dict[tuple[int, int, int], tuple[bytes, bytes | None]] = {}
+        async with self.__pool.connection() as conn:
+            async with conn.cursor() as cur:
+                source = f'''"{self.__schema}"."{id}"'''
+                if await self.__is_deduplicated(cur, id):
+                    source += f''' JOIN "{self.__schema}"."{id}_blobs" USING (hash)'''
+                for zoom, (xs, ys) in coordinates_by_zoom(tiles).items():
+                    await cur.execute(f'''SELECT x, y, tile, hash FROM {source}
+                                          WHERE zoom = %s
+                                          AND (x, y) IN (SELECT *
+                                                         FROM unnest(%s::int[], %s::int[]))''',
+                                      (zoom, xs, ys), binary=True)
+                    async for x, y, data, hash in cur:
+                        stored[(zoom, x, y)] = (data, hash)
+        return [stored.get((tile.zoom, tile.x, tile.y)) for tile in tiles]
+
+    async def get_tile_hash(self, id: str, tile: Tile) -> bytes | None:
+        '''Gets the hash of the content of a tile, without reading the tile'''
+        async with self.__pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(f'''SELECT hash FROM "{self.__schema}"."{id}"
+                                      WHERE zoom = %s AND x = %s AND y = %s''',
+                                  (tile.zoom, tile.x, tile.y), binary=True)
+                result = await cur.fetchone()
+                if result is None:
+                    return None
+                return result[0]
+
+    async def close(self) -> None:
+        await self.__pool.close()
+
+    async def __is_deduplicated(self, cur, id: str) -> bool:
+        '''Returns if a tileset is stored deduplicated, looking it up the first time'''
+        if id not in self.__deduplicated:
+            await cur.execute(f'''SELECT deduplicate
+                                  FROM "{self.__schema}"."{METADATA_TABLE}"
+                                  WHERE id = %s''', (id,))
+            result = await cur.fetchone()
+            if result is None:
+                raise KeyError(f"Tileset {id} does not exist in storage")
+            self.__deduplicated[id] = result[0]
+        return self.__deduplicated[id]
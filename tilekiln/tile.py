@@ -1,3 +1,10 @@
+import math
+from collections.abc import Iterator
+
+# Web mercator is clipped to a square, which happens at this latitude
+MAX_LATITUDE = 85.0511287798066
+
+
 # TODO: Add dataclass
 # TODO: __slots__?
 class Tile:
@@ -26,3 +33,88 @@ class Tile:
         '''Returns the bounding box for a tile
         '''
         return f'''ST_TileEnvelope({self.zoom}, {self.x}, {self.y}, margin=>{buffer})'''
+
+
+class Metatile:
+    def __init__(self, zoom: int, x: int, y: int, size: int):
+        '''Creates a metatile object, a block of size by size tiles
+
+           x and y are of the top-left tile. At low zooms the metatile is limited to the
+           whole world.
+        '''
+        assert size >= 1
+        assert x % size == 0
+        assert y % size == 0
+
+        self.zoom = zoom
+        self.x = x
+        self.y = y
+        self.size = min(size, 2**zoom)
+
+    def __repr__(self):
+        return f"Metatile({self.zoom},{self.x},{self.y},{self.size})"
+
+    @classmethod
+    def from_tile(cls, tile: Tile, size: int):
+        '''Returns the metatile containing a tile'''
+        size = min(size, 2**tile.zoom)
+        return cls(tile.zoom, tile.x - tile.x % size, tile.y - tile.y % size, size)
+
+    @property
+    def max_x(self) -> int:
+        return min(self.x + self.size, 2**self.zoom) - 1
+
+    @property
+    def max_y(self) -> int:
+        return min(self.y + self.size, 2**self.zoom) - 1
+
+    def tiles(self) -> Iterator[Tile]:
+        '''Yields the tiles in the metatile'''
+        for x in range(self.x, self.max_x + 1):
+            for y in range(self.y, self.max_y + 1):
+                yield Tile(self.zoom, x, y)
+
+
+def lonlat_to_xy(lon: float, lat: float, zoom: int) -> tuple[int, int]:
+    '''Returns the x and y of the tile at a zoom containing a longitude and latitude
+
+    Points outside of web mercator are clamped to the nearest tile.
+    '''
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    n = 2**zoom
+    x = math.floor((lon + 180) / 360 * n)
+    y = math.floor((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return max(0, min(n - 1, x)), max(0, min(n - 1, y))
+
+
+def tiles_in_bbox(bbox: list[float], minzoom: int, maxzoom: int) -> Iterator[Tile]:
+    '''Yields all the tiles from minzoom to maxzoom covering a bounding box
+
+    The bounding box is [west, south, east, north] in degrees, the same as a TileJSON.
+    Tiles are generated as needed, so this can be used for ranges with too many tiles
+    to hold in memory.
+    '''
+    west, south, east, north = bbox
+    for zoom in range(minzoom, maxzoom + 1):
+        # y increases southwards, so the north-west corner has the minimum x and y
+        min_x, min_y = lonlat_to_xy(west, north, zoom)
+        max_x, max_y = lonlat_to_xy(east, south, zoom)
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                yield Tile(zoom, x, y)
+
+
+def metatiles_in_bbox(bbox: list[float], minzoom: int, maxzoom: int,
+                      size: int) -> Iterator[Metatile]:
+    '''Yields all the metatiles from minzoom to maxzoom covering a bounding box
+
+    This is the same as tiles_in_bbox, but for metatiles of a given size.
+    '''
+    west, south, east, north = bbox
+    for zoom in range(minzoom, maxzoom + 1):
+        zoom_size = min(size, 2**zoom)
+        min_x, min_y = lonlat_to_xy(west, north, zoom)
+        max_x, max_y = lonlat_to_xy(east, south, zoom)
+        for x in range(min_x - min_x % zoom_size, max_x + 1, zoom_size):
+            for y in range(min_y - min_y % zoom_size, max_y + 1, zoom_size):
+                yield Metatile(zoom, x, y, zoom_size)
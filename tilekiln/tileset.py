@@ -1,8 +1,11 @@
 from __future__ import annotations
-from dataclasses import dataclass
+import json
+from dataclasses import dataclass, field
+
+from collections.abc import Callable, Iterable
 
 from tilekiln.config import Config
-from tilekiln.tile import Tile
+from tilekiln.tile import Metatile, Tile
 
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
@@ -22,12 +25,17 @@ class Tileset:
     minzoom: int
     maxzoom: int
     tilejson: str
+    # Cache-Control header values, by the zoom they start applying at
+    cache_control: dict[int, str] = field(default_factory=dict)
+    # The TileJSON with the tile URLs filled in, by the URL of the tileset
+    _tilejsons: dict[str, bytes] = field(default_factory=dict, init=False, repr=False,
+                                         compare=False)
 
     @classmethod
     def from_config(cls, storage: Storage, config: Config):
         '''Create a tileset from a Storage and Config'''
         return cls(storage, config.id, config.minzoom, config.maxzoom,
-                   config.tilejson('REPLACED_BY_SERVER'))
+                   config.tilejson('REPLACED_BY_SERVER'), config.cache_control)
 
     @classmethod
     def from_id(cls, storage: Storage, id: str) -> Tileset:
@@ -36,22 +44,58 @@ class Tileset:
 
         This pulls the metadata from the storage
         '''
-        minzoom = storage.get_minzoom(id)
-        maxzoom = storage.get_minzoom(id)
-        tilejson = storage.get_tilejson(id, 'REPLACED_BY_SERVER')
-        return cls(storage, id, minzoom, maxzoom, tilejson)
+        tileset = storage.get_tileset(id)
+        return cls(storage, id, tileset.minzoom, tileset.maxzoom, tileset.tilejson,
+                   tileset.cache_control)
 
-    def prepare_storage(self) -> None:
+    def prepare_storage(self, deduplicate: bool = False) -> None:
         self.storage.create_tileset(self.id, self.minzoom, self.maxzoom,
-                                    self.tilejson)
+                                    self.tilejson, deduplicate, self.cache_control)
 
     def update_storage_metadata(self) -> None:
         '''Sets the metadata in storage'''
         self.storage.set_metadata(self.id, self.minzoom, self.maxzoom,
-                                  self.tilejson)
+                                  self.tilejson, self.cache_control)
+
+    def get_tilejson(self, url: str) -> bytes:
+        '''Returns the TileJSON with tiles served from url, the URL of the tileset
+
+        This is only computed once for each url.
+        '''
+        tilejson = self._tilejsons.get(url)
+        if tilejson is None:
+            modified_tilejson = json.loads(self.tilejson)
+            modified_tilejson["tiles"] = [url + "/{z}/{x}/{y}.mvt"]
+            tilejson = json.dumps(modified_tilejson).encode()
+            self._tilejsons[url] = tilejson
+        return tilejson
 
     def get_tile(self, tile: Tile) -> bytes | None:
         return self.storage.get_tile(self.id, tile)
 
+    def get_stored_tile(self, tile: Tile) -> tuple[bytes, bytes | None] | None:
+        return self.storage.get_stored_tile(self.id, tile)
+
+    def get_tile_hash(self, tile: Tile) -> bytes | None:
+        return self.storage.get_tile_hash(self.id, tile)
+
+    def get_cache_control(self, zoom: int) -> str | None:
+        '''Returns the Cache-Control header for tiles at a zoom, if there is one'''
+        zooms = [z for z in self.cache_control if z <= zoom]
+        if not zooms:
+            return None
+        return self.cache_control[max(zooms)]
+
     def save_tile(self, tile: Tile, data: bytes) -> None:
         self.storage.save_tile(self.id, tile, data)
+
+    def save_tiles(self, tiles: Iterable[tuple[Tile, bytes]]) -> int:
+        return self.storage.save_tiles(self.id, tiles)
+
+    def get_or_render_metatile(self, tile: Tile, metatile: Metatile,
+                               render: Callable[[], Iterable[tuple[Tile, bytes]]],
+                               save: Callable[[list[tuple[Tile, bytes]]], object] | None = None,
+                               pending: Callable[[Tile], bytes | None] | None = None
+                               ) -> dict[tuple[int, int], tuple[bytes, bytes]]:
+        return self.storage.get_or_render_metatile(self.id, tile, metatile, render, save,
+                                                   pending)
@@ -0,0 +1,140 @@
+import queue
+import threading
+from collections.abc import Iterable
+
+import click
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+from tilekiln.storage import SAVE_BATCH_SIZE, Storage
+from tilekiln.tile import Tile
+
+# Policies for when the queue is full
+BLOCK = "block"
+DROP = "drop"
+POLICIES = (BLOCK, DROP)
+
+PendingKey = tuple[str, int, int, int]
+
+
+class TileWriter:
+    '''
+    Saves tiles to storage in the background, in batches
+
+    Tiles are put on a bounded queue and saved by a writer thread, which takes
+    as many tiles as are waiting, up to SAVE_BATCH_SIZE, and saves them with
+    Storage.save_tiles. When the queue is full, the block policy waits for space and
+    the drop policy discards the tiles, so they will be rendered again when next
+    requested.
+
+    Tiles which are queued or being saved can be read with get_pending, so they
+    can be served before they are in storage.
+    '''
+    def __init__(self, storage: Storage, max_size: int, policy: str = BLOCK):
+        assert policy in POLICIES
+        self.__storage = storage
+        self.__policy = policy
+        self.__queue: queue.Queue[tuple[str, Tile, bytes] | None] = queue.Queue(max_size)
+
+        self.__pending: dict[PendingKey, bytes] = {}
+        self.__pending_lock = threading.Lock()
+
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self.__thread = threading.Thread(target=self.__run, daemon=True,
+                                         name="tilekiln-writer")
+        self.__thread.start()
+
+    @property
+    def depth(self) -> int:
+        '''Number of tiles waiting in the queue'''
+        return self.__queue.qsize()
+
+    def put(self, id: str, tiles: Iterable[tuple[Tile, bytes]]) -> bool:
+        '''Queue tiles to be saved, returning False if any were dropped'''
+        saved = True
+        for tile, data in tiles:
+            with self.__pending_lock:
+                self.__pending[(id, tile.zoom, tile.x, tile.y)] = data
+            try:
+                self.__queue.put((id, tile, data), block=self.__policy == BLOCK)
+            except queue.Full:
+                self.__remove_pending(id, tile, data)
+                self.dropped += 1
+                saved = False
+        return saved
+
+    def get_pending(self, id: str, tile: Tile) -> bytes | None:
+        '''Returns a tile which is waiting to be saved, or None if there isn't one'''
+        with self.__pending_lock:
+            return self.__pending.get((id, tile.zoom, tile.x, tile.y))
+
+    def close(self) -> None:
+        '''Save the tiles in the queue and stop the writer thread'''
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __run(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            batch = [item]
+            # Take whatever else is waiting, without waiting for more
+            while len(batch) < SAVE_BATCH_SIZE:
+                try:
+                    item = self.__queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.__save(batch)
+                    return
+                batch.append(item)
+            self.__save(batch)
+
+    def __save(self, batch: list[tuple[str, Tile, bytes]]):
+        tilesets: dict[str, list[tuple[Tile, bytes]]] = {}
+        for id, tile, data in batch:
+            tilesets.setdefault(id, []).append((tile, data))
+        for id, tiles in tilesets.items():
+            try:
+                self.written += self.__storage.save_tiles(id, tiles)
+            except Exception as e:
+                self.failed += len(tiles)
+                click.echo(f"Failed to save {len(tiles)} tiles for {id}: {e}", err=True)
+            for tile, data in tiles:
+                self.__remove_pending(id, tile, data)
+
+    def __remove_pending(self, id: str, tile: Tile, data: bytes):
+        '''Stop a tile being pending, unless it has been replaced by a newer copy'''
+        key = (id, tile.zoom, tile.x, tile.y)
+        with self.__pending_lock:
+            if self.__pending.get(key) is data:
+                del self.__pending[key]
+
+
+class WriterCollector(Collector):
+    '''Prometheus metrics for a TileWriter'''
+    def __init__(self, writer: TileWriter):
+        self.__writer = writer
+        super().__init__()
+
+    def collect(self):
+        depth = GaugeMetricFamily('tilekiln_write_queue_depth',
+                                  'Tiles waiting to be saved to storage')
+        depth.add_metric([], self.__writer.depth)
+        yield depth
+        written = CounterMetricFamily('tilekiln_write_queue_written',
+                                      'Tiles saved to storage from the queue')
+        written.add_metric([], self.__writer.written)
+        yield written
+        dropped = CounterMetricFamily('tilekiln_write_queue_dropped',
+                                      'Tiles dropped because the queue was full')
+        dropped.add_metric([], self.__writer.dropped)
+        yield dropped
+        failed = CounterMetricFamily('tilekiln_write_queue_failed',
+                                     'Tiles which failed to save to storage')
+        failed.add_metric([], self.__writer.failed)
+        yield failed